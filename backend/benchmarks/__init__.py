@@ -0,0 +1 @@
+"""OCRパイプラインのベンチマーク（Supabase・Gemini の代わりにローカルのスタンドインを使用）"""
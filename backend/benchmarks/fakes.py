@@ -0,0 +1,325 @@
+"""ベンチマーク用のSupabase・ストレージ・Gemini のスタンドイン
+
+実際のサービスと同じインターフェース（supabase-py のクエリビルダー、ストレージ、
+httpx でのダウンロード、GenerativeModel.generate_content_async）を持ち、
+遅延・エラー率・429の発生率を設定できる。ClientRegistry と差し替えて使う。
+"""
+import asyncio
+import math
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+from google.api_core import exceptions as google_exceptions
+
+STORAGE_BASE_URL = "http://fake-storage.local/storage/v1/object/public"
+
+
+@dataclass
+class LatencyProfile:
+    """遅延（平均・ばらつき）とエラー率の設定"""
+    mean: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+
+    def sample(self) -> float:
+        if self.mean <= 0:
+            return 0.0
+        if self.jitter <= 0:
+            return self.mean
+        # 平均 mean・標準偏差 jitter の対数正規分布で裾の長い遅延を再現する
+        sigma = math.sqrt(math.log(1 + (self.jitter / self.mean) ** 2))
+        return random.lognormvariate(math.log(self.mean) - sigma ** 2 / 2, sigma)
+
+
+class FakeAPIResponse:
+    def __init__(self, data: List[dict]):
+        self.data = data
+
+
+class FakeQuery:
+    """supabase-py のクエリビルダーのうち、アプリで使う部分だけを実装する"""
+
+    def __init__(self, db: "FakeSupabase", table: str):
+        self.db = db
+        self.table_name = table
+        self.action = "select"
+        self.columns = "*"
+        self.payload: Any = None
+        self.filters: List = []
+        self.orders: List = []
+        self.limit_count: Optional[int] = None
+        self.range_bounds: Optional[tuple] = None
+
+    def select(self, columns: str = "*"):
+        self.action, self.columns = "select", columns
+        return self
+
+    def insert(self, payload):
+        self.action, self.payload = "insert", payload
+        return self
+
+    def update(self, payload: dict):
+        self.action, self.payload = "update", payload
+        return self
+
+    def upsert(self, payload, on_conflict: str = ""):
+        self.action, self.payload = "upsert", (payload, on_conflict)
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column: str, value):
+        self.filters.append(lambda row: str(row.get(column)) == str(value))
+        return self
+
+    def in_(self, column: str, values):
+        values = {str(v) for v in values}
+        self.filters.append(lambda row: str(row.get(column)) in values)
+        return self
+
+    def order(self, column: str, desc: bool = False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, count: int):
+        self.limit_count = count
+        return self
+
+    def range(self, start: int, end: int):
+        self.range_bounds = (start, end)
+        return self
+
+    def execute(self) -> FakeAPIResponse:
+        self.db.simulate()
+        with self.db.lock:
+            return FakeAPIResponse(getattr(self, f"_{self.action}")())
+
+    def _rows(self) -> List[dict]:
+        return self.db.tables.setdefault(self.table_name, [])
+
+    def _matching(self) -> List[dict]:
+        return [row for row in self._rows() if all(f(row) for f in self.filters)]
+
+    def _new_row(self, values: dict) -> dict:
+        now = datetime.now(timezone.utc).isoformat()
+        row = {"id": str(uuid.uuid4())}
+        if self.table_name == "medical_records":
+            row.update({"uploaded_at": now, "processing_status": "pending", "page_count": 1})
+        elif self.table_name == "extracted_data":
+            row.update({"extracted_at": now, "page_index": 0})
+        row.update(values)
+        return row
+
+    def _insert(self) -> List[dict]:
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        rows = [self._new_row(values) for values in payload]
+        self._rows().extend(rows)
+        return [dict(row) for row in rows]
+
+    def _upsert(self) -> List[dict]:
+        payload, on_conflict = self.payload
+        payload = payload if isinstance(payload, list) else [payload]
+        keys = [key.strip() for key in on_conflict.split(",") if key.strip()]
+        result = []
+        for values in payload:
+            existing = next(
+                (row for row in self._rows() if keys and all(row.get(k) == values.get(k) for k in keys)), None
+            )
+            if existing is not None:
+                existing.update(values)
+                result.append(dict(existing))
+            else:
+                row = self._new_row(values)
+                self._rows().append(row)
+                result.append(dict(row))
+        return result
+
+    def _update(self) -> List[dict]:
+        rows = self._matching()
+        for row in rows:
+            row.update(self.payload)
+        return [dict(row) for row in rows]
+
+    def _delete(self) -> List[dict]:
+        rows = self._matching()
+        self.db.tables[self.table_name] = [row for row in self._rows() if row not in rows]
+        return [dict(row) for row in rows]
+
+    def _select(self) -> List[dict]:
+        rows = self._matching()
+        for column, desc in reversed(self.orders):
+            rows.sort(key=lambda row: str(row.get(column) or ""), reverse=desc)
+        if self.range_bounds is not None:
+            rows = rows[self.range_bounds[0]:self.range_bounds[1] + 1]
+        elif self.limit_count is not None:
+            rows = rows[:self.limit_count]
+        result = [dict(row) for row in rows]
+        # 外部キーによる埋め込み（"*, extracted_data(*), extracted_fields(*)"）
+        for child_table in ("extracted_data", "extracted_fields"):
+            if f"{child_table}(" not in self.columns:
+                continue
+            children = self.db.tables.get(child_table, [])
+            for row in result:
+                row[child_table] = [dict(c) for c in children if c.get("record_id") == row["id"]]
+        return result
+
+
+class FakeBucket:
+    def __init__(self, storage: "FakeStorage", bucket: str):
+        self.storage = storage
+        self.bucket = bucket
+
+    def upload(self, path: str, file, file_options: Optional[dict] = None):
+        data = file.read() if hasattr(file, "read") else bytes(file)
+        self.storage.db.simulate(self.storage.latency)
+        with self.storage.db.lock:
+            self.storage.objects[f"{self.bucket}/{path}"] = data
+        return {"Key": f"{self.bucket}/{path}"}
+
+    def get_public_url(self, path: str) -> str:
+        return f"{STORAGE_BASE_URL}/{self.bucket}/{path}"
+
+
+class FakeStorage:
+    def __init__(self, db: "FakeSupabase", latency: LatencyProfile):
+        self.db = db
+        self.latency = latency
+        self.objects: Dict[str, bytes] = {}
+
+    def from_(self, bucket: str) -> FakeBucket:
+        return FakeBucket(self, bucket)
+
+
+class FakeSupabase:
+    """PostgREST とストレージのインメモリのスタンドイン（同期API。アプリと同じくスレッドプールから呼ばれる）"""
+
+    def __init__(self, db_latency: Optional[LatencyProfile] = None, storage_latency: Optional[LatencyProfile] = None):
+        self.latency = db_latency or LatencyProfile()
+        self.tables: Dict[str, List[dict]] = {}
+        self.lock = threading.Lock()
+        self.storage = FakeStorage(self, storage_latency or LatencyProfile())
+        self.queries = 0
+
+    def simulate(self, profile: Optional[LatencyProfile] = None) -> None:
+        profile = profile or self.latency
+        self.queries += 1
+        delay = profile.sample()
+        if delay:
+            time.sleep(delay)
+        if profile.error_rate and random.random() < profile.error_rate:
+            raise RuntimeError("Simulated database error")
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict):
+        raise NotImplementedError(f"RPC {name} is not available in the benchmark stand-in")
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.usage_metadata = type("Usage", (), {"total_token_count": prompt_tokens + len(text)})()
+
+
+class FakeGeminiStream:
+    """stream=True のレスポンス（チャンクを一定間隔で返す）"""
+
+    def __init__(self, text: str, chunk_count: int, chunk_delay: float, prompt_tokens: int):
+        step = max(1, len(text) // chunk_count)
+        self.chunks = [text[i:i + step] for i in range(0, len(text), step)]
+        self.chunk_delay = chunk_delay
+        self.usage_metadata = FakeGeminiResponse(text, prompt_tokens).usage_metadata
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.chunk_delay)
+            yield FakeGeminiResponse(chunk, 0)
+
+
+class FakeGeminiModel:
+    """GenerativeModel.generate_content_async のスタンドイン"""
+
+    def __init__(self, latency: Optional[LatencyProfile] = None, output_chars: int = 800):
+        self.latency = latency or LatencyProfile()
+        self.output_chars = output_chars
+        self.calls = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+    def _text(self) -> str:
+        line = "患者名: 山田太郎 診断: 高血圧 処方: 降圧剤 朝1錠 所見: 血圧145/95\n"
+        return (line * (self.output_chars // len(line) + 1))[:self.output_chars]
+
+    async def generate_content_async(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        self.calls += 1
+        roll = random.random()
+        if roll < self.latency.rate_limit_rate:
+            self.rate_limited += 1
+            await asyncio.sleep(0.01)
+            raise google_exceptions.ResourceExhausted("Simulated quota exceeded")
+        if roll < self.latency.rate_limit_rate + self.latency.error_rate:
+            self.errors += 1
+            await asyncio.sleep(0.01)
+            raise google_exceptions.ServiceUnavailable("Simulated overload")
+
+        delay = self.latency.sample()
+        text = self._text()
+        if stream:
+            # 最初のチャンクまでの遅延を全体の1割とし、残りをチャンクに分ける
+            await asyncio.sleep(delay * 0.1)
+            return FakeGeminiStream(text, 10, delay * 0.09, 258)
+        await asyncio.sleep(delay)
+        return FakeGeminiResponse(text, 258)
+
+
+class FakeClientRegistry:
+    """ClientRegistry と同じインターフェースでスタンドインを返す"""
+
+    def __init__(self, supabase: FakeSupabase, model: FakeGeminiModel, download_latency: Optional[LatencyProfile] = None):
+        self._supabase = supabase
+        self._model = model
+        self.download_latency = download_latency or LatencyProfile()
+        self._http: Optional[httpx.AsyncClient] = None
+
+    def warm_up(self, model_names: List[str]) -> None:
+        return None
+
+    def supabase(self) -> FakeSupabase:
+        return self._supabase
+
+    async def _serve_storage(self, request: httpx.Request) -> httpx.Response:
+        """ストレージの公開URLからのダウンロード"""
+        delay = self.download_latency.sample()
+        if delay:
+            await asyncio.sleep(delay)
+        key = str(request.url)[len(STORAGE_BASE_URL) + 1:]
+        data = self._supabase.storage.objects.get(key)
+        if data is None:
+            return httpx.Response(404)
+        return httpx.Response(200, content=data)
+
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(transport=httpx.MockTransport(self._serve_storage))
+        return self._http
+
+    def model(self, name: str = "gemini-1.5-pro") -> FakeGeminiModel:
+        return self._model
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
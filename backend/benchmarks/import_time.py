@@ -0,0 +1,102 @@
+"""コールドスタート時の main の読み込み時間の計測
+
+新しいインタプリタで `import main` にかかる時間をデフォルトの設定のまま計測し、中央値が予算を超えた場合や、
+初回の使用時に読み込むはずのSDK（Gemini・Supabase）が読み込み時に import された場合、
+読み込み時に作業ディレクトリにファイル（OCRキャッシュのDBなど）が作られた場合は終了コード1で終了する。
+FastAPI・httpx などフレームワーク自体の読み込み時間は環境による差が大きいため、先に読み込んでおき、
+予算はアプリ自身の読み込み時間（app_seconds）に適用する。全体の時間（total_seconds）も参考として出力する。
+
+    cd backend && python -m benchmarks.import_time --runs 5 --budget 0.3
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 予算の対象外とする（先に読み込んでおく）フレームワーク
+FRAMEWORK_MODULES = ("fastapi", "starlette", "pydantic", "httpx", "prometheus_client", "dotenv")
+# main の読み込み時に import されてはいけないモジュール
+LAZY_MODULES = ("google.generativeai", "google.api_core.exceptions", "supabase", "postgrest")
+
+DEFAULT_BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", "0.3"))
+
+_SCRIPT = """
+import json, os, sys, time
+before = set(os.listdir("."))
+started = time.perf_counter()
+for name in {framework!r}:
+    __import__(name)
+framework_done = time.perf_counter()
+import main
+finished = time.perf_counter()
+print(json.dumps({{
+    "total_seconds": finished - started,
+    "app_seconds": finished - framework_done,
+    "loaded": [name for name in {lazy!r} if name in sys.modules],
+    "created": sorted(set(os.listdir(".")) - before),
+}}))
+"""
+
+
+def measure_once(env: Optional[Dict[str, str]] = None) -> dict:
+    """新しいインタプリタで main を1回読み込み、所要時間と読み込まれたSDKを返す"""
+    script = _SCRIPT.format(framework=FRAMEWORK_MODULES, lazy=LAZY_MODULES)
+    child_env = {**os.environ, **(env or {})}
+    completed = subprocess.run(
+        [sys.executable, "-c", script], cwd=BACKEND_DIR, env=child_env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run(runs: int = 5, budget: float = DEFAULT_BUDGET) -> dict:
+    samples = [measure_once() for _ in range(runs)]
+    app_seconds = statistics.median(sample["app_seconds"] for sample in samples)
+    loaded = sorted({name for sample in samples for name in sample["loaded"]})
+    created = sorted({name for sample in samples for name in sample["created"]})
+    return {
+        "runs": runs,
+        "budget_seconds": budget,
+        "app_seconds": app_seconds,
+        "total_seconds": statistics.median(sample["total_seconds"] for sample in samples),
+        "eagerly_loaded": loaded,
+        "created_files": created,
+        "ok": app_seconds <= budget and not loaded and not created,
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"main import (median of {result['runs']}): app {result['app_seconds'] * 1000:.0f} ms "
+        f"(budget {result['budget_seconds'] * 1000:.0f} ms), total {result['total_seconds'] * 1000:.0f} ms",
+    ]
+    if result["eagerly_loaded"]:
+        lines.append(f"SDKs imported at module load: {', '.join(result['eagerly_loaded'])}")
+    if result["created_files"]:
+        lines.append(f"Files created at module load: {', '.join(result['created_files'])}")
+    lines.append("OK" if result["ok"] else "FAILED")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="main の読み込み時間（コールドスタート）の計測")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="アプリ自身の読み込み時間の上限（秒）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    return parser.parse_args(argv)
+
+
+def cli(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    result = run(args.runs, args.budget)
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+    if not result["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
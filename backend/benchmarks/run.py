@@ -0,0 +1,302 @@
+"""OCRパイプラインの負荷試験
+
+FastAPIアプリをプロセス内で起動し、Supabase・ストレージ・Gemini をスタンドイン（benchmarks.fakes）に
+差し替えた上で、アップロードと完了待ち（ポーリングまたはSSE）を並列に実行する。
+スループット、アップロード・完了までのレイテンシ（p50/p95/p99）、メモリ使用量、段階ごとの所要時間を出力する。
+
+    cd backend && python -m benchmarks.run --uploads 200 --concurrency 20 --gemini-latency 3
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import math
+import resource
+import sys
+import time
+import tracemalloc
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image, ImageDraw
+
+import main
+import metrics
+from benchmarks.fakes import FakeClientRegistry, FakeGeminiModel, FakeSupabase, LatencyProfile
+from blob_cache import BlobCache
+from events import RecordEventBus
+from job_queue import create_backend
+from ocr_cache import MemoryCacheTier, OCRCache
+from rate_limit import CircuitBreaker, TokenBucket
+from record_cache import RecordCache
+from search import InMemorySearchIndex
+
+TERMINAL = ("completed", "failed")
+
+
+@dataclass
+class BenchmarkConfig:
+    """負荷試験の設定（遅延は秒）"""
+    uploads: int = 100
+    concurrency: int = 10
+    wait: str = "poll"  # poll / sse
+    poll_interval: float = 0.5
+    timeout: float = 600.0
+    gemini_latency: float = 2.0
+    gemini_jitter: float = 0.5
+    gemini_error_rate: float = 0.0
+    gemini_429_rate: float = 0.0
+    gemini_rpm: float = 0.0
+    rate_limit_cooldown: float = 1.0
+    db_latency: float = 0.02
+    storage_latency: float = 0.05
+    download_latency: float = 0.02
+    workers: int = 4
+    queue_size: int = 0
+    image_size: int = 1600
+    streaming: bool = True
+    trace_memory: bool = False
+
+
+def percentile(values: List[float], q: float) -> float:
+    """最近傍順位法によるパーセンタイル（値がなければ0）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4) if values else 0.0,
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4) if values else 0.0,
+    }
+
+
+def make_sample_image(size: int) -> bytes:
+    """カルテ画像の代わりになるJPEG（罫線と文字を描いた縦長の画像）"""
+    width, height = size * 3 // 4, size
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(40, height, 40):
+        draw.line([(20, y), (width - 20, y)], fill=(180, 180, 180))
+        draw.text((30, y - 30), f"Line {y // 40}: BP 145/95 Rx amlodipine 5mg", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+@asynccontextmanager
+async def benchmark_app(config: BenchmarkConfig, supabase: FakeSupabase, model: FakeGeminiModel):
+    """main のクライアント・キャッシュ等をスタンドインに差し替えてアプリを起動する（終了時に元に戻す）"""
+    limiter = main.rate_limiter
+    overrides = {
+        "supabase_url": "http://fake-supabase.local",
+        "supabase_key": "benchmark",
+        "clients": FakeClientRegistry(supabase, model, LatencyProfile(config.download_latency)),
+        "search_backend": InMemorySearchIndex(),
+        "ocr_cache": OCRCache(MemoryCacheTier()),
+        # 画像のディスクキャッシュは使わない（再処理を含まないため、ストレージからのダウンロードは発生しない）
+        "blob_cache": BlobCache("", enabled=False),
+        "record_cache": RecordCache(),
+        "record_events": RecordEventBus(),
+        "ocr_streaming": config.streaming,
+    }
+    saved = {name: getattr(main, name) for name in overrides}
+    # レート制御とジョブキューは起動済みのオブジェクトを直接変更する（ジョブキューのゲートが参照しているため）
+    # asyncio のキュー・ロックはイベントループに紐づくため、実行ごとに作り直す
+    saved_limiter = (limiter.requests, limiter.tokens, limiter.breaker, limiter._lock)
+    saved_queue = (main.job_queue.workers, main.job_queue.backend)
+    for name, value in overrides.items():
+        setattr(main, name, value)
+    limiter.requests = TokenBucket(config.gemini_rpm)
+    limiter.tokens = TokenBucket(0)
+    limiter.breaker = CircuitBreaker(config.rate_limit_cooldown, config.rate_limit_cooldown * 10)
+    limiter._lock = asyncio.Lock()
+    main.job_queue.workers = config.workers
+    main.job_queue.backend = create_backend("memory", maxsize=config.queue_size)
+    metrics.QUEUE_DEPTH.set_function(main.job_queue.backend.qsize)
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=config.timeout) as client:
+                yield client
+    finally:
+        for name, value in saved.items():
+            setattr(main, name, value)
+        limiter.requests, limiter.tokens, limiter.breaker, limiter._lock = saved_limiter
+        main.job_queue.workers, main.job_queue.backend = saved_queue
+        metrics.QUEUE_DEPTH.set_function(main.job_queue.backend.qsize)
+
+
+async def wait_by_polling(client: httpx.AsyncClient, record_id: str, interval: float) -> str:
+    while True:
+        response = await client.get(f"/api/records/{record_id}")
+        if response.status_code == 200:
+            status = response.json()["record"]["processing_status"]
+            if status in TERMINAL:
+                return status
+        await asyncio.sleep(interval)
+
+
+async def wait_by_sse(client: httpx.AsyncClient, record_id: str) -> str:
+    """SSEのストリームは完了・エラーで閉じるため、最後のイベントの状態を返す"""
+    status = "unknown"
+    async with client.stream("GET", f"/api/records/{record_id}/events") as response:
+        async for line in response.aiter_lines():
+            if line.startswith("data: "):
+                status = json.loads(line[len("data: "):]).get("processing_status", status)
+    return status
+
+
+async def run_benchmark(config: BenchmarkConfig) -> dict:
+    """負荷試験を実行し、結果を辞書で返す"""
+    supabase = FakeSupabase(LatencyProfile(config.db_latency), LatencyProfile(config.storage_latency))
+    model = FakeGeminiModel(LatencyProfile(
+        config.gemini_latency, config.gemini_jitter, config.gemini_error_rate, config.gemini_429_rate,
+    ))
+    sample = make_sample_image(config.image_size)
+    semaphore = asyncio.Semaphore(config.concurrency)
+    upload_latencies: List[float] = []
+    end_to_end: List[float] = []
+    outcomes: Dict[str, int] = {}
+
+    def count(outcome: str) -> None:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    async def one_upload(client: httpx.AsyncClient) -> None:
+        # 画像ごとに末尾のバイト列を変え、OCR結果キャッシュに当たらないようにする
+        image = sample + uuid.uuid4().bytes
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/api/upload", files={"file": ("chart.jpg", image, "image/jpeg")})
+            upload_latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            count(f"upload_{response.status_code}")
+            return
+        record_id = response.json()["record_id"]
+        try:
+            if config.wait == "sse":
+                status = await asyncio.wait_for(wait_by_sse(client, record_id), config.timeout)
+            else:
+                status = await asyncio.wait_for(wait_by_polling(client, record_id, config.poll_interval), config.timeout)
+        except asyncio.TimeoutError:
+            status = "timeout"
+        count(status)
+        if status == "completed":
+            end_to_end.append(time.perf_counter() - started)
+
+    if config.trace_memory:
+        tracemalloc.start()
+    async with benchmark_app(config, supabase, model) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one_upload(client) for _ in range(config.uploads)))
+        elapsed = time.perf_counter() - started
+        health = (await client.get("/api/health")).json()
+    traced_peak = tracemalloc.get_traced_memory()[1] if config.trace_memory else None
+    if config.trace_memory:
+        tracemalloc.stop()
+
+    # 段階ごとの所要時間（extracted_data.stage_timings）
+    stages: Dict[str, List[float]] = {}
+    for row in supabase.tables.get("extracted_data", []):
+        for stage, seconds in (row.get("stage_timings") or {}).items():
+            stages.setdefault(stage, []).append(seconds)
+
+    completed = outcomes.get("completed", 0)
+    return {
+        "config": asdict(config),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(completed / elapsed, 3) if elapsed else 0.0,
+        "outcomes": outcomes,
+        "upload_latency": summarize(upload_latencies),
+        "end_to_end_latency": summarize(end_to_end),
+        "stage_timings": {stage: summarize(values) for stage, values in stages.items()},
+        "gemini": {"calls": model.calls, "rate_limited": model.rate_limited, "errors": model.errors},
+        "rate_limit": health["rate_limit"],
+        "db_queries": supabase.queries,
+        "memory": {
+            # Linuxでは KiB 単位
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "traced_peak_mb": round(traced_peak / (1024 * 1024), 1) if traced_peak is not None else None,
+        },
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"uploads: {result['config']['uploads']}  concurrency: {result['config']['concurrency']}  "
+        f"wait: {result['config']['wait']}  workers: {result['config']['workers']}",
+        f"elapsed: {result['elapsed_seconds']}s  throughput: {result['throughput_per_second']} records/s",
+        f"outcomes: {result['outcomes']}",
+        f"gemini: {result['gemini']}  db queries: {result['db_queries']}",
+        f"memory: {result['memory']}",
+        "",
+        f"{'latency (s)':<22}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}",
+    ]
+    rows = [("upload", result["upload_latency"]), ("end-to-end", result["end_to_end_latency"])]
+    rows += [(f"stage:{stage}", values) for stage, values in sorted(result["stage_timings"].items())]
+    for name, values in rows:
+        lines.append(
+            f"{name:<22}{values['mean']:>9.3f}{values['p50']:>9.3f}{values['p95']:>9.3f}"
+            f"{values['p99']:>9.3f}{values['max']:>9.3f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    defaults = BenchmarkConfig()
+    parser = argparse.ArgumentParser(description="OCRパイプラインの負荷試験（Supabase・Geminiはスタンドイン）")
+    parser.add_argument("--uploads", type=int, default=defaults.uploads)
+    parser.add_argument("--concurrency", type=int, default=defaults.concurrency, help="同時アップロード数")
+    parser.add_argument("--wait", choices=["poll", "sse"], default=defaults.wait, help="完了の待ち方")
+    parser.add_argument("--poll-interval", type=float, default=defaults.poll_interval)
+    parser.add_argument("--timeout", type=float, default=defaults.timeout, help="1件あたりの完了待ちの上限")
+    parser.add_argument("--gemini-latency", type=float, default=defaults.gemini_latency)
+    parser.add_argument("--gemini-jitter", type=float, default=defaults.gemini_jitter)
+    parser.add_argument("--gemini-error-rate", type=float, default=defaults.gemini_error_rate, help="503の発生率")
+    parser.add_argument("--gemini-429-rate", type=float, default=defaults.gemini_429_rate, help="429の発生率")
+    parser.add_argument("--gemini-rpm", type=float, default=defaults.gemini_rpm, help="レート制御の上限（0は無制限）")
+    parser.add_argument("--rate-limit-cooldown", type=float, default=defaults.rate_limit_cooldown)
+    parser.add_argument("--db-latency", type=float, default=defaults.db_latency)
+    parser.add_argument("--storage-latency", type=float, default=defaults.storage_latency)
+    parser.add_argument("--download-latency", type=float, default=defaults.download_latency)
+    parser.add_argument("--workers", type=int, default=defaults.workers, help="OCRワーカー数")
+    parser.add_argument("--queue-size", type=int, default=defaults.queue_size, help="キューの上限（0は無制限）")
+    parser.add_argument("--image-size", type=int, default=defaults.image_size, help="サンプル画像の高さ（px）")
+    parser.add_argument("--no-streaming", action="store_true", help="Geminiのストリーミングを無効にする")
+    parser.add_argument("--trace-memory", action="store_true", help="tracemallocでPythonのメモリ確保量を計測する")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    return parser.parse_args(argv)
+
+
+def cli(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    config = BenchmarkConfig(
+        uploads=args.uploads, concurrency=args.concurrency, wait=args.wait, poll_interval=args.poll_interval,
+        timeout=args.timeout, gemini_latency=args.gemini_latency, gemini_jitter=args.gemini_jitter,
+        gemini_error_rate=args.gemini_error_rate, gemini_429_rate=args.gemini_429_rate, gemini_rpm=args.gemini_rpm,
+        rate_limit_cooldown=args.rate_limit_cooldown, db_latency=args.db_latency,
+        storage_latency=args.storage_latency, download_latency=args.download_latency, workers=args.workers,
+        queue_size=args.queue_size, image_size=args.image_size, streaming=not args.no_streaming,
+        trace_memory=args.trace_memory,
+    )
+    # 1件ごとのINFOログは計測の妨げになるため抑える
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(run_benchmark(config))
+    print(json.dumps(result, ensure_ascii=False, indent=2) if args.json else format_report(result))
+    if result["outcomes"].get("completed", 0) < config.uploads:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
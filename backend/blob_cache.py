@@ -0,0 +1,176 @@
+"""ストレージのオブジェクト（カルテ画像）のローカルディスクキャッシュ
+
+アップロード時に一時ファイルをそのままキャッシュに登録し、再処理・復旧時にストレージから
+ダウンロードし直さないようにする。ファイルは内容のSHA-256で保存し（同じ画像は1つだけ）、
+合計サイズの上限を超えると最終アクセスが古いものから削除する。
+公開URLとSHA-256・ETagの対応もSQLiteに記録し、ハッシュが分からないレコードでも利用できるようにする。
+取り出しに失敗した場合（索引のロック・ファイルのリンクやコピーのエラーなど）はキャッシュにないものとして扱い、
+呼び出し側はストレージからダウンロードする。
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from ingest import SpooledImage, link_or_copy, spool_file
+
+logger = logging.getLogger(__name__)
+
+class BlobCache:
+    """内容のSHA-256をキーにしたファイルキャッシュ（合計サイズ上限・LRU）"""
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024, enabled: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 索引のDBとディレクトリは最初に使うときに作る（main の読み込み時にファイルを作らない）
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        """索引のDB（初回・close後に使われた場合に開く。ロックを取得した状態で呼び出す）"""
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.directory, "index.db"), check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS blobs (
+                  sha256 TEXT PRIMARY KEY,
+                  size INTEGER NOT NULL,
+                  accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_accessed_at ON blobs(accessed_at)")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS urls (
+                  url TEXT PRIMARY KEY,
+                  sha256 TEXT NOT NULL,
+                  etag TEXT
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def path_for(self, sha256: str) -> str:
+        # 1ディレクトリのファイル数が増えすぎないよう先頭2文字で分ける
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def lookup(self, url: str, sha256: Optional[str] = None) -> Optional[Tuple[str, Optional[str]]]:
+        """キャッシュにある場合は (SHA-256, ETag) を返す（ハッシュが分からない場合はURLで探す）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                db = self._db()
+                etag = None
+                if sha256 is None:
+                    row = db.execute("SELECT sha256, etag FROM urls WHERE url = ?", (url,)).fetchone()
+                    sha256, etag = row if row is not None else (None, None)
+                found = sha256 is not None and db.execute(
+                    "SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)
+                ).fetchone() is not None
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Blob cache lookup failed for {url}, treating it as a miss: {str(e)}")
+                found = False
+            if not found:
+                self.misses += 1
+                return None
+        return sha256, etag
+
+    def checkout(self, sha256: str, filename: str = "", content_type: Optional[str] = None) -> Optional[SpooledImage]:
+        """キャッシュの画像を一時ファイルとして取り出す（ワーカーが削除してもキャッシュには残る）"""
+        if not self.enabled:
+            return None
+        path = self.path_for(sha256)
+        with self._lock:
+            try:
+                db = self._db()
+                try:
+                    image = spool_file(path, sha256, filename, content_type)
+                except FileNotFoundError:
+                    # 手動で削除されていた場合などは索引からも削除する
+                    db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                    db.commit()
+                    self.misses += 1
+                    return None
+            except (OSError, sqlite3.Error) as e:
+                # 別のデバイスへのコピーの失敗・索引のロックなど（ストレージからダウンロードし直す）
+                logger.warning(f"Blob cache checkout failed for {sha256}, treating it as a miss: {str(e)}")
+                self.misses += 1
+                return None
+            try:
+                db.execute("UPDATE blobs SET accessed_at = ? WHERE sha256 = ?", (time.time(), sha256))
+                db.commit()
+            except sqlite3.Error as e:
+                # 取り出した画像は使える（最終アクセスの更新だけを諦める）
+                logger.warning(f"Failed to update blob cache access time for {sha256}: {str(e)}")
+        self.hits += 1
+        return image
+
+    def put(self, image: SpooledImage, url: Optional[str] = None, etag: Optional[str] = None) -> None:
+        """一時ファイルの画像をキャッシュに登録する（url を渡すとURLからも引けるようにする）"""
+        if not self.enabled:
+            return
+        path = self.path_for(image.sha256)
+        with self._lock:
+            db = self._db()
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 書き込み途中のファイルを読まないよう、別名で作成してから置き換える
+                temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+                link_or_copy(image.path, temporary)
+                os.replace(temporary, path)
+            db.execute(
+                "INSERT OR REPLACE INTO blobs (sha256, size, accessed_at) VALUES (?, ?, ?)",
+                (image.sha256, image.size, time.time()),
+            )
+            if url is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO urls (url, sha256, etag) VALUES (?, ?, ?)", (url, image.sha256, etag)
+                )
+            self._evict(db)
+            db.commit()
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = db.execute("SELECT sha256, size FROM blobs ORDER BY accessed_at").fetchall()
+        for sha256, size in rows:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path_for(sha256))
+            except FileNotFoundError:
+                pass
+            db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            db.execute("DELETE FROM urls WHERE sha256 = ?", (sha256,))
+            total -= size
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        with self._lock:
+            count, total = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {
+            "enabled": True,
+            "entries": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,51 @@
+"""同期I/Oのオフロード
+
+supabase-py のクエリ実行やストレージ操作は同期APIのため、イベントループ上で直接呼ぶと
+その間すべてのリクエストが停止する。専用のスレッドプールで実行し、結果を await できるようにする。
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_max_workers = 16
+
+
+def configure(max_workers: int) -> None:
+    """スレッドプールのサイズを設定する（次回の生成時に反映）"""
+    global _max_workers
+    _max_workers = max_workers
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """同期I/O専用のスレッドプールを取得する"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix="blocking-io")
+        logger.info(f"Blocking I/O thread pool started with {_max_workers} threads")
+    return _executor
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """同期関数をスレッドプールで実行し、完了を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def execute(query) -> Any:
+    """Supabase（PostgREST）のクエリをスレッドプールで実行する"""
+    return await run_blocking(query.execute)
+
+
+def shutdown() -> None:
+    """スレッドプールを停止する"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,241 @@
+"""カルテの一括再処理（プロンプト・モデル変更時の再実行）
+
+条件（処理状態・アップロード日時の範囲・OCRバージョン）に一致するカルテを (uploaded_at, id) の降順に
+一定件数ずつ取得し、キューに空きができるのを待ってから再処理ジョブを投入する。
+進捗（最後に投入したカルテのカーソル・投入件数）はバッチごとに reprocess_runs テーブルに保存し、
+実行中のプロセスは updated_at を定期的に更新し、stale_after 秒以上更新されていない一括再処理だけを
+他のプロセスが引き継いで続きから再開する（複数のプロセスが同時に引き継ごうとしても再開するのは1つだけ）。
+進捗・完了の保存は状態が running の場合だけ行い、他のプロセスで中止された一括再処理は次のバッチの前に止まる。
+"""
+import asyncio
+import logging
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from blocking_io import execute
+from pagination import decode_cursor, encode_cursor, keyset_filter
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+COMPLETED = "completed"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+# 一括再処理のために取得する列
+RECORD_COLUMNS = "id, original_image_url, image_sha256, uploaded_at"
+
+
+class _RunStopped(Exception):
+    """一括再処理が他のプロセスで中止された（状態が running でなくなった）"""
+
+
+@dataclass
+class BulkFilter:
+    """一括再処理の対象の条件（指定しない条件は絞り込まない）"""
+    status: Optional[str] = None
+    uploaded_from: Optional[str] = None
+    uploaded_to: Optional[str] = None
+    # このバージョンで処理されたカルテ
+    ocr_version: Optional[str] = None
+    # このバージョン以外（未記録を含む）で処理されたカルテ
+    exclude_ocr_version: Optional[str] = None
+
+    def apply(self, query):
+        if self.status is not None:
+            query = query.eq("processing_status", self.status)
+        if self.uploaded_from is not None:
+            query = query.gte("uploaded_at", self.uploaded_from)
+        if self.uploaded_to is not None:
+            query = query.lt("uploaded_at", self.uploaded_to)
+        if self.ocr_version is not None:
+            query = query.eq("ocr_version", self.ocr_version)
+        if self.exclude_ocr_version is not None:
+            query = query.neq("ocr_version", self.exclude_ocr_version)
+        return query
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in asdict(self).items() if value is not None}
+
+    @classmethod
+    def from_dict(cls, values: Optional[dict]) -> "BulkFilter":
+        return cls(**{key: value for key, value in (values or {}).items() if key in cls.__dataclass_fields__})
+
+
+class BulkReprocessor:
+    """一括再処理の実行を管理する（1件の一括再処理につき1つのタスク）
+
+    schedule は取得したカルテを再処理ジョブとして投入し、投入した件数を返す。
+    wait_for_capacity はキューに指定件数の空きができるまで待機する。
+    stale_after は実行中のプロセスが止まったとみなすまでの秒数（updated_at の更新はその1/3ごと）。
+    """
+
+    def __init__(
+        self,
+        get_client: Callable,
+        schedule: Callable[[List[dict], str, bool], Awaitable[int]],
+        wait_for_capacity: Callable[[int], Awaitable[None]],
+        max_batch_size: int = 500,
+        stale_after: float = 120.0,
+    ):
+        self._get_client = get_client
+        self.schedule = schedule
+        self.wait_for_capacity = wait_for_capacity
+        self.max_batch_size = max_batch_size
+        self.stale_after = stale_after
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def is_running(self, run_id: str) -> bool:
+        return run_id in self._tasks
+
+    async def start(self, bulk_filter: BulkFilter, bypass_cache: bool = False, batch_size: int = 100) -> dict:
+        """対象件数を数えて一括再処理を登録し、バックグラウンドで開始する"""
+        supabase = self._get_client()
+        counted = await execute(
+            bulk_filter.apply(supabase.table("medical_records").select("id", count="exact")).limit(1)
+        )
+        run = (await execute(supabase.table("reprocess_runs").insert({
+            "status": RUNNING,
+            "filter": bulk_filter.to_dict(),
+            "bypass_cache": bypass_cache,
+            "batch_size": max(1, min(batch_size, self.max_batch_size)),
+            "total": counted.count,
+        }))).data[0]
+        self._launch(run)
+        return run
+
+    async def resume(self) -> int:
+        """止まったプロセスで実行中だった一括再処理を引き継いで再開する"""
+        runs = await execute(
+            self._get_client().table("reprocess_runs").select("*").eq("status", RUNNING).order("created_at")
+        )
+        resumed = 0
+        for run in runs.data or []:
+            if not self.is_running(run["id"]) and await self._take_over(run):
+                self._launch(run)
+                resumed += 1
+        if resumed:
+            logger.info(f"Resumed {resumed} bulk reprocess runs")
+        return resumed
+
+    async def watch(self) -> None:
+        """止まった一括再処理がないか stale_after 秒ごとに確認して引き継ぐ（起動時にも確認する）"""
+        while True:
+            try:
+                await self.resume()
+            except Exception as e:
+                logger.error(f"Failed to resume bulk reprocess runs: {str(e)}")
+            await asyncio.sleep(self.stale_after)
+
+    async def _take_over(self, run: dict) -> bool:
+        """止まった一括再処理だけを引き継ぐ
+
+        updated_at が stale_after 秒以内に更新されていれば他のプロセスが実行中なので引き継がない。
+        引き継ぐ場合も updated_at が取得時のままの場合だけ更新し、同時に引き継ごうとした他のプロセスと重複しない。
+        """
+        if run.get("updated_at") is None:
+            return True
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(run["updated_at"])
+        if age.total_seconds() < self.stale_after:
+            return False
+        claimed = await execute(
+            self._get_client().table("reprocess_runs")
+            .update({"updated_at": datetime.now(timezone.utc).isoformat()})
+            .eq("id", run["id"])
+            .eq("updated_at", run["updated_at"])
+        )
+        return bool(claimed.data)
+
+    async def cancel(self, run_id: str) -> None:
+        """一括再処理を中止する（投入済みのジョブはそのまま処理される）"""
+        task = self._tasks.pop(run_id, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self._update(run_id, {"status": CANCELLED})
+
+    async def stop(self) -> None:
+        """プロセス終了時にタスクを止める（状態は running のまま残り、次回起動時に再開する）"""
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _launch(self, run: dict) -> None:
+        self._tasks[run["id"]] = asyncio.create_task(self._run(run))
+
+    async def _update(self, run_id: str, values: dict) -> bool:
+        """実行中の一括再処理を更新する（状態が running でなくなっていた場合は更新せずに False を返す）"""
+        values = {**values, "updated_at": datetime.now(timezone.utc).isoformat()}
+        updated = await execute(
+            self._get_client().table("reprocess_runs").update(values).eq("id", run_id).eq("status", RUNNING)
+        )
+        return bool(updated.data)
+
+    async def _keep_running(self, run_id: str, values: dict) -> None:
+        """進捗を保存し、他のプロセスで中止されていた場合は止める"""
+        if not await self._update(run_id, values):
+            raise _RunStopped()
+
+    async def _run(self, run: dict) -> None:
+        run_id = run["id"]
+        bulk_filter = BulkFilter.from_dict(run.get("filter"))
+        batch_size = run.get("batch_size") or 100
+        cursor = run.get("cursor")
+        scheduled = run.get("scheduled") or 0
+        skipped = run.get("skipped") or 0
+        try:
+            while True:
+                # 他のプロセスで中止されていないか確認してから次のバッチを取得する
+                await self._keep_running(run_id, {})
+                # 前回のバッチの最後のカルテより後ろを取得する（投入済みのカルテの状態が変わっても位置がずれない）
+                query = bulk_filter.apply(self._get_client().table("medical_records").select(RECORD_COLUMNS))
+                if cursor is not None:
+                    query = query.or_(keyset_filter(decode_cursor(cursor)))
+                rows = (await execute(
+                    query.order("uploaded_at", desc=True).order("id", desc=True).limit(batch_size)
+                )).data or []
+                if not rows:
+                    break
+
+                # 通常のアップロード用の空きを残すため、キューが空くまで待ってから投入する
+                await self._heartbeat_while(run_id, self.wait_for_capacity(len(rows)))
+                count = await self._heartbeat_while(run_id, self.schedule(rows, run_id, bool(run.get("bypass_cache"))))
+                scheduled += count
+                skipped += len(rows) - count
+                cursor = encode_cursor(rows[-1])
+                await self._keep_running(run_id, {"cursor": cursor, "scheduled": scheduled, "skipped": skipped})
+                logger.info(f"Bulk reprocess {run_id}: scheduled {scheduled} records ({skipped} skipped)")
+
+            await self._keep_running(run_id, {"status": COMPLETED})
+            logger.info(f"Bulk reprocess {run_id} finished: {scheduled} records scheduled")
+        except _RunStopped:
+            logger.info(f"Bulk reprocess {run_id} is no longer running, stopping ({scheduled} records scheduled)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Bulk reprocess {run_id} failed: {str(e)}")
+            try:
+                await self._update(run_id, {"status": FAILED, "error": str(e)})
+            except Exception as update_error:
+                logger.error(f"Failed to record bulk reprocess failure: {str(update_error)}")
+        finally:
+            if self._tasks.get(run_id) is asyncio.current_task():
+                del self._tasks[run_id]
+
+    async def _heartbeat_while(self, run_id: str, awaitable: Awaitable):
+        """キューの空きを待つ間なども updated_at を更新し、他のプロセスに止まったとみなされないようにする"""
+        waiting = asyncio.ensure_future(awaitable)
+        try:
+            while True:
+                done, _ = await asyncio.wait({waiting}, timeout=self.stale_after / 3)
+                if done:
+                    return waiting.result()
+                await self._keep_running(run_id, {})
+        finally:
+            waiting.cancel()
+
+    def stats(self) -> dict:
+        return {"running": len(self._tasks)}
@@ -0,0 +1,118 @@
+"""プロセス内で共有する外部サービスのクライアント
+
+Supabase・httpx・Gemini のクライアントを1プロセスにつき1つだけ生成して使い回す。
+接続はキープアライブで再利用されるため、リクエストごとのTLSハンドシェイクやクライアント生成が発生しない。
+Gemini・Supabase のSDKは読み込みに時間がかかるため、モジュールの読み込み時ではなく初回の使用時に import する
+（コールドスタートを短くする。起動後に warm_up で先に読み込んでおくこともできる）。
+"""
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import httpx
+
+if TYPE_CHECKING:
+    from google.generativeai import GenerativeModel
+    from supabase import Client
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """共有クライアントの生成と後始末を管理する"""
+
+    def __init__(
+        self,
+        supabase_url: Optional[str],
+        supabase_key: Optional[str],
+        http_max_connections: int = 20,
+        http_max_keepalive: int = 10,
+        http_timeout: float = 30.0,
+        db_timeout: float = 10.0,
+        gemini_api_key: Optional[str] = None,
+    ):
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.gemini_api_key = gemini_api_key
+        self.limits = httpx.Limits(
+            max_connections=http_max_connections,
+            max_keepalive_connections=http_max_keepalive,
+        )
+        self.http_timeout = http_timeout
+        self.db_timeout = db_timeout
+        self._lock = threading.Lock()
+        self._supabase: Optional["Client"] = None
+        self._http: Optional[httpx.AsyncClient] = None
+        self._models: Dict[str, "GenerativeModel"] = {}
+        self._genai_configured = False
+
+    def supabase(self) -> "Client":
+        """共有のSupabaseクライアントを取得する（初回のみ生成）"""
+        if self._supabase is None:
+            if not self.supabase_url or not self.supabase_key:
+                raise RuntimeError("Supabase credentials not configured")
+            with self._lock:
+                if self._supabase is None:
+                    from supabase import create_client
+                    from supabase.lib.client_options import ClientOptions
+
+                    client = create_client(
+                        self.supabase_url,
+                        self.supabase_key,
+                        options=ClientOptions(postgrest_client_timeout=self.db_timeout),
+                    )
+                    # PostgRESTのセッションを接続数上限付きのものに差し替える
+                    postgrest = client.postgrest
+                    session = postgrest.session
+                    postgrest.session = httpx.Client(
+                        base_url=session.base_url,
+                        headers=session.headers,
+                        timeout=session.timeout,
+                        limits=self.limits,
+                    )
+                    session.close()
+                    self._supabase = client
+                    logger.info("Supabase client created")
+        return self._supabase
+
+    def http(self) -> httpx.AsyncClient:
+        """画像ダウンロード用の共有 httpx.AsyncClient を取得する"""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(limits=self.limits, timeout=self.http_timeout)
+        return self._http
+
+    def model(self, name: str = "gemini-1.5-pro") -> "GenerativeModel":
+        """モデル名ごとに共有の GenerativeModel を取得する（初回はSDKを読み込んでAPIキーを設定する）"""
+        model = self._models.get(name)
+        if model is None:
+            import google.generativeai as genai
+
+            with self._lock:
+                if not self._genai_configured:
+                    genai.configure(api_key=self.gemini_api_key)
+                    self._genai_configured = True
+                model = self._models.get(name)
+                if model is None:
+                    model = genai.GenerativeModel(name)
+                    self._models[name] = model
+        return model
+
+    def warm_up(self, model_names: List[str]) -> None:
+        """SDKの読み込みとクライアントの生成を先に済ませる（起動後にスレッドで実行し、最初のリクエストを待たせない）"""
+        for name in model_names:
+            self.model(name)
+        if self.supabase_url and self.supabase_key:
+            self.supabase()
+
+    async def aclose(self) -> None:
+        """すべてのクライアントの接続を閉じる"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        if self._supabase is not None:
+            try:
+                self._supabase.postgrest.session.close()
+            except Exception as e:
+                logger.warning(f"Supabase client close error: {str(e)}")
+            self._supabase = None
+        self._models.clear()
@@ -0,0 +1,82 @@
+"""複数ページの文書（PDF・TIFF）の分割
+
+FAXで届くマルチページTIFFやスキャンしたPDFをページごとの画像に変換する。
+各ページの変換は前処理用のプロセスプールで並列に実行し、ページ画像には通常の前処理も適用する。
+"""
+import asyncio
+import logging
+from typing import List
+
+from preprocess import ImagePreprocessor, PreprocessResult, PreprocessSettings, encode_pil_image
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # pypdfium2がない環境ではPDFを受け付けない
+    pdfium = None
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_MIME_TYPES = {"application/pdf", "image/tiff"}
+
+
+class UnsupportedDocumentError(Exception):
+    """文書を処理できない（ライブラリがない・壊れている）場合に送出される例外"""
+
+
+def count_pages(path: str, mime_type: str) -> int:
+    """文書のページ数を返す（プロセスプールで実行される同期関数）"""
+    if mime_type == "application/pdf":
+        if pdfium is None:
+            raise UnsupportedDocumentError("PDF support requires pypdfium2")
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    if mime_type == "image/tiff":
+        if Image is None:
+            raise UnsupportedDocumentError("TIFF support requires Pillow")
+        with Image.open(path) as image:
+            return getattr(image, "n_frames", 1)
+    raise UnsupportedDocumentError(f"Unsupported document type: {mime_type}")
+
+
+def render_page(path: str, mime_type: str, index: int, dpi: int, settings: PreprocessSettings) -> PreprocessResult:
+    """1ページを画像に変換して前処理する（プロセスプールで実行される同期関数）"""
+    if mime_type == "application/pdf":
+        pdf = pdfium.PdfDocument(path)
+        try:
+            page = pdf[index]
+            bitmap = page.render(scale=dpi / 72)
+            image = bitmap.to_pil()
+            page.close()
+        finally:
+            pdf.close()
+        return encode_pil_image(image, settings)
+
+    with Image.open(path) as image:
+        image.seek(index)
+        return encode_pil_image(image.copy(), settings)
+
+
+async def split_document(
+    preprocessor: ImagePreprocessor, path: str, mime_type: str, max_pages: int = 50, dpi: int = 200
+) -> List[PreprocessResult]:
+    """文書をページごとの画像に分割する（ページの変換は並列に実行）"""
+    page_count = await preprocessor.run_in_pool(count_pages, path, mime_type)
+    if page_count > max_pages:
+        raise UnsupportedDocumentError(f"Document has {page_count} pages (max {max_pages})")
+
+    pages = await asyncio.gather(*(
+        preprocessor.run_in_pool(render_page, path, mime_type, index, dpi, preprocessor.settings)
+        for index in range(page_count)
+    ))
+    for page in pages:
+        preprocessor.record(page)
+    logger.info(f"Split {mime_type} document into {page_count} pages")
+    return list(pages)
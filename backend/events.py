@@ -0,0 +1,83 @@
+"""カルテの処理状態の通知（プロセス内のpub/sub）
+
+OCRの処理中に発生した状態遷移を、Server-Sent Events で待機しているクライアントに配信する。
+直近の状態はレコードごとに保持し、後から購読したクライアントはDBを参照せずに現在の状態を受け取れる。
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# これ以上状態が変わらない処理状態（ストリームを閉じる）
+TERMINAL_STATUSES = {"completed", "failed"}
+
+
+def is_terminal(event: Optional[dict]) -> bool:
+    return event is not None and event.get("processing_status") in TERMINAL_STATUSES
+
+
+class RecordEventBus:
+    """レコードIDごとに状態遷移を配信するプロセス内のイベントバス"""
+
+    def __init__(self, max_recent: int = 10000, subscriber_queue_size: int = 100):
+        self.max_recent = max_recent
+        self.subscriber_queue_size = subscriber_queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        # レコードごとの直近のイベント（件数上限を超えると古いものから削除）
+        self._recent: "OrderedDict[str, dict]" = OrderedDict()
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, record_id: str, processing_status: str, **fields) -> dict:
+        """状態遷移を購読中のクライアントに配信する"""
+        event = {"record_id": record_id, "processing_status": processing_status, "timestamp": time.time(), **fields}
+        self._recent[record_id] = event
+        self._recent.move_to_end(record_id)
+        while len(self._recent) > self.max_recent:
+            self._recent.popitem(last=False)
+
+        self.published += 1
+        for queue in self._subscribers.get(record_id, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # 受信が追いつかないクライアントには最新の状態だけを残す
+                self.dropped += 1
+                queue.get_nowait()
+                queue.put_nowait(event)
+        return event
+
+    def latest(self, record_id: str) -> Optional[dict]:
+        """直近に配信した状態を返す（このプロセスで処理していない場合はNone）"""
+        return self._recent.get(record_id)
+
+    def subscribe(self, record_id: str) -> asyncio.Queue:
+        """レコードの状態遷移を受け取るキューを登録する（不要になったら unsubscribe する）"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.subscriber_queue_size)
+        self._subscribers.setdefault(record_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, record_id: str, queue: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(record_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[record_id]
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+def format_sse(event: dict, event_type: Optional[str] = None) -> str:
+    """イベントをServer-Sent Eventsの形式に変換する（生成途中のテキストは partial イベント）"""
+    if event_type is None:
+        event_type = "partial" if "partial_text" in event else "status"
+    return f"event: {event_type}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
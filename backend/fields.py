@@ -0,0 +1,230 @@
+"""抽出テキストの構造化（バイタル・日付・処方）
+
+OCRで抽出したテキストから、バイタル（体温・血圧など）、日付（和暦を含む）、処方薬と用量を取り出し、
+単位と表記を正規化した項目にする。結果は extracted_fields テーブルに保存し、参照のたびに
+テキストを解析し直さないようにする。
+パターンはモジュールの読み込み時に一度だけコンパイルし、解析はプロセスプールで実行する。
+"""
+import logging
+import re
+import unicodedata
+from datetime import date
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 項目の種類
+VITAL = "vital"
+DATE = "date"
+MEDICATION = "medication"
+
+# バイタル: (項目名, 正規化した単位, パターン, 有効範囲)
+# パターンは NFKC 正規化後のテキストに適用する（全角数字・記号は半角に、℃ は °C になる）
+# 数値の途中で切らないよう、数値の直後に数字が続く場合は一致させない
+_VITALS = [
+    ("body_temperature", "℃",
+     re.compile(r"(?:体温|(?<![A-Za-z])(?:BT|KT))\s*:?\s*(\d{2}(?:\.\d{1,2})?)(?!\.?\d)\s*(?:°C|度)?"), (30.0, 45.0)),
+    ("pulse", "/min",
+     re.compile(r"(?:脈拍|心拍数?|脈|(?<![A-Za-z])(?:HR|PR))\s*:?\s*(\d{2,3})(?!\.?\d)\s*(?:回/分|/分|/min|bpm)?",
+                re.IGNORECASE), (20.0, 250.0)),
+    ("spo2", "%",
+     re.compile(r"(?:SpO2|サチュレーション|酸素飽和度)\s*:?\s*(\d{2,3})(?!\.?\d)\s*%?", re.IGNORECASE), (50.0, 100.0)),
+    ("respiratory_rate", "/min",
+     re.compile(r"(?:呼吸数|(?<![A-Za-z])RR)\s*:?\s*(\d{1,2})(?!\.?\d)\s*(?:回/分|/分|/min)?"), (4.0, 80.0)),
+    ("height", "cm", re.compile(r"身長\s*:?\s*(\d{2,3}(?:\.\d)?)(?!\.?\d)\s*(?:cm)?"), (30.0, 250.0)),
+    ("weight", "kg", re.compile(r"体重\s*:?\s*(\d{1,3}(?:\.\d{1,2})?)(?!\.?\d)\s*(?:kg)?"), (0.5, 300.0)),
+    ("blood_glucose", "mg/dL",
+     re.compile(r"(?:血糖値?|(?<![A-Za-z])(?:BS|GLU))\s*:?\s*(\d{2,4})(?!\.?\d)\s*(?:mg/dl)?", re.IGNORECASE),
+     (10.0, 1500.0)),
+]
+_BLOOD_PRESSURE = re.compile(
+    r"(?:血圧|(?<![A-Za-z])BP)\s*:?\s*(\d{2,3})(?!\.?\d)\s*/\s*(\d{2,3})(?!\.?\d)\s*(?:mmHg)?", re.IGNORECASE
+)
+_SYSTOLIC_RANGE = (50, 300)
+_DIASTOLIC_RANGE = (20, 200)
+
+# 和暦の元年（西暦）
+ERA_START_YEARS = {
+    "明治": 1868, "大正": 1912, "昭和": 1926, "平成": 1989, "令和": 2019,
+    "M": 1868, "T": 1912, "S": 1926, "H": 1989, "R": 2019,
+}
+_ERA_DATE = re.compile(r"(明治|大正|昭和|平成|令和)\s*(元|\d{1,2})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日")
+_ERA_SHORT_DATE = re.compile(r"(?<![A-Za-z])([MTSHR])\s*(\d{1,2})[./-](\d{1,2})[./-](\d{1,2})(?!\.?\d)")
+_WESTERN_DATE = re.compile(r"(?<!\d)(\d{4})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日")
+_WESTERN_SHORT_DATE = re.compile(r"(?<!\d)(\d{4})[./-](\d{1,2})[./-](\d{1,2})(?!\.?\d)")
+# 日付の直前のラベルから日付の意味を決める（該当しなければ date）
+_DATE_LABELS = [
+    ("birth_date", re.compile(r"(?:生年月日|誕生日)\s*:?\s*$")),
+    ("visit_date", re.compile(r"(?:受診日|診察日|来院日|初診日|初診|再診日)\s*:?\s*$")),
+    ("prescription_date", re.compile(r"(?:処方日|交付日|調剤日)\s*:?\s*$")),
+    ("test_date", re.compile(r"(?:検査日|採血日)\s*:?\s*$")),
+]
+_DATE_LABEL_WINDOW = 12
+
+# 処方: 薬品名（カタカナ + 剤形）、規格、1回量、1日の回数、服用時点
+_MEDICATION = re.compile(
+    r"(?P<name>[ァ-ヺ][ァ-ヺー・]+(?:OD|ER|SR|LA)?"
+    r"(?:錠|カプセル|細粒|顆粒|散|シロップ|テープ|軟膏|クリーム|ゲル|点眼液|吸入|注)?)"
+    r"\s*(?P<strength>\d+(?:\.\d+)?)\s*(?P<unit>mg|μg|mcg|g|mL|ml|単位|IU)(?![A-Za-z/])"
+    r"(?:\s*(?P<quantity>\d+(?:\.\d+)?)\s*(?P<form>錠|カプセル|包|枚|本|T|C)(?![A-Za-z]))?"
+    r"(?:\s*(?:分(?P<divided>\d)|1日(?P<times>\d)回))?"
+    r"(?:\s*(?P<timing>毎食後|毎食前|毎食間|朝夕食後|朝食後|昼食後|夕食後|朝食前|夕食前|食後|食前|食間|就寝前|頓用|頓服))?"
+)
+# 薬品名と誤認しやすいバイタル等のラベル
+_NOT_MEDICATIONS = {"サチュレーション"}
+_UNIT_ALIASES = {"mcg": "μg", "ml": "mL"}
+
+
+def normalize_text(text: str) -> str:
+    """全角英数字・記号を半角にそろえる（位置はこのテキスト上の文字位置）"""
+    return unicodedata.normalize("NFKC", text)
+
+
+def _number(value: str) -> float:
+    return float(value)
+
+
+def _in_range(value: float, bounds) -> bool:
+    return bounds[0] <= value <= bounds[1]
+
+
+def _field(field_type: str, name: str, match, page_index: int, **values) -> dict:
+    return {
+        "page_index": page_index,
+        "field_type": field_type,
+        "name": name,
+        "value_text": values.get("value_text"),
+        "value_numeric": values.get("value_numeric"),
+        "value_date": values.get("value_date"),
+        "unit": values.get("unit"),
+        "attributes": values.get("attributes") or {},
+        "raw_text": match.group(0).strip(),
+        "position": match.start(),
+    }
+
+
+def parse_vitals(text: str, page_index: int = 0) -> List[dict]:
+    fields = []
+    for match in _BLOOD_PRESSURE.finditer(text):
+        systolic, diastolic = int(match.group(1)), int(match.group(2))
+        if not (_in_range(systolic, _SYSTOLIC_RANGE) and _in_range(diastolic, _DIASTOLIC_RANGE)):
+            continue
+        # 上と下は数値で検索できるよう別の項目にする
+        for name, value in (("blood_pressure_systolic", systolic), ("blood_pressure_diastolic", diastolic)):
+            fields.append(_field(
+                VITAL, name, match, page_index,
+                value_text=f"{systolic}/{diastolic}", value_numeric=value, unit="mmHg",
+            ))
+    for name, unit, pattern, bounds in _VITALS:
+        for match in pattern.finditer(text):
+            value = _number(match.group(1))
+            if not _in_range(value, bounds):
+                continue
+            fields.append(_field(VITAL, name, match, page_index, value_text=match.group(1), value_numeric=value, unit=unit))
+    return fields
+
+
+def era_to_year(era: str, year: str) -> int:
+    """和暦の年を西暦にする（元年は1年）"""
+    return ERA_START_YEARS[era] + (1 if year == "元" else int(year)) - 1
+
+
+def _date_name(text: str, start: int) -> str:
+    before = text[max(0, start - _DATE_LABEL_WINDOW):start]
+    for name, pattern in _DATE_LABELS:
+        if pattern.search(before):
+            return name
+    return "date"
+
+
+def parse_dates(text: str, page_index: int = 0) -> List[dict]:
+    fields = []
+    seen = set()
+    patterns = [(_ERA_DATE, True), (_ERA_SHORT_DATE, True), (_WESTERN_DATE, False), (_WESTERN_SHORT_DATE, False)]
+    for pattern, is_era in patterns:
+        for match in pattern.finditer(text):
+            if match.start() in seen:
+                continue
+            if is_era:
+                year = era_to_year(match.group(1), match.group(2))
+                month, day = int(match.group(3)), int(match.group(4))
+            else:
+                year, month, day = int(match.group(1)), int(match.group(2)), int(match.group(3))
+            try:
+                value = date(year, month, day)
+            except ValueError:
+                continue
+            seen.add(match.start())
+            attributes = {"era": match.group(1)} if is_era else {}
+            fields.append(_field(
+                DATE, _date_name(text, match.start()), match, page_index,
+                value_text=value.isoformat(), value_date=value.isoformat(), attributes=attributes,
+            ))
+    return fields
+
+
+def parse_medications(text: str, page_index: int = 0) -> List[dict]:
+    fields = []
+    for match in _MEDICATION.finditer(text):
+        name = match.group("name")
+        if name in _NOT_MEDICATIONS:
+            continue
+        unit = _UNIT_ALIASES.get(match.group("unit"), match.group("unit"))
+        strength = _number(match.group("strength"))
+        attributes = {}
+        if match.group("quantity"):
+            attributes["quantity"] = _number(match.group("quantity"))
+            attributes["form"] = match.group("form")
+        times = match.group("divided") or match.group("times")
+        if times:
+            attributes["times_per_day"] = int(times)
+        if match.group("timing"):
+            attributes["timing"] = match.group("timing")
+        fields.append(_field(
+            MEDICATION, name, match, page_index,
+            value_text=f"{match.group('strength')}{unit}", value_numeric=strength, unit=unit, attributes=attributes,
+        ))
+    return fields
+
+
+def parse_fields(text: str, page_index: int = 0) -> List[dict]:
+    """1ページのテキストから構造化項目を取り出す（テキスト上の出現順）"""
+    text = normalize_text(text or "")
+    fields = parse_vitals(text, page_index) + parse_dates(text, page_index) + parse_medications(text, page_index)
+    fields.sort(key=lambda field: field["position"])
+    return fields
+
+
+def parse_pages(texts: List[str]) -> List[dict]:
+    """ページごとのテキストから構造化項目を取り出す（プロセスプールで実行する）"""
+    fields = []
+    for page_index, text in enumerate(texts):
+        fields.extend(parse_fields(text, page_index))
+    return fields
+
+
+class FieldExtractor:
+    """構造化項目の抽出をプロセスプールで実行し、件数を集計する"""
+
+    def __init__(self, run_in_pool: Callable[..., Awaitable], enabled: bool = True):
+        self.run_in_pool = run_in_pool
+        self.enabled = enabled
+        self.records = 0
+        self.fields = 0
+        self.failed = 0
+
+    async def run(self, texts: List[str]) -> Optional[List[dict]]:
+        """ページごとのテキストから構造化項目を取り出す（無効の場合は None）"""
+        if not self.enabled:
+            return None
+        try:
+            fields = await self.run_in_pool(parse_pages, list(texts))
+        except Exception:
+            self.failed += 1
+            raise
+        self.records += 1
+        self.fields += len(fields)
+        return fields
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "records": self.records, "fields": self.fields, "failed": self.failed}
@@ -0,0 +1,196 @@
+"""アップロード画像の取り込み
+
+アップロードされたファイルをチャンク単位で読み込み、サイズ上限を超えた時点で中止する。
+読み込んだデータは一時ファイルに退避し、キュー待ちのジョブはファイルパスだけを保持するため、
+待機中のジョブ数が増えてもメモリ使用量は増えない。
+非同期の読み込みでは、一時ファイルへの書き込みとハッシュの計算をスレッドプールで行い、イベントループを止めない。
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from typing import BinaryIO, Optional
+
+from blocking_io import run_blocking
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+_spool_dir = os.path.join(tempfile.gettempdir(), "medical-record-uploads")
+
+
+class FileTooLargeError(Exception):
+    """サイズ上限を超えたファイルを読み込もうとした場合に送出される例外"""
+
+
+def configure(spool_dir: Optional[str] = None) -> None:
+    """一時ファイルの保存先を設定する"""
+    global _spool_dir
+    if spool_dir:
+        _spool_dir = spool_dir
+
+
+class SpooledImage:
+    """一時ファイルに退避した画像データ"""
+
+    def __init__(self, path: str, size: int, sha256: str, filename: str = "", content_type: Optional[str] = None):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.filename = filename
+        self.content_type = content_type
+
+    def open(self) -> BinaryIO:
+        """読み込み用にファイルを開く（ストレージへのストリーミングアップロード用）"""
+        return open(self.path, "rb")
+
+    def read_head(self, size: int = 16) -> bytes:
+        """ファイル形式の判定用に先頭バイトを読み込む"""
+        with open(self.path, "rb") as f:
+            return f.read(size)
+
+    def read(self) -> bytes:
+        """画像データ全体を読み込む"""
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def cleanup(self) -> None:
+        """一時ファイルを削除する"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove spooled upload {self.path}: {str(e)}")
+
+
+class SpoolWriter:
+    """チャンクを一時ファイルに書き込みながらサイズとハッシュを計算する"""
+
+    def __init__(self, max_size: int, filename: str = "", content_type: Optional[str] = None):
+        os.makedirs(_spool_dir, exist_ok=True)
+        self.max_size = max_size
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(dir=_spool_dir, suffix=os.path.splitext(filename)[1])
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            self.abort()
+            raise FileTooLargeError(f"File exceeds {self.max_size} bytes")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def finish(self) -> SpooledImage:
+        self._file.close()
+        return SpooledImage(self.path, self.size, self._hash.hexdigest(), self.filename, self.content_type)
+
+    def abort(self) -> None:
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def spool_upload(file, max_size: int, chunk_size: int = CHUNK_SIZE) -> SpooledImage:
+    """UploadFile をチャンク単位で読み込み、一時ファイルに退避する"""
+    # 受信済みのサイズが分かる場合は読み込む前に拒否する
+    if getattr(file, "size", None) is not None and file.size > max_size:
+        raise FileTooLargeError(f"File exceeds {max_size} bytes")
+    writer = await run_blocking(SpoolWriter, max_size, file.filename or "", file.content_type)
+    try:
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            await run_blocking(writer.write, chunk)
+    except FileTooLargeError:
+        raise
+    except BaseException:
+        await run_blocking(writer.abort)
+        raise
+    return await run_blocking(writer.finish)
+
+
+def spool_stream(stream: BinaryIO, max_size: int, filename: str = "", content_type: Optional[str] = None,
+                 chunk_size: int = CHUNK_SIZE) -> SpooledImage:
+    """同期のファイルオブジェクト（ZIP内のファイルなど）を一時ファイルに退避する"""
+    writer = SpoolWriter(max_size, filename, content_type)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+    except FileTooLargeError:
+        raise
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+
+async def spool_response(response, max_size: int, filename: str = "", content_type: Optional[str] = None) -> SpooledImage:
+    """httpx のストリーミングレスポンスを一時ファイルに退避する"""
+    writer = await run_blocking(SpoolWriter, max_size, filename, content_type)
+    try:
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            await run_blocking(writer.write, chunk)
+    except FileTooLargeError:
+        raise
+    except BaseException:
+        await run_blocking(writer.abort)
+        raise
+    return await run_blocking(writer.finish)
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    """同じファイルシステムならハードリンク（データのコピーなし）、異なる場合はコピーする"""
+    try:
+        os.link(source, destination)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def spool_file(source: str, sha256: str, filename: str = "", content_type: Optional[str] = None) -> SpooledImage:
+    """既存のファイル（ローカルキャッシュの画像など）を一時ファイルとして取り出す
+
+    一時ファイルを削除しても元のファイルは残る。
+    """
+    os.makedirs(_spool_dir, exist_ok=True)
+    path = os.path.join(_spool_dir, f"{uuid.uuid4().hex}{os.path.splitext(filename)[1]}")
+    try:
+        link_or_copy(source, path)
+        return SpooledImage(path, os.path.getsize(path), sha256, filename, content_type)
+    except OSError:
+        # コピーの途中で失敗した場合は一時ファイルを残さない
+        SpooledImage(path, 0, sha256).cleanup()
+        raise
+
+
+def cleanup_stale_spool_files(max_age: float = 24 * 3600) -> int:
+    """前回のプロセスから残った古い一時ファイルを削除する"""
+    if not os.path.isdir(_spool_dir):
+        return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(_spool_dir):
+        path = os.path.join(_spool_dir, name)
+        try:
+            if os.path.isfile(path) and now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
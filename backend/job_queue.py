@@ -0,0 +1,514 @@
+"""OCRジョブキュー
+
+アップロード・再処理で発生したOCRジョブをキューに積み、固定数のワーカーで処理する。
+バックエンドはインメモリ（既定）、SQLite（プロセス再起動をまたいで永続化）、
+Supabase（medical_records をキューとして複数のプロセス・ノードでジョブを取り合う）から選択できる。
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional
+
+from blocking_io import execute
+
+if TYPE_CHECKING:
+    from ingest import SpooledImage
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """キューが上限に達している場合に送出される例外"""
+
+
+@dataclass
+class OCRJob:
+    """キューに積まれる1件のOCRジョブ"""
+    record_id: str
+    image_url: str
+    language: str = "ja"
+    # Trueの場合はOCR結果キャッシュを使わずに再抽出する
+    bypass_cache: bool = False
+    # アップロード直後の画像の一時ファイル（永続化はしない。復旧時・再処理時はURLから取得する）
+    image: Optional["SpooledImage"] = field(default=None, repr=False)
+    # 画像のSHA-256（ローカルのキャッシュから画像を取得するために使う）
+    image_sha256: Optional[str] = None
+    # アップロード時に計測した段階ごとの所要時間（永続化はしない）
+    stage_timings: Dict[str, float] = field(default_factory=dict, repr=False)
+    job_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    enqueued_at: float = field(default_factory=time.time)
+
+
+class JobBackend(ABC):
+    """ジョブキューのバックエンドの共通インターフェース"""
+
+    # 他のプロセスと共有するバックエンドか（投入したジョブがこのプロセスで処理されるとは限らない）
+    distributed = False
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+
+    @abstractmethod
+    async def put(self, job: OCRJob) -> None:
+        """ジョブを追加する（満杯の場合は QueueFullError）"""
+
+    @abstractmethod
+    async def get(self) -> OCRJob:
+        """次のジョブを取り出す（空の場合は待機）"""
+
+    @abstractmethod
+    async def ack(self, job: OCRJob) -> None:
+        """ジョブの完了を記録する"""
+
+    @abstractmethod
+    def qsize(self) -> int:
+        """待機中のジョブ数"""
+
+    async def recover(self) -> List[OCRJob]:
+        """前回のプロセスで未完了だったジョブを返す"""
+        return []
+
+    async def depth(self) -> int:
+        """処理を待っているジョブ数（共有のバックエンドでは全プロセスの合計）"""
+        return self.qsize()
+
+    async def close(self) -> None:
+        """バックエンドの後始末"""
+
+    def is_full(self) -> bool:
+        return self.maxsize > 0 and self.qsize() >= self.maxsize
+
+    def stats(self) -> dict:
+        return {}
+
+
+class InMemoryJobBackend(JobBackend):
+    """asyncio.Queue によるインメモリのバックエンド"""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    async def put(self, job: OCRJob) -> None:
+        if self.is_full():
+            raise QueueFullError(f"OCR queue is full ({self.maxsize} jobs)")
+        self._queue.put_nowait(job)
+
+    async def get(self) -> OCRJob:
+        return await self._queue.get()
+
+    async def ack(self, job: OCRJob) -> None:
+        return None
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+class SQLiteJobBackend(JobBackend):
+    """SQLiteにジョブを記録し、再起動後も未完了ジョブを復旧できるバックエンド"""
+
+    def __init__(self, path: str, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.path = path
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ocr_jobs (
+                  job_id TEXT PRIMARY KEY,
+                  record_id TEXT NOT NULL,
+                  image_url TEXT NOT NULL,
+                  language TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'queued',
+                  enqueued_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            self._conn.commit()
+            return rows
+
+    async def put(self, job: OCRJob) -> None:
+        if self.is_full():
+            raise QueueFullError(f"OCR queue is full ({self.maxsize} jobs)")
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO ocr_jobs (job_id, record_id, image_url, language, status, enqueued_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?)",
+            (job.job_id, job.record_id, job.image_url, job.language, job.enqueued_at),
+        )
+        self._queue.put_nowait(job)
+
+    async def get(self) -> OCRJob:
+        job = await self._queue.get()
+        await asyncio.to_thread(
+            self._execute, "UPDATE ocr_jobs SET status = 'running' WHERE job_id = ?", (job.job_id,)
+        )
+        return job
+
+    async def ack(self, job: OCRJob) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM ocr_jobs WHERE job_id = ?", (job.job_id,))
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def recover(self) -> List[OCRJob]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT job_id, record_id, image_url, language, enqueued_at FROM ocr_jobs ORDER BY enqueued_at",
+        )
+        jobs = [
+            OCRJob(record_id=r[1], image_url=r[2], language=r[3], job_id=r[0], enqueued_at=r[4])
+            for r in rows
+        ]
+        for job in jobs:
+            self._queue.put_nowait(job)
+        if jobs:
+            await asyncio.to_thread(self._execute, "UPDATE ocr_jobs SET status = 'queued'")
+        return jobs
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def default_worker_id() -> str:
+    """ワーカーのプロセスを識別するID（ホスト名:PID:乱数）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class SupabaseJobBackend(JobBackend):
+    """medical_records をキューとして使い、複数のプロセス・ノードのワーカーでジョブを取り合うバックエンド
+
+    pending のカルテを claim_ocr_jobs（FOR UPDATE SKIP LOCKED）で1件ずつ取得し、処理中はリースを
+    定期的に延長する。リースが切れたカルテ（ワーカーが落ちた場合など）は他のワーカーが取得し直す。
+    投入は処理状態の更新だけで、ジョブはどのプロセスのワーカーが処理してもよい。
+    処理中に再処理が投入された場合（ocr_queued_at が取得時より新しい）は、解放時に pending に戻す。
+    待機中のジョブ数（全プロセスの合計）はリースの延長と同じ間隔でDBから数え直し、qsize はその値を返す。
+    """
+
+    distributed = True
+
+    def __init__(self, get_client: Callable, worker_id: Optional[str] = None, lease_seconds: float = 60,
+                 poll_interval: float = 1.0, max_attempts: int = 3, maxsize: int = 0):
+        super().__init__(maxsize)
+        self._get_client = get_client
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        # このプロセスで処理中のジョブ（レコードID → ジョブ）
+        self._active: Dict[str, OCRJob] = {}
+        # 取得時の ocr_queued_at（解放時に、処理中に再処理が投入されたかを判定する）
+        self._claimed_queued_at: Dict[str, str] = {}
+        # 取得時の ocr_attempts（停止時に pending に戻す場合は取得前の回数に戻す）
+        self._claimed_attempts: Dict[str, int] = {}
+        # 直近に数えた待機中のジョブ数
+        self._depth = 0
+        self._heartbeat: Optional[asyncio.Task] = None
+        self.claimed = 0
+        self.reclaimed = 0
+        self.leases_lost = 0
+        self.requeued = 0
+
+    async def put(self, job: OCRJob) -> None:
+        # このプロセスで処理されるとは限らないため、画像の一時ファイルは保持しない
+        # （ワーカーはローカルのキャッシュかストレージから取得する）
+        if job.image is not None:
+            job.image.cleanup()
+            job.image = None
+            # アップロード直後のカルテは pending で登録済みで、オプションも既定値のまま
+            if not job.bypass_cache:
+                self._depth += 1
+                return
+        await execute(self._get_client().table("medical_records").update({
+            "processing_status": "pending",
+            "ocr_bypass_cache": job.bypass_cache,
+            "ocr_attempts": 0,
+            "ocr_queued_at": datetime.fromtimestamp(job.enqueued_at, timezone.utc).isoformat(),
+        }).eq("id", job.record_id))
+        # 次に数え直すまでの間も、投入した分を待機中のジョブ数に含める
+        self._depth += 1
+
+    async def _claim(self) -> Optional[dict]:
+        rows = (await execute(self._get_client().rpc("claim_ocr_jobs", {
+            "p_worker_id": self.worker_id,
+            "p_limit": 1,
+            "p_lease_seconds": int(self.lease_seconds),
+            "p_max_attempts": self.max_attempts,
+        }))).data or []
+        return rows[0] if rows else None
+
+    async def get(self) -> OCRJob:
+        while True:
+            try:
+                row = await self._claim()
+            except Exception as e:
+                logger.error(f"Failed to claim OCR job: {str(e)}")
+                row = None
+            if row is not None:
+                break
+            # 全ワーカーが同時に問い合わせないよう間隔をずらす
+            await asyncio.sleep(self.poll_interval * random.uniform(0.5, 1.5))
+
+        queued_at = row.get("ocr_queued_at")
+        job = OCRJob(
+            record_id=row["id"],
+            image_url=row["original_image_url"],
+            bypass_cache=bool(row.get("ocr_bypass_cache")),
+            image_sha256=row.get("image_sha256"),
+            job_id=f"{row['id']}:{row.get('ocr_attempts', 1)}",
+            enqueued_at=datetime.fromisoformat(queued_at).timestamp() if queued_at else time.time(),
+        )
+        self.claimed += 1
+        if row.get("reclaimed"):
+            self.reclaimed += 1
+            logger.warning(f"Reclaimed OCR job for record {job.record_id} after its lease expired")
+        self._active[job.record_id] = job
+        if queued_at:
+            self._claimed_queued_at[job.record_id] = queued_at
+        self._claimed_attempts[job.record_id] = row.get("ocr_attempts") or 1
+        self._depth = max(0, self._depth - 1)
+        self._start_heartbeat()
+        return job
+
+    async def recover(self) -> List[OCRJob]:
+        # 未完了のカルテはワーカーが直接取得するため、待機中のジョブ数を数えて定期的な更新を始めるだけ
+        await self._refresh_depth()
+        self._start_heartbeat()
+        return []
+
+    def _start_heartbeat(self) -> None:
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._beat())
+
+    async def _beat(self) -> None:
+        """期限の1/3ごとに、待機中のジョブ数を数え直して処理中のジョブのリースを延長する"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self._refresh_depth()
+            if self._active:
+                await self._extend_leases()
+
+    async def _refresh_depth(self) -> None:
+        try:
+            self._depth = await self.depth()
+        except Exception as e:
+            logger.error(f"Failed to count pending OCR jobs: {str(e)}")
+
+    async def _extend_leases(self) -> None:
+        """処理中のジョブのリースを延長する"""
+        record_ids = list(self._active)
+        try:
+            rows = (await execute(self._get_client().rpc("extend_ocr_leases", {
+                "p_worker_id": self.worker_id,
+                "p_ids": record_ids,
+                "p_lease_seconds": int(self.lease_seconds),
+            }))).data or []
+        except Exception as e:
+            logger.error(f"Failed to extend OCR job leases: {str(e)}")
+            return
+        held = {row["id"] for row in rows}
+        for record_id in record_ids:
+            # 延長が間に合わず他のワーカーに取得された（結果の保存は冪等なので処理は続ける）
+            if record_id not in held and self._active.pop(record_id, None) is not None:
+                self._claimed_attempts.pop(record_id, None)
+                self.leases_lost += 1
+                logger.warning(f"Lost the lease on record {record_id}, another worker may process it again")
+
+    async def ack(self, job: OCRJob) -> None:
+        self._active.pop(job.record_id, None)
+        self._claimed_attempts.pop(job.record_id, None)
+        claimed_queued_at = self._claimed_queued_at.pop(job.record_id, None)
+        try:
+            if claimed_queued_at is None:
+                await execute(
+                    self._get_client().table("medical_records")
+                    .update({"claimed_by": None, "lease_expires_at": None})
+                    .eq("id", job.record_id)
+                    .eq("claimed_by", self.worker_id)
+                )
+                return
+            rows = (await execute(self._get_client().rpc("release_ocr_job", {
+                "p_id": job.record_id,
+                "p_worker_id": self.worker_id,
+                "p_claimed_queued_at": claimed_queued_at,
+            }))).data or []
+            if any(row.get("requeued") for row in rows):
+                self.requeued += 1
+                logger.info(f"Record {job.record_id} was reprocessed while being processed, requeued it")
+        except Exception as e:
+            # リースは期限切れで解放される
+            logger.error(f"Failed to release OCR job for record {job.record_id}: {str(e)}")
+
+    def qsize(self) -> int:
+        # 待機中のジョブはDBにあるため、直近に数えた値を返す（メトリクス・振り分け・429の判定に使う）
+        return self._depth
+
+    async def depth(self) -> int:
+        counted = await execute(
+            self._get_client().table("medical_records").select("id", count="exact")
+            .eq("processing_status", "pending").limit(1)
+        )
+        return counted.count or 0
+
+    async def close(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+        if not self._active:
+            return
+        # 停止時に処理中だったジョブは、リースの期限を待たずに他のワーカーが取得できるようにする
+        # （途中で止めただけなので、取得時に数えた試行回数も戻す）
+        by_attempts: Dict[int, List[str]] = {}
+        for record_id in self._active:
+            attempts = max(0, self._claimed_attempts.get(record_id, 1) - 1)
+            by_attempts.setdefault(attempts, []).append(record_id)
+        self._active.clear()
+        self._claimed_queued_at.clear()
+        self._claimed_attempts.clear()
+        for attempts, record_ids in by_attempts.items():
+            try:
+                await execute(
+                    self._get_client().table("medical_records")
+                    .update({
+                        "processing_status": "pending", "claimed_by": None, "lease_expires_at": None,
+                        "ocr_attempts": attempts,
+                    })
+                    .in_("id", record_ids)
+                    .eq("claimed_by", self.worker_id)
+                )
+            except Exception as e:
+                logger.error(f"Failed to release OCR jobs on shutdown: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "active": len(self._active),
+            "claimed": self.claimed,
+            "reclaimed": self.reclaimed,
+            "leases_lost": self.leases_lost,
+            "requeued": self.requeued,
+        }
+
+
+def create_backend(kind: str, maxsize: int = 0, sqlite_path: str = "ocr_jobs.db",
+                   get_client: Optional[Callable] = None, **options) -> JobBackend:
+    """設定値からバックエンドを生成する（supabase の場合は get_client と SupabaseJobBackend の設定を渡す）"""
+    if kind == "memory":
+        return InMemoryJobBackend(maxsize)
+    if kind == "sqlite":
+        return SQLiteJobBackend(sqlite_path, maxsize)
+    if kind == "supabase":
+        return SupabaseJobBackend(get_client, maxsize=maxsize, **options)
+    raise ValueError(f"Unknown job queue backend: {kind}")
+
+
+class JobQueue:
+    """ワーカープールでジョブを処理するキュー"""
+
+    def __init__(self, handler: Callable[[OCRJob], Awaitable[None]], backend: JobBackend, workers: int = 4,
+                 gate: Optional[Callable[[], Awaitable[object]]] = None):
+        self.handler = handler
+        self.backend = backend
+        self.workers = workers
+        # ジョブを取り出す前に待機する処理（レート制限中はジョブをキューに残したまま止める）
+        self.gate = gate
+        self._tasks: List[asyncio.Task] = []
+        # キュー投入済み・処理中のレコード（復旧時の二重投入防止）
+        self._record_ids: Dict[str, OCRJob] = {}
+        self._in_flight = 0
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def is_full(self) -> bool:
+        return self.backend.is_full()
+
+    def has_capacity(self, count: int) -> bool:
+        """count件のジョブを追加できるか"""
+        maxsize = self.backend.maxsize
+        return maxsize <= 0 or self.backend.qsize() + count <= maxsize
+
+    def has_record(self, record_id: str, bypass_cache: bool = False) -> bool:
+        """キュー投入済み・処理中のカルテか（bypass_cache=True の場合はキャッシュを使わないジョブだけを数える）"""
+        job = self._record_ids.get(record_id)
+        return job is not None and (job.bypass_cache or not bypass_cache)
+
+    async def enqueue(self, job: OCRJob) -> OCRJob:
+        """ジョブを投入する（満杯の場合は QueueFullError）"""
+        await self.backend.put(job)
+        # 共有のバックエンドでは他のプロセスが処理するため、このプロセスでは追跡しない
+        if not self.backend.distributed:
+            self._record_ids[job.record_id] = job
+        logger.info(f"Enqueued OCR job {job.job_id} for record {job.record_id} (queued: {self.backend.qsize()})")
+        return job
+
+    async def start(self) -> List[OCRJob]:
+        """ワーカーを起動し、バックエンドに残っていたジョブを復旧する"""
+        recovered = await self.backend.recover()
+        for job in recovered:
+            self._record_ids[job.record_id] = job
+        if recovered:
+            logger.info(f"Recovered {len(recovered)} OCR jobs from backend")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        return recovered
+
+    async def stop(self) -> None:
+        """ワーカーを停止する（処理中のジョブはバックエンドに残り、次回起動時に復旧される）"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.backend.close()
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            if self.gate is not None:
+                await self.gate()
+            job = await self.backend.get()
+            self._in_flight += 1
+            try:
+                await self.handler(job)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"OCR job {job.job_id} failed in worker {index}: {str(e)}")
+            finally:
+                self._in_flight -= 1
+            # キャンセル時はackしない（永続バックエンドでは次回起動時に再実行される）
+            if self._record_ids.get(job.record_id) is job:
+                del self._record_ids[job.record_id]
+            await self.backend.ack(job)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.backend.qsize(),
+            "in_flight": self._in_flight,
+            "max_queue_size": self.backend.maxsize,
+            "processed": self.processed,
+            "failed": self.failed,
+            **self.backend.stats(),
+        }
@@ -1,20 +1,47 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import List, Optional
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from typing import TYPE_CHECKING, List, Optional, Tuple
 import os
 import uuid
-import httpx
+import mimetypes
+import zipfile
 import json
-import base64
 import asyncio
 import logging
-import random
+import tempfile
 import time
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from supabase import create_client, Client
-import google.generativeai as genai
+
+import blocking_io
+from blocking_io import execute, run_blocking
+from blob_cache import BlobCache
+from bulk_reprocess import BulkFilter, BulkReprocessor
+from clients import ClientRegistry
+import ingest
+from ingest import FileTooLargeError, SpooledImage, spool_response, spool_stream, spool_upload
+from preprocess import ImagePreprocessor, PreprocessResult, PreprocessSettings, detect_mime_type
+from documents import DOCUMENT_MIME_TYPES, split_document
+from fields import FieldExtractor
+from ocr_batch import OCRBatcher, image_label, split_batch_output
+from ocr_engines import TESSERACT_MODEL_NAME, EngineRouter, GeminiEngine, OCRResult, TesseractEngine
+from ocr_cache import cache_key, create_cache, image_digest, settings_digest
+from job_queue import JobQueue, OCRJob, QueueFullError, create_backend
+from record_cache import REVALIDATE_COLUMNS, RecordCache, is_current
+from single_flight import SingleFlight
+import metrics
+from metrics import StageTimings, timed
+from streaming import PartialTextFlusher, generate_streaming
+from search import create_search_backend, parse_query
+from pagination import InvalidCursorError, decode_cursor, keyset_filter, next_cursor
+from events import RecordEventBus, format_sse, is_terminal
+from rate_limit import PERMANENT, RATE_LIMITED, RateLimiter, backoff_delay, classify_error
+
+# Gemini・SupabaseのSDKは初回の使用時に読み込む（clients.py）
+if TYPE_CHECKING:
+    from supabase import Client
 
 # 環境変数の読み込み
 load_dotenv()
@@ -26,7 +53,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="医療カルテ文字抽出 API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にOCRワーカーを開始し、未完了のジョブを復旧する"""
+    logger.info(
+        f"Starting (role: {app_role}, job queue: {job_queue_backend}, "
+        f"supabase: {'configured' if supabase_url and supabase_key else 'not configured'})"
+    )
+    warmup = asyncio.create_task(warm_up_clients()) if warmup_on_startup else None
+    ingest.cleanup_stale_spool_files()
+    await job_queue.start()
+    await recover_unfinished_records()
+    # 一括再処理の投入はAPI側のプロセスで行う
+    bulk_watch = asyncio.create_task(watch_bulk_reprocess()) if app_role != "worker" else None
+    yield
+    for task in (warmup, bulk_watch):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await bulk_reprocessor.stop()
+    await job_queue.stop()
+    await clients.aclose()
+    ocr_cache.close()
+    blob_cache.close()
+    preprocessor.shutdown()
+    blocking_io.shutdown()
+
+app = FastAPI(title="医療カルテ文字抽出 API", lifespan=lifespan)
 
 # CORS設定
 app.add_middleware(
@@ -41,79 +94,526 @@ app.add_middleware(
 supabase_url = os.environ.get("SUPABASE_URL")
 supabase_key = os.environ.get("SUPABASE_KEY")
 
-print("PROXY:", os.environ.get("proxy"))
-print("HTTPS_PROXY:", os.environ.get("HTTPS_PROXY"))
-print("HTTP_PROXY:", os.environ.get("HTTP_PROXY"))
-print(f"SUPABASE_URL: {supabase_url}")
-print(f"SUPABASE_KEY: {supabase_key[:10]}..." if supabase_key else "SUPABASE_KEY not set")
-
-# Gemini API設定
+# Gemini API設定（APIキーはモデルの初回使用時に設定する）
 gemini_api_key = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=gemini_api_key)
+# 起動後にSDKの読み込みとクライアントの生成をバックグラウンドで済ませる
+warmup_on_startup = os.environ.get("WARMUP_ON_STARTUP", "true").lower() == "true"
+
+# OCRジョブキュー設定
+ocr_workers = int(os.environ.get("OCR_WORKERS", "4"))
+ocr_queue_max_size = int(os.environ.get("OCR_QUEUE_MAX_SIZE", "100"))
+job_queue_backend = os.environ.get("JOB_QUEUE_BACKEND", "memory")
+job_queue_sqlite_path = os.environ.get("JOB_QUEUE_SQLITE_PATH", "ocr_jobs.db")
+# JOB_QUEUE_BACKEND=supabase の場合のリース（ワーカーが落ちたとみなすまでの秒数）と空きがない場合の問い合わせ間隔
+job_lease_seconds = float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+job_poll_interval = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+job_max_attempts = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+# プロセスの役割（all: API + OCRワーカー、api: APIのみ、worker: OCRワーカーのみ）
+APP_ROLES = ("all", "api", "worker")
+app_role = os.environ.get("APP_ROLE", "all")
+if app_role not in APP_ROLES:
+    raise ValueError(f"Unknown APP_ROLE: {app_role}")
+# APIとワーカーを分ける場合は、プロセス間でジョブを受け渡せるバックエンドが必要
+if app_role != "all" and job_queue_backend != "supabase":
+    raise ValueError(f"APP_ROLE={app_role} requires JOB_QUEUE_BACKEND=supabase")
+
+# バッチアップロード設定
+max_batch_files = int(os.environ.get("MAX_BATCH_FILES", "500"))
+max_batch_archive_size = int(os.environ.get("MAX_BATCH_ARCHIVE_SIZE", str(500 * 1024 * 1024)))
+upload_concurrency = int(os.environ.get("UPLOAD_CONCURRENCY", "8"))
+
+# 複数ページの文書（PDF・TIFF）の設定
+max_document_size = int(os.environ.get("MAX_DOCUMENT_SIZE", str(50 * 1024 * 1024)))
+max_document_pages = int(os.environ.get("MAX_DOCUMENT_PAGES", "50"))
+pdf_render_dpi = int(os.environ.get("PDF_RENDER_DPI", "200"))
+# ページ単位のOCRの同時実行数（プロセス全体）
+page_ocr_semaphore = asyncio.Semaphore(int(os.environ.get("PAGE_OCR_CONCURRENCY", "4")))
+
+# アップロードされた画像を退避する一時ディレクトリ
+ingest.configure(os.environ.get("UPLOAD_SPOOL_DIR"))
+
+# 同期I/O（supabase-py）を実行するスレッドプールのサイズ
+blocking_io.configure(int(os.environ.get("BLOCKING_IO_THREADS", "16")))
+
+# OCR結果キャッシュ設定
+ocr_cache = create_cache(
+    enabled=os.environ.get("OCR_CACHE_ENABLED", "true").lower() == "true",
+    max_entries=int(os.environ.get("OCR_CACHE_MAX_ENTRIES", "1000")),
+    ttl=float(os.environ.get("OCR_CACHE_TTL_SECONDS", str(30 * 24 * 3600))),
+    sqlite_path=os.environ.get("OCR_CACHE_SQLITE_PATH", "ocr_cache.db"),
+    max_bytes=int(os.environ.get("OCR_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+)
+
+# ストレージの画像のローカルキャッシュ（再処理・復旧時にストレージからダウンロードしない）
+blob_cache = BlobCache(
+    os.environ.get("BLOB_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "medical-record-blobs"),
+    max_bytes=int(os.environ.get("BLOB_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),
+    enabled=os.environ.get("BLOB_CACHE_ENABLED", "true").lower() == "true",
+)
+# 画像のハッシュが分からないレコード（以前のレコード）は、ETagでストレージの変更を確認してから使う
+blob_cache_revalidate = os.environ.get("BLOB_CACHE_REVALIDATE", "true").lower() == "true"
+
+# OCR前の画像前処理（プロセスプールで実行）
+preprocessor = ImagePreprocessor(
+    PreprocessSettings(
+        enabled=os.environ.get("PREPROCESS_ENABLED", "true").lower() == "true",
+        max_dimension=int(os.environ.get("PREPROCESS_MAX_DIMENSION", "2048")),
+        grayscale=os.environ.get("PREPROCESS_GRAYSCALE", "true").lower() == "true",
+        autocontrast=os.environ.get("PREPROCESS_AUTOCONTRAST", "true").lower() == "true",
+        output_format=os.environ.get("PREPROCESS_FORMAT", "JPEG"),
+        jpeg_quality=int(os.environ.get("PREPROCESS_JPEG_QUALITY", "85")),
+    ),
+    workers=int(os.environ["PREPROCESS_WORKERS"]) if os.environ.get("PREPROCESS_WORKERS") else None,
+)
+
+# 抽出テキストの構造化（バイタル・日付・処方。前処理と同じプロセスプールで実行）
+field_extractor = FieldExtractor(
+    preprocessor.run_in_pool,
+    enabled=os.environ.get("FIELD_EXTRACTION_ENABLED", "true").lower() == "true",
+)
 
-# Supabaseクライアント作成
-def get_supabase() -> Client:
+# OCR結果のストリーミング（生成途中のテキストをSSEで配信。通知はflush間隔・文字数ごとにまとめる）
+ocr_streaming = os.environ.get("OCR_STREAMING", "true").lower() == "true"
+ocr_stream_flush_interval = float(os.environ.get("OCR_STREAM_FLUSH_INTERVAL", "0.5"))
+ocr_stream_flush_chars = int(os.environ.get("OCR_STREAM_FLUSH_CHARS", "200"))
+
+# 小さい画像を複数まとめた1回のリクエストでOCRする（オプトイン。ストリーミングより優先する）
+ocr_batching = os.environ.get("OCR_BATCHING", "false").lower() == "true"
+ocr_batch_max_images = int(os.environ.get("OCR_BATCH_MAX_IMAGES", "4"))
+ocr_batch_max_wait = float(os.environ.get("OCR_BATCH_MAX_WAIT_SECONDS", "0.5"))
+# 前処理後のサイズがこれ以下の画像だけをまとめる
+ocr_batch_max_image_bytes = int(os.environ.get("OCR_BATCH_MAX_IMAGE_BYTES", str(300 * 1024)))
+
+# OCRエンジンの振り分け（オプトイン。無効の場合は常に OCR_MODEL_NAME で抽出する）
+# 通常は安価な OCR_FAST_MODEL_NAME で抽出し、確信度が OCR_ROUTE_MIN_CONFIDENCE 未満の場合だけ高精度のモデルで抽出し直す
+ocr_routing = os.environ.get("OCR_ROUTING", "false").lower() == "true"
+# ローカルのTesseractをGeminiが使えない間・混雑時に使う（pytesseract と tesseract コマンドが必要）
+ocr_local_engine = os.environ.get("OCR_LOCAL_ENGINE", "false").lower() == "true"
+# 前処理後のサイズがこれを超える画像は最初から高精度のモデルで抽出する（0は無制限）
+ocr_route_large_image_bytes = int(os.environ.get("OCR_ROUTE_LARGE_IMAGE_BYTES", str(1536 * 1024)))
+# キューの待ち件数がこれ以上の間はローカルエンジンで抽出する（0は無効）
+ocr_route_overflow_queue_depth = int(os.environ.get("OCR_ROUTE_OVERFLOW_QUEUE_DEPTH", "50"))
+# Geminiの直近の所要時間がこれを超えている間はローカルエンジンで抽出する（0は無効）
+ocr_route_latency_budget = float(os.environ.get("OCR_ROUTE_LATENCY_BUDGET_SECONDS", "0"))
+ocr_route_min_confidence = float(os.environ.get("OCR_ROUTE_MIN_CONFIDENCE", "0.8"))
+
+# Gemini APIのレート制御（プロセス全体で共有。上限0は無制限）
+rate_limiter = RateLimiter(
+    requests_per_minute=float(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "60")),
+    tokens_per_minute=float(os.environ.get("GEMINI_TOKENS_PER_MINUTE", "0")),
+    cooldown=float(os.environ.get("GEMINI_RATE_LIMIT_COOLDOWN", "30")),
+    max_cooldown=float(os.environ.get("GEMINI_RATE_LIMIT_MAX_COOLDOWN", "300")),
+)
+# 1リクエストあたりの推定トークン数（画像 + プロンプト + 出力。レスポンスの実測値で補正する）
+ocr_estimated_tokens = int(os.environ.get("OCR_ESTIMATED_TOKENS", "2000"))
+
+# 一括再処理（キューで待機中のジョブがこの件数以下の間だけ次のバッチを投入し、通常のアップロード用の空きを残す）
+bulk_reprocess_max_queued = int(os.environ.get("BULK_REPROCESS_MAX_QUEUED", "50"))
+bulk_reprocess_poll_seconds = float(os.environ.get("BULK_REPROCESS_POLL_SECONDS", "1"))
+# 実行中のプロセスがこの秒数以上進捗を更新していない一括再処理は、他のプロセスが引き継ぐ
+bulk_reprocess_stale_seconds = float(os.environ.get("BULK_REPROCESS_STALE_SECONDS", "120"))
+
+# カルテ一覧の1ページあたりの最大件数
+max_records_page_size = int(os.environ.get("MAX_RECORDS_PAGE_SIZE", "100"))
+
+# 完了済みカルテ詳細のキャッシュ（再処理時に無効化）
+record_cache = RecordCache(
+    max_entries=int(os.environ.get("RECORD_CACHE_MAX_ENTRIES", "1000")),
+    ttl=float(os.environ.get("RECORD_CACHE_TTL_SECONDS", "600")),
+    enabled=os.environ.get("RECORD_CACHE_ENABLED", "true").lower() == "true",
+)
+
+# 抽出テキストの全文検索（supabase: 文字とバイグラムのインデックス / memory: インメモリのバイグラム索引）
+search_backend_kind = os.environ.get("SEARCH_BACKEND", "supabase")
+# supabase で出現回数を数えて並べる候補ページの上限（新しい順）
+search_candidate_limit = int(os.environ.get("SEARCH_CANDIDATE_LIMIT", "1000"))
+
+# 処理状態の通知（SSEで待機しているクライアントに配信）
+record_events = RecordEventBus()
+sse_keepalive_seconds = float(os.environ.get("SSE_KEEPALIVE_SECONDS", "15"))
+# 共有のジョブキューで他のプロセスが処理する場合に、DBの処理状態を確認する間隔
+sse_poll_seconds = float(os.environ.get("SSE_POLL_SECONDS", "2"))
+
+# 同時に実行された同じ処理の集約（同じ画像のOCR・同じカルテのジョブ・同じカルテへの再処理リクエスト）
+ocr_flights = SingleFlight()
+record_flights = SingleFlight()
+reprocess_flights = SingleFlight()
+
+# 共有クライアント（接続プール設定）
+clients = ClientRegistry(
+    supabase_url,
+    supabase_key,
+    http_max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", "20")),
+    http_max_keepalive=int(os.environ.get("HTTP_MAX_KEEPALIVE", "10")),
+    http_timeout=float(os.environ.get("HTTP_TIMEOUT", "30")),
+    db_timeout=float(os.environ.get("DB_TIMEOUT", "10")),
+    gemini_api_key=gemini_api_key,
+)
+
+search_backend = create_search_backend(search_backend_kind, clients.supabase, search_candidate_limit)
+
+async def warm_up_clients():
+    """SDKの読み込みとOCRモデル・Supabaseクライアントの生成をスレッドで済ませる（最初のリクエストを待たせない）"""
+    started = time.perf_counter()
+    try:
+        model_names = [OCR_MODEL_NAME]
+        if ocr_router is not None and ocr_router.fast is not None:
+            model_names.append(OCR_FAST_MODEL_NAME)
+        await run_blocking(clients.warm_up, model_names)
+        logger.info(f"Warmed up clients in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        logger.warning(f"Client warm-up failed: {str(e)}")
+
+# Supabaseクライアント取得（プロセス内で共有）
+def get_supabase() -> "Client":
     if not supabase_url or not supabase_key:
         raise HTTPException(status_code=500, detail="Supabase credentials not configured")
     try:
-        return create_client(supabase_url, supabase_key)
+        return clients.supabase()
     except Exception as e:
         logger.error(f"Supabase client creation error: {str(e)}")
         raise HTTPException(status_code=500, detail="Could not connect to database")
 
+async def download_image(image_url: str, image_sha256: Optional[str] = None) -> SpooledImage:
+    """ストレージから画像を取得し、一時ファイルに退避する
+    
+    ローカルのキャッシュにある場合はダウンロードしない。ない場合はストリーミングでダウンロードし、キャッシュに登録する。
+    """
+    filename = os.path.basename(image_url)
+    headers = {}
+    cached = await run_blocking(blob_cache.lookup, image_url, image_sha256)
+    if cached is not None:
+        sha256, etag = cached
+        # ハッシュが一致する画像は内容が同じなので、ストレージに確認せずに使う
+        if image_sha256 is not None or not blob_cache_revalidate or not etag:
+            image = await run_blocking(blob_cache.checkout, sha256, filename)
+            if image is not None:
+                metrics.BLOB_CACHE_LOOKUPS.labels("hit").inc()
+                return image
+        else:
+            headers["If-None-Match"] = etag
+    
+    async with clients.http().stream("GET", image_url, headers=headers) as response:
+        if response.status_code == 304:
+            # 変更がなければキャッシュの画像を使う（確認中に削除された場合はダウンロードし直す）
+            image = await run_blocking(blob_cache.checkout, cached[0], filename)
+            if image is None:
+                return await download_image(image_url, image_sha256)
+            metrics.BLOB_CACHE_LOOKUPS.labels("revalidated").inc()
+            return image
+        if response.status_code != 200:
+            logger.error(f"Failed to download image: {image_url}, status code: {response.status_code}")
+            raise HTTPException(status_code=500, detail="Failed to download image")
+        image = await spool_response(response, max_document_size, filename=filename)
+    metrics.BLOB_CACHE_LOOKUPS.labels("miss").inc()
+    await cache_blob(image, image_url, response.headers.get("etag"))
+    return image
+
+async def cache_blob(image: SpooledImage, image_url: str, etag: Optional[str] = None):
+    """画像をローカルのキャッシュに登録する（失敗しても処理は続ける）"""
+    try:
+        await run_blocking(blob_cache.put, image, image_url, etag)
+    except Exception as e:
+        logger.warning(f"Failed to cache image {image_url}: {str(e)}")
+
+async def run_ocr_job(job: OCRJob):
+    """キューから取り出したOCRジョブを実行する（同じカルテのジョブが実行中の場合はその完了を待つ）"""
+    if record_flights.in_flight(job.record_id):
+        logger.info(f"OCR job for record {job.record_id} is already running, waiting for it")
+        metrics.COALESCED.labels("record").inc()
+    with metrics.JOBS_IN_FLIGHT.track_inprogress():
+        await record_flights.do(job.record_id, lambda: _run_ocr_job(job))
+
+async def _run_ocr_job(job: OCRJob):
+    # 段階ごとの所要時間（アップロード時の計測値を引き継ぐ）
+    timings = StageTimings(job.stage_timings)
+    timings.add(metrics.QUEUE_WAIT, max(0.0, time.time() - job.enqueued_at))
+    
+    # 再処理・復旧したジョブは画像を保持していないためストレージから取得する
+    # 取得・前処理に失敗した場合もカルテをエラー状態にする（ワーカーはエラーをログに出すだけのため）
+    image = job.image
+    job.image = None
+    if image is None:
+        try:
+            with timings.stage(metrics.DOWNLOAD):
+                image = await download_image(job.image_url, job.image_sha256)
+        except Exception as e:
+            logger.error(f"Failed to download image for record {job.record_id}: {str(e)}")
+            metrics.FAILURES.labels("download").inc()
+            await mark_record_failed(job.record_id)
+            return
+    failure = "preprocess"
+    pages = None
+    try:
+        mime_type = detect_mime_type(await run_blocking(image.read_head))
+        if mime_type in DOCUMENT_MIME_TYPES:
+            # PDF・TIFFはページごとの画像に分割し、ページ単位で並列にOCRする
+            failure = "document"
+            with timings.stage(metrics.PREPROCESS):
+                pages = await split_document(preprocessor, image.path, mime_type, max_document_pages, pdf_render_dpi)
+        else:
+            image_bytes = await run_blocking(image.read)
+            # OCR用に縮小・補正した画像を使う（ストレージには元の画像を保存したまま）
+            with timings.stage(metrics.PREPROCESS):
+                processed = await preprocessor.run(image_bytes)
+            del image_bytes
+    except Exception as e:
+        logger.error(f"Failed to read or preprocess image for record {job.record_id}: {str(e)}")
+        metrics.FAILURES.labels(failure).inc()
+        await mark_record_failed(job.record_id)
+        return
+    finally:
+        image.cleanup()
+    if pages is not None:
+        await process_document(
+            job.record_id, job.image_url, pages, language=job.language, use_cache=not job.bypass_cache,
+            timings=timings,
+        )
+        return
+    await process_image(
+        job.record_id, job.image_url, processed.data,
+        language=job.language, use_cache=not job.bypass_cache,
+        image_sha256=image.sha256, mime_type=processed.mime_type, timings=timings,
+    )
+
+job_queue = JobQueue(
+    run_ocr_job,
+    create_backend(
+        job_queue_backend, maxsize=ocr_queue_max_size, sqlite_path=job_queue_sqlite_path,
+        **({
+            "get_client": lambda: clients.supabase(),
+            "lease_seconds": job_lease_seconds,
+            "poll_interval": job_poll_interval,
+            "max_attempts": job_max_attempts,
+        } if job_queue_backend == "supabase" else {}),
+    ),
+    # APIのみのプロセスはジョブを投入するだけで処理しない
+    workers=0 if app_role == "api" else ocr_workers,
+    gate=rate_limiter.wait_until_closed,
+)
+
+# 現在値を都度参照するゲージ
+metrics.QUEUE_DEPTH.set_function(job_queue.backend.qsize)
+metrics.THROTTLED_SECONDS.set_function(lambda: rate_limiter.throttled_seconds)
+metrics.CIRCUIT_OPEN.set_function(lambda: 1 if rate_limiter.breaker.is_open else 0)
+
+async def enqueue_ocr_job(record_id: str, image_url: str, image: Optional[SpooledImage] = None, bypass_cache: bool = False,
+                          timings: Optional[StageTimings] = None, image_sha256: Optional[str] = None):
+    """OCRジョブをキューに投入する（満杯の場合は429を返す）"""
+    try:
+        await job_queue.enqueue(OCRJob(
+            record_id=record_id, image_url=image_url, image=image, bypass_cache=bypass_cache,
+            image_sha256=image_sha256 or (image.sha256 if image is not None else None),
+            stage_timings=timings.durations if timings is not None else {},
+        ))
+    except QueueFullError as e:
+        logger.warning(f"OCR queue is full, rejecting record {record_id}: {str(e)}")
+        raise HTTPException(status_code=429, detail="Too many pending OCR jobs", headers={"Retry-After": "30"})
+    record_events.publish(record_id, "pending")
+
+def ensure_queue_capacity():
+    """キューに空きがなければ、ストレージへのアップロード前に429を返す"""
+    if job_queue.is_full():
+        raise HTTPException(status_code=429, detail="Too many pending OCR jobs", headers={"Retry-After": "30"})
+
+async def recover_unfinished_records():
+    """pending / processing のまま残っているカルテを再度キューに投入する"""
+    # 共有のバックエンドでは、未完了のカルテ・リースの切れたカルテはワーカーが直接取得する
+    if job_queue.backend.distributed:
+        return
+    if not supabase_url or not supabase_key:
+        logger.warning("Supabase credentials not configured, skipping OCR job recovery")
+        return
+    try:
+        supabase = clients.supabase()
+        records = await execute(
+            supabase.table("medical_records")
+            .select("id, original_image_url, image_sha256")
+            .in_("processing_status", ["pending", "processing"])
+            .order("uploaded_at")
+        )
+    except Exception as e:
+        logger.error(f"未完了レコードの取得に失敗しました: {str(e)}")
+        return
+
+    recovered = 0
+    for row in records.data or []:
+        if job_queue.has_record(row["id"]):
+            continue
+        try:
+            await job_queue.enqueue(OCRJob(
+                record_id=row["id"], image_url=row["original_image_url"], image_sha256=row.get("image_sha256"),
+            ))
+            recovered += 1
+        except QueueFullError:
+            logger.warning("OCR queue is full, remaining unfinished records will not be recovered")
+            break
+    logger.info(f"Recovered {recovered} unfinished records into the OCR queue")
+
+async def wait_for_bulk_capacity(count: int):
+    """一括再処理のバッチを投入できる空きがキューにできるまで待つ"""
+    count = min(count, bulk_reprocess_max_queued)
+    while await job_queue.backend.depth() + count > bulk_reprocess_max_queued or not job_queue.has_capacity(count):
+        await asyncio.sleep(bulk_reprocess_poll_seconds)
+
+async def schedule_bulk_reprocess(rows: List[dict], run_id: str, bypass_cache: bool) -> int:
+    """一括再処理のバッチを投入する（状態は1回の更新でまとめて変更する）"""
+    # キュー投入済み・処理中のカルテは重複して投入しない
+    rows = [row for row in rows if not job_queue.has_record(row["id"])]
+    if not rows:
+        return 0
+    await execute(clients.supabase().table("medical_records").update({
+        "processing_status": "pending",
+        "reprocess_run_id": run_id,
+    }).in_("id", [row["id"] for row in rows]))
+    for row in rows:
+        record_cache.invalidate(row["id"])
+        while True:
+            try:
+                await enqueue_ocr_job(
+                    row["id"], row["original_image_url"], bypass_cache=bypass_cache, image_sha256=row.get("image_sha256"),
+                )
+                break
+            except HTTPException:
+                # 通常のアップロードでキューが埋まった場合は空くまで待つ
+                await wait_for_bulk_capacity(1)
+    return len(rows)
+
+bulk_reprocessor = BulkReprocessor(
+    lambda: clients.supabase(), schedule_bulk_reprocess, wait_for_bulk_capacity,
+    stale_after=bulk_reprocess_stale_seconds,
+)
+
+async def watch_bulk_reprocess():
+    """止まったプロセスで実行中だった一括再処理を定期的に確認して再開する"""
+    if not supabase_url or not supabase_key:
+        return
+    await bulk_reprocessor.watch()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(metrics.render_latest(), media_type=metrics.CONTENT_TYPE_LATEST)
+
 @app.get("/api/health")
 async def health_check():
     """ヘルスチェックエンドポイント"""
-    return {"status": "ok", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "ok",
+        "timestamp": datetime.now().isoformat(),
+        "role": app_role,
+        "queue": job_queue.stats(),
+        "ocr_cache": ocr_cache.stats(),
+        "preprocess": preprocessor.stats(),
+        "fields": field_extractor.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "events": record_events.stats(),
+        "record_cache": record_cache.stats(),
+        "blob_cache": blob_cache.stats(),
+        "bulk_reprocess": bulk_reprocessor.stats(),
+        "ocr_batch": {"enabled": ocr_batching, **ocr_batcher.stats()},
+        "ocr_routing": {"enabled": True, **ocr_router.stats()} if ocr_router is not None else {"enabled": False},
+        "single_flight": {
+            "ocr": ocr_flights.stats(),
+            "record": record_flights.stats(),
+            "reprocess": reprocess_flights.stats(),
+        },
+    }
+
+# アップロード可能なファイル
+ALLOWED_IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+ALLOWED_DOCUMENT_EXTENSIONS = [".pdf", ".tif", ".tiff"]  # 複数ページの文書（ページごとにOCR）
+ALLOWED_EXTENSIONS = ALLOWED_IMAGE_EXTENSIONS + ALLOWED_DOCUMENT_EXTENSIONS
+UNSUPPORTED_FILE_MESSAGE = "Only JPG, PNG, PDF and TIFF files are allowed"
+MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+
+def max_upload_size(file_ext: str) -> int:
+    """拡張子ごとのファイルサイズ上限"""
+    return max_document_size if file_ext in ALLOWED_DOCUMENT_EXTENSIONS else MAX_FILE_SIZE
+
+def size_limit_message(file_ext: str) -> str:
+    return f"File size exceeds {max_upload_size(file_ext) // (1024 * 1024)}MB limit"
+STORAGE_BUCKET = "images"
+
+async def upload_to_storage(supabase: "Client", image: SpooledImage, file_ext: str) -> str:
+    """画像をSupabaseのストレージにアップロードし、公開URLを返す"""
+    # 一意のファイル名を生成
+    file_name = f"{uuid.uuid4()}{file_ext}"
+    storage_path = f"medical_records/{file_name}"
+
+    # 一時ファイルから直接送信する（画像全体をメモリに読み込まない）
+    def upload():
+        with image.open() as f:
+            # from_メソッドを使用（fromはPythonの予約語なのでfrom_を使用）
+            return supabase.storage.from_(STORAGE_BUCKET).upload(
+                path=storage_path,
+                file=f,
+                file_options={"content-type": image.content_type}
+            )
+
+    await run_blocking(upload)
+
+    # 画像のURLを取得
+    file_url = supabase.storage.from_(STORAGE_BUCKET).get_public_url(storage_path)
+    logger.info(f"File URL: {file_url}")
+    
+    # 再処理時にダウンロードしないよう、ローカルのキャッシュにも登録する
+    await cache_blob(image, file_url)
+    return file_url
 
 @app.post("/api/upload")
-async def upload_file(file: UploadFile = File(...), supabase: Client = Depends(get_supabase)):
+async def upload_file(file: UploadFile = File(...), supabase: "Client" = Depends(get_supabase)):
     """カルテ画像のアップロード処理"""
     try:
         # ファイル拡張子の確認
         file_ext = os.path.splitext(file.filename)[1].lower()
-        if file_ext not in [".jpg", ".jpeg", ".png"]:
-            raise HTTPException(status_code=400, detail="Only JPG and PNG files are allowed")
-        
-        # ファイルサイズ確認 (10MB以下)
-        contents = await file.read()
-        if len(contents) > 10 * 1024 * 1024:  # 10MB
-            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit")
-        
-        # 一意のファイル名を生成
-        file_name = f"{uuid.uuid4()}{file_ext}"
+        if file_ext not in ALLOWED_EXTENSIONS:
+            raise HTTPException(status_code=400, detail=UNSUPPORTED_FILE_MESSAGE)
         
-        # Supabaseのストレージにアップロード
-        storage_path = f"medical_records/{file_name}"
+        # キューが満杯の場合はストレージへのアップロード前に拒否する
+        ensure_queue_capacity()
+        timings = StageTimings()
 
-        # from_メソッドを使用（fromはPythonの予約語なのでfrom_を使用）
-        bucket_name = "images"
-
-        # ファイルの内容を使用してアップロード
-        upload_result = supabase.storage.from_(bucket_name).upload(
-            path=storage_path,
-            file=contents,
-            file_options={"content-type": file.content_type}
-        )
+        # ファイルサイズ確認 (画像は10MB以下) - チャンク単位で読み込み、上限を超えた時点で中止する
+        try:
+            with timings.stage(metrics.UPLOAD_READ):
+                image = await spool_upload(file, max_upload_size(file_ext))
+        except FileTooLargeError:
+            raise HTTPException(status_code=400, detail=size_limit_message(file_ext))
         
-        # 画像のURLを取得
-        bucket_name = "images"
-        file_url = supabase.storage.from_(bucket_name).get_public_url(storage_path)
-        logger.info(f"File URL: {file_url}")
+        try:
+            # Supabaseのストレージにアップロード
+            with timings.stage(metrics.STORAGE_UPLOAD):
+                file_url = await upload_to_storage(supabase, image, file_ext)
+        except Exception:
+            image.cleanup()
+            raise
         
         # DBに新しいレコードを作成
-        record = supabase.table("medical_records").insert({
-            "original_image_url": file_url,
-            "processing_status": "pending"
-        }).execute()
+        with timings.stage(metrics.DB_INSERT):
+            record = await execute(supabase.table("medical_records").insert({
+                "original_image_url": file_url,
+                "image_sha256": image.sha256,
+                "processing_status": "pending"
+            }))
         
         if not record.data:
+            image.cleanup()
             raise HTTPException(status_code=500, detail="Failed to create record")
         
         record_id = record.data[0]["id"]
         
-        # バックグラウンドでの画像処理を開始
-        asyncio.create_task(process_image(record_id, file_url, contents))
+        # OCRジョブをキューに投入（画像は一時ファイルのままワーカーに渡す）
+        try:
+            await enqueue_ocr_job(record_id, file_url, image, timings=timings)
+        except HTTPException:
+            image.cleanup()
+            # 投入できなかったレコードは再処理できるよう失敗状態にしておく
+            await execute(supabase.table("medical_records").update({
+                "processing_status": "failed"
+            }).eq("id", record_id))
+            raise
         
         return {"record_id": record_id, "status": "processing"}
     
@@ -123,26 +623,198 @@ async def upload_file(file: UploadFile = File(...), supabase: Client = Depends(g
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
-async def process_image(record_id: str, image_url: str, image_bytes: bytes, language="ja", max_retries=5, initial_delay=2):
-    """画像処理と文字抽出を行う非同期関数（リトライ機能付き）"""
-    retries = 0
-    
-    # Supabaseに再接続（非同期タスク内）
-    supabase = create_client(supabase_url, supabase_key)
+def too_many_batch_files() -> HTTPException:
+    return HTTPException(status_code=400, detail=f"Too many files in batch (max {max_batch_files})")
+
+def expand_zip_archive(archive_image: SpooledImage, max_entries: Optional[int] = None) -> List[dict]:
+    """ZIPアーカイブから画像ファイルを一時ファイルに取り出す（同期処理・スレッドプールで実行する）
     
-    # 医療カルテの状態を処理中に更新
+    ファイル数が max_entries を超える場合は、取り出す前に400エラーにする。
+    """
+    entries = []
+    with zipfile.ZipFile(archive_image.path) as archive:
+        members = [
+            info for info in archive.infolist()
+            if not (info.is_dir() or info.filename.startswith("__MACOSX/") or os.path.basename(info.filename).startswith("."))
+        ]
+        if max_entries is not None and len(members) > max_entries:
+            raise too_many_batch_files()
+        for info in members:
+            name = info.filename
+            entry = {"filename": f"{archive_image.filename}/{name}"}
+            file_ext = os.path.splitext(name)[1].lower()
+            if file_ext not in ALLOWED_EXTENSIONS:
+                entry["error"] = UNSUPPORTED_FILE_MESSAGE
+            elif info.file_size > max_upload_size(file_ext):
+                entry["error"] = size_limit_message(file_ext)
+            else:
+                try:
+                    with archive.open(info) as stream:
+                        entry["image"] = spool_stream(
+                            stream, max_upload_size(file_ext), name, mimetypes.guess_type(name)[0]
+                        )
+                except FileTooLargeError:
+                    entry["error"] = size_limit_message(file_ext)
+            entries.append(entry)
+    return entries
+
+async def read_batch_file(file: UploadFile, max_entries: Optional[int] = None) -> List[dict]:
+    """バッチ内の1ファイルを読み込んで検証する（ZIPは展開する。展開後のファイル数の上限は max_entries）"""
+    file_ext = os.path.splitext(file.filename)[1].lower()
+    if file_ext == ".zip":
+        try:
+            archive_image = await spool_upload(file, max_batch_archive_size)
+        except FileTooLargeError:
+            return [{"filename": file.filename, "error": "Zip archive is too large"}]
+        try:
+            return await run_blocking(expand_zip_archive, archive_image, max_entries)
+        except zipfile.BadZipFile:
+            return [{"filename": file.filename, "error": "Invalid zip archive"}]
+        finally:
+            archive_image.cleanup()
+
+    entry = {"filename": file.filename, "timings": StageTimings()}
+    if file_ext not in ALLOWED_EXTENSIONS:
+        entry["error"] = UNSUPPORTED_FILE_MESSAGE
+        return [entry]
     try:
-        supabase.table("medical_records").update({
-            "processing_status": "processing"
-        }).eq("id", record_id).execute()
+        with entry["timings"].stage(metrics.UPLOAD_READ):
+            entry["image"] = await spool_upload(file, max_upload_size(file_ext))
+    except FileTooLargeError:
+        entry["error"] = size_limit_message(file_ext)
+    return [entry]
+
+@app.post("/api/upload/batch")
+async def upload_batch(files: List[UploadFile] = File(...), supabase: "Client" = Depends(get_supabase)):
+    """複数のカルテ画像（またはZIP）をまとめてアップロードする"""
+    entries = []
+    try:
+        batch_id = str(uuid.uuid4())
+        # 上限を超えるバッチは読み込む前に拒否する
+        if len(files) > max_batch_files:
+            raise too_many_batch_files()
+
+        # ファイルの読み込みと検証（一時ファイルに退避し、ZIPは展開する。展開後のファイル数も上限までに制限する）
+        for file in files:
+            if len(entries) >= max_batch_files:
+                raise too_many_batch_files()
+            entries.extend(await read_batch_file(file, max_batch_files - len(entries)))
+
+        accepted = [entry for entry in entries if "error" not in entry]
+        if not accepted:
+            raise HTTPException(status_code=400, detail="No valid image files in batch")
+
+        # キューに全件分の空きがなければストレージへのアップロード前に拒否する
+        if not job_queue.has_capacity(len(accepted)):
+            raise HTTPException(status_code=429, detail="Too many pending OCR jobs", headers={"Retry-After": "30"})
+
+        # ストレージへの並列アップロード（同時実行数を制限）
+        semaphore = asyncio.Semaphore(upload_concurrency)
+
+        async def upload_entry(entry: dict):
+            async with semaphore:
+                try:
+                    file_ext = os.path.splitext(entry["filename"])[1].lower()
+                    with timed(metrics.STORAGE_UPLOAD, entry.get("timings")):
+                        entry["file_url"] = await upload_to_storage(supabase, entry["image"], file_ext)
+                except Exception as e:
+                    logger.error(f"Batch upload error ({entry['filename']}): {str(e)}")
+                    entry["error"] = "Failed to upload file"
+
+        await asyncio.gather(*(upload_entry(entry) for entry in accepted))
+        uploaded = [entry for entry in accepted if "file_url" in entry]
+
+        # DBにレコードを一括作成
+        if uploaded:
+            insert_started = time.perf_counter()
+            records = await execute(supabase.table("medical_records").insert([
+                {
+                    "original_image_url": entry["file_url"], "image_sha256": entry["image"].sha256,
+                    "processing_status": "pending", "batch_id": batch_id,
+                }
+                for entry in uploaded
+            ]))
+            # 一括insertの所要時間はヒストグラムには1回だけ記録し、各レコードの内訳には同じ値を記録する
+            insert_seconds = time.perf_counter() - insert_started
+            metrics.observe(metrics.DB_INSERT, insert_seconds)
+            if not records.data or len(records.data) != len(uploaded):
+                raise HTTPException(status_code=500, detail="Failed to create records")
+            for entry, row in zip(uploaded, records.data):
+                entry["record_id"] = row["id"]
+                if "timings" in entry:
+                    entry["timings"].add(metrics.DB_INSERT, insert_seconds, observe_histogram=False)
+
+        # OCRジョブをキューに投入（画像は一時ファイルのままワーカーに渡す）
+        rejected_ids = []
+        for entry in uploaded:
+            try:
+                await enqueue_ocr_job(entry["record_id"], entry["file_url"], entry["image"], timings=entry.get("timings"))
+                del entry["image"]
+                entry["status"] = "processing"
+            except HTTPException:
+                entry["error"] = "Too many pending OCR jobs"
+                rejected_ids.append(entry["record_id"])
+        if rejected_ids:
+            # 投入できなかったレコードは再処理できるよう失敗状態にしておく
+            await execute(supabase.table("medical_records").update({
+                "processing_status": "failed"
+            }).in_("id", rejected_ids))
+
+        results = [
+            {
+                "filename": entry["filename"],
+                "record_id": entry.get("record_id"),
+                "status": "rejected" if "error" in entry else entry.get("status", "processing"),
+                "error": entry.get("error"),
+            }
+            for entry in entries
+        ]
+
+        logger.info(f"Batch {batch_id}: {len(uploaded) - len(rejected_ids)}/{len(entries)} files queued")
+        return {"batch_id": batch_id, "files": results}
+
     except Exception as e:
-        logger.error(f"処理状態の更新に失敗しました: {str(e)}")
-    
-    while retries <= max_retries:
-        try:
-            # プロンプトの設定
-            if language == "ja":
-                prompt = """
+        logger.error(f"Batch upload error: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+    finally:
+        # キューに渡さなかった一時ファイルを削除する
+        for entry in entries:
+            if "image" in entry:
+                entry["image"].cleanup()
+
+@app.get("/api/upload/batch/{batch_id}")
+async def get_batch(batch_id: str, supabase: "Client" = Depends(get_supabase)):
+    """バッチアップロードの処理状況を取得する"""
+    try:
+        records = await execute(
+            supabase.table("medical_records")
+            .select("id, processing_status, uploaded_at")
+            .eq("batch_id", batch_id)
+        )
+        if not records.data:
+            raise HTTPException(status_code=404, detail="Batch not found")
+
+        counts = {}
+        for row in records.data:
+            counts[row["processing_status"]] = counts.get(row["processing_status"], 0) + 1
+        return {"batch_id": batch_id, "total": len(records.data), "status_counts": counts, "records": records.data}
+
+    except Exception as e:
+        logger.error(f"Error fetching batch: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+# OCR設定（キャッシュキーにも使用する）
+OCR_MODEL_NAME = "gemini-1.5-pro"
+# エンジンの振り分けで使う安価・高速なモデル（空の場合は使わない）
+OCR_FAST_MODEL_NAME = os.environ.get("OCR_FAST_MODEL_NAME", "gemini-1.5-flash")
+
+OCR_PROMPTS = {
+    "ja": """
                 この医療カルテ画像から、実際に書かれているテキストのみを抽出してください。
 
                 重要な指示：
@@ -160,9 +832,8 @@ async def process_image(record_id: str, image_url: str, image_bytes: bytes, lang
                 5. レイアウトをなるべく維持
 
                 例えば、画像に「体温 36.5℃」としか書かれていなければ、余分な見出しや区分けせず「体温 36.5℃」とだけ出力してください。
-                """
-            else:
-                prompt = """
+                """,
+    "en": """
                 Extract ONLY the text that is actually written in this medical record image.
 
                 Important instructions:
@@ -180,90 +851,525 @@ async def process_image(record_id: str, image_url: str, image_bytes: bytes, lang
                 5. Preserve layout as much as possible
 
                 For example, if the image only shows "Temperature 98.6°F", just output "Temperature 98.6°F" without any additional headings or sections.
-                """
-            
-            # Gemini モデルを設定
-            model = genai.GenerativeModel('gemini-1.5-pro')
+                """,
+}
+
+# 生成設定 - OCRに最適化
+OCR_GENERATION_CONFIG = {
+    "max_output_tokens": 8192,
+    "temperature": 0.1,  # 低い温度で創造性を抑え、正確な抽出のみを促進
+    "top_p": 0.95,
+}
+
+# 複数画像をまとめて抽出する場合にプロンプトの後に追加する指示
+OCR_BATCH_INSTRUCTIONS = {
+    "ja": """
+                この後に{count}枚の画像があり、それぞれの直前に「{first}」のようなラベルがあります。
+                画像ごとに、上記の指示に従って抽出したテキストを、その画像のラベルと同じ行の後に出力してください。
+                ラベルの行はそのまま1行で出力し、画像の順番を変えず、すべての画像について出力してください。
+                テキストがない画像はラベルの行だけを出力してください。
+                """,
+    "en": """
+                {count} images follow, each preceded by a label such as "{first}".
+                For each image, output its label on its own line, followed by the text extracted according to the instructions above.
+                Output the label lines exactly as given, keep the image order, and include every image.
+                For an image with no text, output only its label line.
+                """,
+}
+
+async def run_ocr_batch(batch_key: Tuple[str, str], image_parts: List[dict]) -> List[str]:
+    """同じモデル・言語の複数の画像を1回のリクエストで抽出し、画像ごとのテキストに分割する（失敗時は例外）"""
+    model_name, language = batch_key
+    prompt = OCR_PROMPTS["ja"] if language == "ja" else OCR_PROMPTS["en"]
+    instructions = OCR_BATCH_INSTRUCTIONS["ja" if language == "ja" else "en"]
+    contents = [prompt + instructions.format(count=len(image_parts), first=image_label(1))]
+    for n, image_part in enumerate(image_parts, start=1):
+        contents.extend([image_label(n), image_part])
+    
+    estimated_tokens = ocr_estimated_tokens * len(image_parts)
+    await rate_limiter.acquire(estimated_tokens)
+    sent_at = time.monotonic()
+    try:
+        with timed(metrics.GEMINI):
+            response = await clients.model(model_name).generate_content_async(
+                contents, generation_config=OCR_GENERATION_CONFIG
+            )
+            text = response.text
+    except Exception as e:
+        error_class = classify_error(e)
+        metrics.GEMINI_REQUESTS.labels(error_class).inc()
+        if error_class == RATE_LIMITED:
+            rate_limiter.record_rate_limited(sent_at=sent_at)
+        raise
+    metrics.GEMINI_REQUESTS.labels("success").inc()
+    usage = getattr(response, "usage_metadata", None)
+    rate_limiter.record_usage(estimated_tokens, getattr(usage, "total_token_count", None))
+    return split_batch_output(text, len(image_parts))
+
+ocr_batcher = OCRBatcher(run_ocr_batch, max_size=ocr_batch_max_images, max_wait=ocr_batch_max_wait)
+
+def create_ocr_router() -> Optional[EngineRouter]:
+    """OCRエンジンの振り分けを作る（無効の場合は None）"""
+    if not ocr_routing:
+        return None
+    return EngineRouter(
+        primary=GeminiEngine("pro", OCR_MODEL_NAME, run_gemini_engine),
+        fast=GeminiEngine("flash", OCR_FAST_MODEL_NAME, run_gemini_engine) if OCR_FAST_MODEL_NAME else None,
+        local=TesseractEngine(preprocessor.run_in_pool) if ocr_local_engine else None,
+        large_image_bytes=ocr_route_large_image_bytes,
+        overflow_queue_depth=ocr_route_overflow_queue_depth,
+        latency_budget=ocr_route_latency_budget,
+        min_confidence=ocr_route_min_confidence,
+        # 認証エラーや不正なリクエストはローカルエンジンで代替しない
+        can_fall_back=lambda error: classify_error(error) != PERMANENT,
+        lookup=lookup_cached_ocr,
+    )
+
+def ocr_routing_settings() -> dict:
+    """OCRバージョンに含める振り分けの設定"""
+    return {
+        "engines": ocr_router.stats()["engines"],
+        "fast_model": OCR_FAST_MODEL_NAME,
+        "min_confidence": ocr_route_min_confidence,
+    }
+
+def ocr_cache_key(image_sha256: str, language: str, model_name: str = OCR_MODEL_NAME) -> str:
+    """OCR結果キャッシュのキー（画像ハッシュ + プロンプト・モデル・生成設定・前処理設定）"""
+    prompt = OCR_PROMPTS["ja"] if language == "ja" else OCR_PROMPTS["en"]
+    return cache_key(
+        image_sha256, prompt, model_name, language, OCR_GENERATION_CONFIG,
+        extra={"preprocess": preprocessor.settings.as_dict()},
+    )
+
+def current_ocr_version(language: str = "ja") -> str:
+    """OCR設定のバージョン（モデル名 + プロンプト・生成設定・前処理設定のハッシュ）。一括再処理の条件に使う
+    
+    エンジンを振り分ける場合はページごとにエンジンが異なるため、振り分けの設定をハッシュに含める。
+    """
+    prompt = OCR_PROMPTS["ja"] if language == "ja" else OCR_PROMPTS["en"]
+    extra = {"preprocess": preprocessor.settings.as_dict()}
+    if ocr_router is not None:
+        extra["routing"] = ocr_routing_settings()
+    digest = settings_digest(prompt, OCR_MODEL_NAME, language, OCR_GENERATION_CONFIG, extra=extra)
+    return f"{OCR_MODEL_NAME}:{digest[:12]}"
+
+def record_ocr_version(language: str, engines: List[str]) -> str:
+    """カルテに記録するOCRバージョン
+    
+    ローカルエンジンで抽出したページがある場合は現在のバージョンと一致させず、outdated の一括再処理の対象にする。
+    """
+    version = current_ocr_version(language)
+    if TESSERACT_MODEL_NAME in engines:
+        return f"{version}+{TESSERACT_MODEL_NAME}"
+    return version
+
+async def extract_text(image_bytes: bytes, language="ja", max_retries=5, initial_delay=2, use_cache=True, image_sha256=None, mime_type=None, label="", on_partial=None, timings=None, engines=None):
+    """1枚の画像からテキストを抽出する（リトライ機能・結果キャッシュ付き）
+    
+    on_partial を指定し、ストリーミングが有効な場合は生成途中のテキストをまとめて通知する。
+    timings を指定した場合はGemini APIの所要時間（リトライ分を含む）をレコードの内訳に加える。
+    同じ画像のOCRが実行中の場合はGemini APIを呼ばずにその結果（エラーを含む）を共有する。
+    その場合、生成途中のテキストは先に実行した側にだけ通知される。
+    エンジンの振り分けが有効な場合は、画像ごとに選んだエンジンで抽出する（キャッシュはモデルごと）。
+    engines を指定した場合は抽出したモデル名を追加する（抽出データに記録する）。
+    """
+    image_sha256 = image_sha256 or image_digest(image_bytes)
+    if ocr_router is not None:
+        # 振り分けの結果（エスカレーションを含む）ごと共有する
+        flight_key = ("routed", image_sha256, language, use_cache)
+        run = lambda: extract_text_routed(
+            image_bytes, language, max_retries=max_retries, initial_delay=initial_delay, use_cache=use_cache,
+            image_sha256=image_sha256, mime_type=mime_type, label=label, on_partial=on_partial, timings=timings,
+        )
+    else:
+        # 画像と設定が同じなら抽出結果も同じなので、キャッシュを利用する
+        key = ocr_cache_key(image_sha256, language)
+        # キャッシュを使わない再抽出は、キャッシュを使う実行中のOCRとは共有しない
+        flight_key = (key, use_cache)
+        run = lambda: _extract_text(
+            key, image_bytes, language, max_retries, initial_delay, use_cache, mime_type, label, on_partial, timings,
+        )
+    if ocr_flights.in_flight(flight_key):
+        logger.info(f"OCR for the same image is already running, sharing its result ({label})")
+        metrics.COALESCED.labels("ocr").inc()
+    result = await ocr_flights.do(flight_key, run)
+    if ocr_router is None:
+        text, model_name = result, OCR_MODEL_NAME
+    else:
+        text, model_name = result.text, result.model_name
+    if engines is not None:
+        engines.append(model_name)
+    return text
+
+async def extract_text_routed(image_bytes: bytes, language: str = "ja", **options) -> OCRResult:
+    """画像サイズ・キューの待ち件数・直近の所要時間からエンジンを選んで抽出する"""
+    result = await ocr_router.extract(
+        image_bytes, language,
+        queue_depth=job_queue.backend.qsize(),
+        # 429で全体が止まっている間はGeminiの代わりにローカルエンジンを使う
+        offline=rate_limiter.breaker.is_open,
+        **options,
+    )
+    route = "cached" if result.cached else "escalated" if result.escalated_from else "first"
+    metrics.OCR_ENGINE_RESULTS.labels(result.engine, route).inc()
+    logger.info(
+        f"OCR by {result.engine} (confidence {result.confidence:.2f}"
+        + (f", from {result.escalated_from}" if result.escalated_from else "")
+        + f") for {options.get('label', '')}"
+    )
+    return result
+
+async def lookup_cached_ocr(model_name: str, image_bytes: bytes, language: str, image_sha256=None, use_cache=True, **options) -> Optional[str]:
+    """振り分けの前に、モデルのキャッシュ済みの抽出結果を探す"""
+    if not use_cache:
+        return None
+    text = await ocr_cache.get(ocr_cache_key(image_sha256 or image_digest(image_bytes), language, model_name))
+    if text is not None:
+        metrics.CACHE_LOOKUPS.labels("hit").inc()
+    return text
+
+async def run_gemini_engine(model_name: str, image_bytes: bytes, language: str, image_sha256=None, use_cache=True, max_retries=5, initial_delay=2, mime_type=None, label="", on_partial=None, timings=None, signals=None) -> str:
+    """振り分けで選ばれたGeminiのモデルで抽出する（キャッシュはモデルごと）"""
+    key = ocr_cache_key(image_sha256 or image_digest(image_bytes), language, model_name)
+    return await _extract_text(
+        key, image_bytes, language, max_retries, initial_delay, use_cache, mime_type, label, on_partial, timings,
+        model_name=model_name, signals=signals,
+    )
+
+def response_signals(response) -> dict:
+    """確信度の推定に使うレスポンスの情報（生成の終了理由・トークンの平均対数確率）"""
+    candidates = getattr(response, "candidates", None)
+    if not isinstance(candidates, (list, tuple)) or not candidates:
+        return {}
+    candidate = candidates[0]
+    finish_reason = getattr(candidate, "finish_reason", None)
+    avg_logprobs = getattr(candidate, "avg_logprobs", None)
+    return {
+        "finish_reason": getattr(finish_reason, "name", finish_reason),
+        "avg_logprobs": avg_logprobs if isinstance(avg_logprobs, (int, float)) else None,
+    }
+
+async def _extract_text(key, image_bytes, language, max_retries, initial_delay, use_cache, mime_type, label, on_partial, timings, model_name=OCR_MODEL_NAME, signals=None):
+    retries = 0
+    
+    # プロンプトの設定
+    prompt = OCR_PROMPTS["ja"] if language == "ja" else OCR_PROMPTS["en"]
+    
+    # 画像をmimeタイプ付きで準備（リトライごとに作り直さない）
+    # Base64文字列にはせずバイト列のまま渡す（SDK内部でデコードし直すため不要なコピーになる）
+    image_part = {
+        "mime_type": mime_type or detect_mime_type(image_bytes),
+        "data": image_bytes
+    }
+    
+    # 共有のGeminiモデルを使用
+    model = clients.model(model_name)
+    
+    # 小さい画像は他の画像とまとめて抽出する（まとめられなかった場合は1枚ずつ抽出する）
+    batch_eligible = ocr_batching and len(image_bytes) <= ocr_batch_max_image_bytes
+    
+    while True:
+        # 429を受けた場合に、同じ制限で失敗した他のリクエストと区別するための送信時刻
+        sent_at = None
+        try:
+            extracted_text = await ocr_cache.get(key) if use_cache else None
+            if use_cache:
+                metrics.CACHE_LOOKUPS.labels("hit" if extracted_text is not None else "miss").inc()
+            if extracted_text is not None:
+                logger.info(f"OCR cache hit for {label}")
+                return extracted_text
             
-            # 画像をmimeタイプとBase64で準備
-            image_part = {
-                "mime_type": "image/jpeg",
-                "data": base64.b64encode(image_bytes).decode('utf-8')
-            }
+            if batch_eligible:
+                batch_eligible = False
+                # まとめたリクエストの所要時間をレコードの内訳に記録する（ヒストグラムにはリクエストごとに記録済み）
+                batch_started = time.perf_counter()
+                extracted_text = await ocr_batcher.submit((model_name, language), image_part)
+                if timings is not None:
+                    timings.add(metrics.GEMINI, time.perf_counter() - batch_started, observe_histogram=False)
+                metrics.BATCHED_IMAGES.labels("batched" if extracted_text is not None else "single").inc()
+                if extracted_text is not None:
+                    await ocr_cache.put(key, extracted_text)
+                    return extracted_text
             
-            # 生成設定 - OCRに最適化
-            generation_config = {
-                "max_output_tokens": 8192,
-                "temperature": 0.1,  # 低い温度で創造性を抑え、正確な抽出のみを促進
-                "top_p": 0.95,
-            }
+            # プロセス全体のレート制限を待つ（429を受けている間は全ワーカーがここで止まる）
+            await rate_limiter.acquire(ocr_estimated_tokens)
+            sent_at = time.monotonic()
             
             # モデルにコンテンツを送信（画像とプロンプト）
-            response = model.generate_content([prompt, image_part], generation_config=generation_config)
+            with timed(metrics.GEMINI, timings):
+                if on_partial is not None and ocr_streaming:
+                    # 生成途中のテキストを一定間隔ごとに通知する（リトライ時は最初から）
+                    flusher = PartialTextFlusher(on_partial, ocr_stream_flush_interval, ocr_stream_flush_chars)
+                    extracted_text, response = await generate_streaming(
+                        model, [prompt, image_part], OCR_GENERATION_CONFIG, flusher
+                    )
+                else:
+                    response = await model.generate_content_async([prompt, image_part], generation_config=OCR_GENERATION_CONFIG)
+                    # テキスト抽出結果の取得
+                    extracted_text = response.text
+            metrics.GEMINI_REQUESTS.labels("success").inc()
+            usage = getattr(response, "usage_metadata", None)
+            rate_limiter.record_usage(ocr_estimated_tokens, getattr(usage, "total_token_count", None))
+            if signals is not None:
+                signals.update(response_signals(response))
             
-            # テキスト抽出結果の取得
-            extracted_text = response.text
-            
-            # DBに抽出データを保存
-            supabase.table("extracted_data").insert({
-                "record_id": record_id,
-                "extracted_text": extracted_text,
-            }).execute()
-            
-            # 医療カルテの状態を更新
-            supabase.table("medical_records").update({
-                "processing_status": "completed"
-            }).eq("id", record_id).execute()
-            
-            logger.info(f"Processed record {record_id} successfully")
-            return
+            await ocr_cache.put(key, extracted_text)
+            return extracted_text
             
         except Exception as e:
             retries += 1
             error_message = str(e)
+            error_class = classify_error(e)
+            metrics.GEMINI_REQUESTS.labels(error_class).inc()
+            
+            # 認証エラーや不正なリクエストはリトライしても成功しない
+            if error_class == PERMANENT:
+                logger.error(f"リトライできないエラーです ({label}): {error_message}")
+                raise
             
             if retries > max_retries:
                 logger.error(f"最大リトライ回数({max_retries})に達しました。処理を中止します。エラー: {error_message}")
-                # エラー状態に更新
-                try:
-                    supabase.table("medical_records").update({
-                        "processing_status": "failed"
-                    }).eq("id", record_id).execute()
-                except Exception as update_error:
-                    logger.error(f"エラー状態への更新に失敗しました: {str(update_error)}")
-                return
+                raise
             
             # エラーメッセージを出力
-            logger.warning(f"画像処理中にエラー発生: {error_message}。{retries}/{max_retries}回目のリトライ")
+            logger.warning(f"画像処理中にエラー発生 ({label}): {error_message}。{retries}/{max_retries}回目のリトライ")
+            metrics.RETRIES.labels(error_class).inc()
+            
+            if error_class == RATE_LIMITED:
+                # 429・クォータ超過はブレーカーを開き、全ワーカーをまとめて待機させる
+                rate_limiter.record_rate_limited(sent_at=sent_at)
+                continue
             
             # エクスポネンシャルバックオフ（ジッター付き）
-            delay = initial_delay * (2 ** (retries - 1)) * (0.5 + random.random())
+            delay = backoff_delay(retries, initial_delay)
             logger.info(f"{delay:.2f}秒後にリトライします。")
             await asyncio.sleep(delay)  # asyncioを使用して非同期に待機
+
+# 振り分けで使うGeminiのエンジンは run_gemini_engine を使うため、定義の後で作る
+ocr_router = create_ocr_router()
+
+# 抽出データはカルテのページごとに1行（一意インデックスで上書き）
+EXTRACTED_DATA_CONFLICT_KEY = "record_id,page_index"
+
+async def mark_record_failed(record_id: str):
+    """カルテをエラー状態に更新する"""
+    try:
+        await execute(clients.supabase().table("medical_records").update({
+            "processing_status": "failed"
+        }).eq("id", record_id))
+    except Exception as update_error:
+        logger.error(f"エラー状態への更新に失敗しました: {str(update_error)}")
+    record_events.publish(record_id, "failed")
+
+async def save_extracted_fields(supabase: "Client", record_id: str, texts: List[str], timings: StageTimings):
+    """抽出テキストから構造化項目を取り出して保存する（失敗してもOCR結果の保存は続ける）"""
+    try:
+        with timed(metrics.FIELDS, timings):
+            fields = await field_extractor.run(texts)
+            if fields is None:
+                return
+            # 再処理の場合は前回の項目をすべて置き換える
+            await execute(supabase.table("extracted_fields").delete().eq("record_id", record_id))
+            if fields:
+                await execute(supabase.table("extracted_fields").insert(
+                    [{"record_id": record_id, **field} for field in fields]
+                ))
+    except Exception as e:
+        logger.warning(f"Saving structured fields failed for record {record_id}: {str(e)}")
+
+async def process_image(record_id: str, image_url: str, image_bytes: bytes, language="ja", max_retries=5, initial_delay=2, use_cache=True, image_sha256=None, mime_type=None, timings=None):
+    """画像処理と文字抽出を行う非同期関数（リトライ機能・結果キャッシュ付き）"""
+    timings = timings or StageTimings()
+    # 共有のSupabaseクライアントを使用
+    supabase = clients.supabase()
+    
+    # 医療カルテの状態を処理中に更新
+    try:
+        await execute(supabase.table("medical_records").update({
+            "processing_status": "processing"
+        }).eq("id", record_id))
+    except Exception as e:
+        logger.error(f"処理状態の更新に失敗しました: {str(e)}")
+    record_events.publish(record_id, "processing")
+    
+    engines: List[str] = []
+    try:
+        extracted_text = await extract_text(
+            image_bytes, language, max_retries, initial_delay,
+            use_cache=use_cache, image_sha256=image_sha256, mime_type=mime_type, label=f"record {record_id}",
+            on_partial=lambda text: record_events.publish(record_id, "processing", partial_text=text),
+            timings=timings, engines=engines,
+        )
+    except Exception as e:
+        logger.error(f"Processing failed for record {record_id}: {str(e)}")
+        metrics.FAILURES.labels(classify_error(e)).inc()
+        await mark_record_failed(record_id)
+        return
+    
+    await save_extracted_fields(supabase, record_id, [extracted_text], timings)
+    
+    try:
+        with timed(metrics.DB_WRITE, timings):
+            # DBに抽出データを保存（段階ごとの所要時間も一緒に保存する）
+            # 再処理・重複実行の場合は前回の結果を上書きする
+            await execute(supabase.table("extracted_data").upsert({
+                "record_id": record_id,
+                "page_index": 0,
+                "extracted_text": extracted_text,
+                "ocr_engine": engines[0] if engines else None,
+                "stage_timings": timings.as_dict(),
+                "extracted_at": datetime.now(timezone.utc).isoformat(),
+            }, on_conflict=EXTRACTED_DATA_CONFLICT_KEY))
+            await search_backend.index_pages(record_id, [extracted_text])
             
-            # APIキーに関連するエラーの場合は長めに待機
-            if any(keyword in error_message.lower() for keyword in ["key", "quota", "permission", "limit", "api"]):
-                extra_delay = 60  # 1分追加で待機
-                logger.warning(f"APIキー関連のエラーが疑われます。追加で{extra_delay}秒待機します。")
-                await asyncio.sleep(extra_delay)  # asyncioを使用して非同期に待機
+            # 医療カルテの状態を更新（処理したOCR設定のバージョンも記録する）
+            await execute(supabase.table("medical_records").update({
+                "processing_status": "completed",
+                "ocr_version": record_ocr_version(language, engines),
+            }).eq("id", record_id))
+        record_events.publish(record_id, "completed")
+        metrics.RECORDS_PROCESSED.inc()
+        
+        logger.info(f"Processed record {record_id} successfully ({timings.as_dict()})")
+    
+    except Exception as e:
+        logger.error(f"Saving extracted data failed for record {record_id}: {str(e)}")
+        metrics.FAILURES.labels("db").inc()
+        await mark_record_failed(record_id)
+
+async def process_document(record_id: str, image_url: str, pages: List[PreprocessResult], language="ja", use_cache=True, timings=None):
+    """複数ページの文書をページごとに並列でOCRし、ページ番号付きで保存する"""
+    timings = timings or StageTimings()
+    supabase = clients.supabase()
+    
+    # 医療カルテの状態を処理中に更新
+    try:
+        await execute(supabase.table("medical_records").update({
+            "processing_status": "processing",
+            "page_count": len(pages),
+        }).eq("id", record_id))
+    except Exception as e:
+        logger.error(f"処理状態の更新に失敗しました: {str(e)}")
+    record_events.publish(record_id, "processing", page_count=len(pages), pages_completed=0)
+    
+    pages_completed = 0
+    # ページごとに抽出したモデル名
+    page_engines: List[List[str]] = [[] for _ in pages]
+    
+    async def ocr_page(index: int, page: PreprocessResult) -> str:
+        nonlocal pages_completed
+        # ページ単位のOCRはプロセス全体で同時実行数を制限する
+        async with page_ocr_semaphore:
+            text = await extract_text(
+                page.data, language, use_cache=use_cache, mime_type=page.mime_type,
+                label=f"record {record_id} page {index + 1}/{len(pages)}", engines=page_engines[index],
+            )
+        # ページの進捗も通知する
+        pages_completed += 1
+        record_events.publish(record_id, "processing", page_count=len(pages), pages_completed=pages_completed)
+        return text
+    
+    # ページは並列に処理するため、レコードの内訳には全ページの経過時間を記録する
+    # （ヒストグラムにはページごとのAPI呼び出しが記録済み）
+    ocr_started = time.perf_counter()
+    results = await asyncio.gather(*(ocr_page(i, page) for i, page in enumerate(pages)), return_exceptions=True)
+    timings.add(metrics.GEMINI, time.perf_counter() - ocr_started, observe_histogram=False)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.error(f"{len(errors)}/{len(pages)} pages failed for record {record_id}: {str(errors[0])}")
+        metrics.FAILURES.labels(classify_error(errors[0])).inc()
+        await mark_record_failed(record_id)
+        return
+    
+    await save_extracted_fields(supabase, record_id, list(results), timings)
+    
+    try:
+        with timed(metrics.DB_WRITE, timings):
+            # ページごとの抽出データを一括で保存（再処理・重複実行の場合は前回の結果を上書きする）
+            stage_timings = timings.as_dict()
+            extracted_at = datetime.now(timezone.utc).isoformat()
+            await execute(supabase.table("extracted_data").upsert([
+                {
+                    "record_id": record_id, "extracted_text": text, "page_index": index,
+                    "ocr_engine": page_engines[index][0] if page_engines[index] else None,
+                    "stage_timings": stage_timings, "extracted_at": extracted_at,
+                }
+                for index, text in enumerate(results)
+            ], on_conflict=EXTRACTED_DATA_CONFLICT_KEY))
+            await search_backend.index_pages(record_id, list(results))
+            
+            # 医療カルテの状態を更新（処理したOCR設定のバージョンも記録する）
+            await execute(supabase.table("medical_records").update({
+                "processing_status": "completed",
+                "ocr_version": record_ocr_version(language, [engine for engines in page_engines for engine in engines]),
+            }).eq("id", record_id))
+        record_events.publish(record_id, "completed", page_count=len(pages), pages_completed=len(pages))
+        metrics.RECORDS_PROCESSED.inc()
+        
+        logger.info(f"Processed {len(pages)}-page document {record_id} successfully ({timings.as_dict()})")
+    
+    except Exception as e:
+        logger.error(f"Saving document pages failed for record {record_id}: {str(e)}")
+        metrics.FAILURES.labels("db").inc()
+        await mark_record_failed(record_id)
+
+def assemble_document_text(extracted_data: List[dict]) -> str:
+    """ページごとの抽出テキストをページ順に連結する"""
+    pages = sorted(extracted_data, key=lambda row: row.get("page_index") or 0)
+    return "\n\n".join(row.get("extracted_text") or "" for row in pages)
+
+async def revalidate_cached_record(supabase: "Client", record_id: str, cached: dict) -> Optional[dict]:
+    """他のプロセスで再処理されていないか処理状態の列だけを確認する（再処理されていれば破棄して None）"""
+    current = await execute(
+        supabase.table("medical_records").select(",".join(REVALIDATE_COLUMNS)).eq("id", record_id)
+    )
+    if current.data and is_current(cached, current.data[0]):
+        return cached
+    record_cache.invalidate(record_id)
+    return None
 
 @app.get("/api/records/{record_id}")
-async def get_record(record_id: str, supabase: Client = Depends(get_supabase)):
+async def get_record(record_id: str, supabase: "Client" = Depends(get_supabase)):
     """特定のカルテレコードと抽出データを取得"""
     try:
-        # 医療カルテレコードを取得
-        record = supabase.table("medical_records").select("*").eq("id", record_id).execute()
+        # 処理済みのカルテは再処理されるまで変わらないため、キャッシュから返す
+        cached = record_cache.get(record_id)
+        if cached is not None and job_queue.backend.distributed:
+            cached = await revalidate_cached_record(supabase, record_id, cached)
+        if cached is not None:
+            return cached
+        generation = record_cache.generation()
+        
+        # 医療カルテレコードと抽出データ・構造化項目を1回の問い合わせで取得（外部キーで埋め込み）
+        record = await execute(
+            supabase.table("medical_records").select("*, extracted_data(*), extracted_fields(*)").eq("id", record_id)
+        )
         
         if not record.data:
             raise HTTPException(status_code=404, detail="Record not found")
         
-        # 抽出データを取得
-        extracted = supabase.table("extracted_data").select("*").eq("record_id", record_id).execute()
+        # 抽出データはページ順に並べる
+        row = dict(record.data[0])
+        extracted_data = sorted(row.pop("extracted_data", None) or [], key=lambda item: item.get("page_index") or 0)
+        # 構造化項目はページ内の出現順に並べる
+        fields = sorted(
+            row.pop("extracted_fields", None) or [],
+            key=lambda item: (item.get("page_index") or 0, item.get("position") or 0),
+        )
         
-        return {
-            "record": record.data[0],
-            "extracted_data": extracted.data
+        result = {
+            "record": row,
+            "extracted_data": extracted_data,
+            "fields": fields,
         }
+        if (row.get("page_count") or 1) > 1:
+            result["document_text"] = assemble_document_text(extracted_data)
+        # 処理中のカルテは、このプロセスで生成途中のテキストがあれば返す
+        latest = record_events.latest(record_id)
+        if row.get("processing_status") == "processing" and latest and "partial_text" in latest:
+            result["partial_text"] = latest["partial_text"]
+        record_cache.put(record_id, result, generation)
+        return result
     
     except Exception as e:
         logger.error(f"Error fetching record: {str(e)}")
@@ -271,51 +1377,287 @@ async def get_record(record_id: str, supabase: Client = Depends(get_supabase)):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
+async def fetch_record_status(supabase: "Client", record_id: str) -> Optional[dict]:
+    """DBからカルテの処理状態をイベントと同じ形式で取得する（存在しない場合は None）"""
+    record = await execute(
+        supabase.table("medical_records").select("id, processing_status, page_count").eq("id", record_id)
+    )
+    if not record.data:
+        return None
+    return {
+        "record_id": record_id,
+        "processing_status": record.data[0]["processing_status"],
+        "page_count": record.data[0].get("page_count") or 1,
+    }
+
+@app.get("/api/records/{record_id}/events")
+async def stream_record_events(record_id: str, request: Request, supabase: "Client" = Depends(get_supabase)):
+    """カルテの処理状態の変化をServer-Sent Eventsで配信する（完了・エラーで終了）"""
+    # 取得と購読の間に発生した状態遷移を取りこぼさないよう、先に購読する
+    queue = record_events.subscribe(record_id)
+    try:
+        # このプロセスで処理中・処理済みのレコードはDBを参照しない
+        current = record_events.latest(record_id)
+        if current is None:
+            current = await fetch_record_status(supabase, record_id)
+            if current is None:
+                raise HTTPException(status_code=404, detail="Record not found")
+    except Exception as e:
+        record_events.unsubscribe(record_id, queue)
+        logger.error(f"Error fetching record status: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    # ワーカーが別のプロセスの場合、このプロセスにはイベントが届かないためDBの状態を定期的に確認する
+    polling = job_queue.backend.distributed
+    
+    async def event_stream():
+        last = current
+        idle = 0.0
+        try:
+            # 切断時はブラウザが3秒後に再接続する
+            yield "retry: 3000\n\n"
+            yield format_sse(current)
+            if is_terminal(current):
+                return
+            while True:
+                timeout = min(sse_poll_seconds, sse_keepalive_seconds) if polling else sse_keepalive_seconds
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    event = None
+                    if polling:
+                        try:
+                            polled = await fetch_record_status(supabase, record_id)
+                        except Exception as e:
+                            logger.warning(f"Failed to poll record status for {record_id}: {str(e)}")
+                            polled = None
+                        if polled is not None and polled["processing_status"] != last["processing_status"]:
+                            event = polled
+                    if event is None:
+                        idle += timeout
+                        if idle >= sse_keepalive_seconds:
+                            # プロキシにアイドル接続を切られないようにコメント行を送る
+                            idle = 0.0
+                            yield ": keepalive\n\n"
+                        continue
+                idle = 0.0
+                last = event
+                yield format_sse(event)
+                if is_terminal(event):
+                    return
+        finally:
+            record_events.unsubscribe(record_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# 一覧で返す列（一覧画面で使わない列は取得しない）
+RECORD_LIST_COLUMNS = "id, original_image_url, uploaded_at, processing_status, page_count"
+RECORD_STATUSES = ["pending", "processing", "completed", "failed"]
+
 @app.get("/api/records")
-async def get_records(limit: int = 10, offset: int = 0, supabase: Client = Depends(get_supabase)):
-    """カルテレコードのリストを取得"""
+async def get_records(
+    limit: int = 10,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    supabase: "Client" = Depends(get_supabase),
+):
+    """カルテレコードのリストを取得（cursorで次のページ、statusで処理状態を絞り込み）"""
+    # ページサイズはサーバー側で上限をかける
+    limit = max(1, min(limit, max_records_page_size))
+    if status is not None and status not in RECORD_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Invalid status. Allowed: {', '.join(RECORD_STATUSES)}")
+    
     try:
-        records = supabase.table("medical_records") \
-            .select("*") \
-            .order("uploaded_at", desc=True) \
-            .limit(limit) \
-            .offset(offset) \
-            .execute()
+        query = supabase.table("medical_records").select(RECORD_LIST_COLUMNS)
+        if status is not None:
+            query = query.eq("processing_status", status)
+        if cursor is not None:
+            # 前のページの最後の行より後ろだけを取得する（インデックスで直接位置を特定できる）
+            query = query.or_(keyset_filter(decode_cursor(cursor)))
+        query = query.order("uploaded_at", desc=True).order("id", desc=True)
+        
+        # 次のページがあるか判定するため1件多く取得する
+        if cursor is None and offset:
+            # 互換性のため offset も受け付ける（深いページほど遅くなるため cursor を推奨）
+            query = query.range(offset, offset + limit)
+        else:
+            query = query.limit(limit + 1)
+        records = await execute(query)
         
-        return {"records": records.data}
+        return {"records": records.data[:limit], "next_cursor": next_cursor(records.data, limit)}
     
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"Error fetching records: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/search")
+async def search_records(q: str = "", limit: int = 20, offset: int = 0):
+    """抽出テキストを全文検索する（空白区切りの語をすべて含むページを出現回数の多い順に返す）"""
+    terms = parse_query(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query is required")
+    limit = max(1, min(limit, max_records_page_size))
+    offset = max(0, offset)
+    
+    try:
+        # 次のページがあるか判定するため1件多く取得する
+        hits = await search_backend.search(terms, limit + 1, offset)
+    except Exception as e:
+        logger.error(f"Error searching records: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return {
+        "query": q,
+        "terms": terms,
+        "results": [hit.to_dict(terms) for hit in hits[:limit]],
+        "has_more": len(hits) > limit,
+    }
+
+def parse_timestamp(value: Optional[str], name: str) -> Optional[str]:
+    """ISO 8601形式の日時を検証する（タイムゾーンがない場合はUTCとみなす）"""
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}. Use ISO 8601 format")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.isoformat()
+
+# /api/process/{record_id} より先に登録する
+@app.post("/api/process/bulk")
+async def start_bulk_reprocess(
+    status: Optional[str] = None,
+    uploaded_from: Optional[str] = None,
+    uploaded_to: Optional[str] = None,
+    ocr_version: Optional[str] = None,
+    outdated: bool = False,
+    bypass_cache: bool = False,
+    batch_size: int = 100,
+    supabase: "Client" = Depends(get_supabase),
+):
+    """条件に一致するカルテを一括で再処理する（バックグラウンドでバッチごとに投入し、進捗は run_id で取得する）
+    
+    outdated=true の場合は、現在のOCR設定とは異なる設定で処理されたカルテ（未記録を含む）を対象にする。
+    """
+    if status is not None and status not in RECORD_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Invalid status. Allowed: {', '.join(RECORD_STATUSES)}")
+    bulk_filter = BulkFilter(
+        status=status,
+        uploaded_from=parse_timestamp(uploaded_from, "uploaded_from"),
+        uploaded_to=parse_timestamp(uploaded_to, "uploaded_to"),
+        ocr_version=ocr_version,
+        exclude_ocr_version=current_ocr_version() if outdated else None,
+    )
+    try:
+        run = await bulk_reprocessor.start(bulk_filter, bypass_cache=bypass_cache, batch_size=batch_size)
+    except Exception as e:
+        logger.error(f"Error starting bulk reprocess: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"run_id": run["id"], "status": run["status"], "total": run.get("total"), "filter": bulk_filter.to_dict()}
+
+async def count_run_statuses(supabase: "Client", run_id: str) -> dict:
+    """一括再処理で投入したカルテの処理状態ごとの件数"""
+    async def count(status: str) -> int:
+        result = await execute(
+            supabase.table("medical_records").select("id", count="exact")
+            .eq("reprocess_run_id", run_id).eq("processing_status", status).limit(1)
+        )
+        return result.count or 0
+    counts = await asyncio.gather(*(count(status) for status in RECORD_STATUSES))
+    return dict(zip(RECORD_STATUSES, counts))
+
+@app.get("/api/process/bulk/{run_id}")
+async def get_bulk_reprocess(run_id: str, supabase: "Client" = Depends(get_supabase)):
+    """一括再処理の進捗を取得する"""
+    try:
+        runs = await execute(supabase.table("reprocess_runs").select("*").eq("id", run_id))
+        if not runs.data:
+            raise HTTPException(status_code=404, detail="Bulk reprocess run not found")
+        run = runs.data[0]
+        return {**run, "status_counts": await count_run_statuses(supabase, run_id)}
+    
+    except Exception as e:
+        logger.error(f"Error fetching bulk reprocess: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/process/bulk/{run_id}/cancel")
+async def cancel_bulk_reprocess(run_id: str, supabase: "Client" = Depends(get_supabase)):
+    """一括再処理を中止する（投入済みのカルテはそのまま処理される）"""
+    try:
+        runs = await execute(supabase.table("reprocess_runs").select("id, status").eq("id", run_id))
+        if not runs.data:
+            raise HTTPException(status_code=404, detail="Bulk reprocess run not found")
+        if runs.data[0]["status"] != "running":
+            raise HTTPException(status_code=409, detail="Bulk reprocess run is not running")
+        await bulk_reprocessor.cancel(run_id)
+        return {"run_id": run_id, "status": "cancelled"}
+    
+    except Exception as e:
+        logger.error(f"Error cancelling bulk reprocess: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/process/{record_id}")
-async def reprocess_record(record_id: str, supabase: Client = Depends(get_supabase)):
-    """特定のカルテを再処理する"""
+async def reprocess_record(record_id: str, bypass_cache: bool = False, supabase: "Client" = Depends(get_supabase)):
+    """特定のカルテを再処理する（bypass_cache=trueでキャッシュを使わずにOCRをやり直す）
+    
+    同じカルテへのリクエストが同時に届いた場合は1回だけ処理し、同じ結果を返す
+    （bypass_cache=true のリクエストはキャッシュを使う再処理とはまとめない）。
+    """
+    flight_key = (record_id, bypass_cache)
+    if reprocess_flights.in_flight(flight_key):
+        metrics.COALESCED.labels("reprocess").inc()
+    return await reprocess_flights.do(flight_key, lambda: _reprocess_record(record_id, bypass_cache, supabase))
+
+async def _reprocess_record(record_id: str, bypass_cache: bool, supabase: "Client"):
     try:
         # レコードの確認
-        record = supabase.table("medical_records").select("*").eq("id", record_id).execute()
+        record = await execute(supabase.table("medical_records").select("*").eq("id", record_id))
         
         if not record.data:
             raise HTTPException(status_code=404, detail="Record not found")
         
+        # キュー投入済み・処理中のカルテは重複して処理しない（実行中のジョブの結果を待てばよい）
+        # キャッシュを使わない再処理は、投入済みのジョブもキャッシュを使わない場合だけまとめる
+        if job_queue.has_record(record_id, bypass_cache=bypass_cache):
+            logger.info(f"Record {record_id} is already queued or processing, skipping reprocess")
+            metrics.COALESCED.labels("reprocess").inc()
+            return {"status": "processing", "record_id": record_id, "coalesced": True}
+        
+        ensure_queue_capacity()
+        
+        # 結果が変わるため、キャッシュした詳細を破棄する
+        record_cache.invalidate(record_id)
+        
         # ステータスを処理中に更新
-        supabase.table("medical_records").update({
+        await execute(supabase.table("medical_records").update({
             "processing_status": "pending"
-        }).eq("id", record_id).execute()
+        }).eq("id", record_id))
         
         # 画像URLを取得
         image_url = record.data[0]["original_image_url"]
         
-        # 画像をダウンロード
-        async with httpx.AsyncClient() as client:
-            response = await client.get(image_url)
-            if response.status_code != 200:
-                logger.error(f"Failed to download image: {image_url}, status code: {response.status_code}")
-                raise HTTPException(status_code=500, detail="Failed to download image")
-            image_bytes = response.content
-        
-        # 処理タスクを開始
-        asyncio.create_task(process_image(record_id, image_url, image_bytes))
+        # OCRジョブをキューに投入（画像はワーカーが処理直前にローカルのキャッシュかストレージから取得するため、
+        # 待機中のジョブは画像を保持しない）
+        await enqueue_ocr_job(
+            record_id, image_url, bypass_cache=bypass_cache, image_sha256=record.data[0].get("image_sha256"),
+        )
         
         return {"status": "processing", "record_id": record_id}
     
@@ -327,5 +1669,18 @@ async def reprocess_record(record_id: str, supabase: Client = Depends(get_supaba
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # 開発時は APP_RELOAD=true で自動リロードする（リロード時のプロセスは1つ）
+    reload = os.environ.get("APP_RELOAD", "false").lower() == "true"
+    web_concurrency = int(os.environ.get("WEB_CONCURRENCY", "1"))
+    if web_concurrency > 1 and job_queue_backend != "supabase":
+        # プロセスごとのキューでは、起動時の復旧で全プロセスが同じカルテを処理し、
+        # 他のプロセスで処理中のカルテの完了もSSEに配信されない
+        raise ValueError(f"WEB_CONCURRENCY > 1 requires JOB_QUEUE_BACKEND=supabase (got {job_queue_backend})")
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        reload=reload,
+        workers=None if reload else web_concurrency,
+    )
 
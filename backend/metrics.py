@@ -0,0 +1,98 @@
+"""Prometheusメトリクスと処理段階ごとの計測
+
+アップロードからDBへの書き戻しまでの各段階の所要時間をヒストグラムに記録し、
+レコードごとの内訳（StageTimings）は extracted_data.stage_timings に保存する。
+"""
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# 処理段階（ラベル値）
+UPLOAD_READ = "upload_read"
+STORAGE_UPLOAD = "storage_upload"
+DB_INSERT = "db_insert"
+QUEUE_WAIT = "queue_wait"
+DOWNLOAD = "download"
+PREPROCESS = "preprocess"
+GEMINI = "gemini"
+FIELDS = "fields"
+DB_WRITE = "db_write"
+
+# 数十ミリ秒（DB）から数分（キュー待ち・長いカルテの生成）まで
+_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "ocr_stage_duration_seconds", "Time spent in each stage of the OCR pipeline", ["stage"], buckets=_BUCKETS
+)
+GEMINI_REQUESTS = Counter("ocr_gemini_requests_total", "Gemini API calls by outcome", ["outcome"])
+BATCHED_IMAGES = Counter(
+    "ocr_batched_images_total", "Images submitted for multi-image OCR by how they were extracted", ["outcome"]
+)
+OCR_ENGINE_RESULTS = Counter(
+    "ocr_engine_results_total", "Images extracted by each OCR engine when routing is enabled", ["engine", "route"]
+)
+RETRIES = Counter("ocr_retries_total", "Gemini API retries by error class", ["error_class"])
+FAILURES = Counter("ocr_failures_total", "Records that failed processing by error class", ["error_class"])
+CACHE_LOOKUPS = Counter("ocr_cache_lookups_total", "OCR result cache lookups", ["result"])
+BLOB_CACHE_LOOKUPS = Counter("ocr_blob_cache_lookups_total", "Local image cache lookups before downloading", ["result"])
+COALESCED = Counter(
+    "ocr_coalesced_total", "Duplicate work joined onto an in-flight call instead of running again", ["kind"]
+)
+RECORDS_PROCESSED = Counter("ocr_records_processed_total", "Records processed successfully")
+JOBS_IN_FLIGHT = Gauge("ocr_jobs_in_flight", "OCR jobs currently being processed")
+QUEUE_DEPTH = Gauge("ocr_queue_depth", "OCR jobs waiting in the queue")
+THROTTLED_SECONDS = Gauge("ocr_throttled_seconds", "Total time Gemini calls waited on the rate limiter")
+CIRCUIT_OPEN = Gauge("ocr_circuit_open", "1 while the Gemini circuit breaker is open")
+
+
+def observe(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+class StageTimings:
+    """1件のレコードの処理段階ごとの所要時間（秒）を集計する"""
+
+    def __init__(self, initial: Optional[Dict[str, float]] = None):
+        self.durations: Dict[str, float] = dict(initial or {})
+
+    def add(self, stage: str, seconds: float, observe_histogram: bool = True) -> None:
+        """所要時間を記録する（同じ段階が複数回ある場合はリトライ分も含めて合計する）
+
+        一括処理の所要時間を複数レコードに記録する場合は、ヒストグラムへの記録を1回にするため
+        observe_histogram=False を指定する。
+        """
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+        if observe_histogram:
+            observe(stage, seconds)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {stage: round(seconds, 4) for stage, seconds in self.durations.items()}
+
+
+@contextmanager
+def timed(stage: str, timings: Optional[StageTimings] = None) -> Iterator[None]:
+    """ヒストグラムに記録する（timings を渡した場合はレコードの内訳にも加える）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if timings is not None:
+            timings.add(stage, elapsed)
+        else:
+            observe(stage, elapsed)
+
+
+def render_latest() -> bytes:
+    return generate_latest()
+
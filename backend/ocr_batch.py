@@ -0,0 +1,114 @@
+"""複数画像をまとめた1回のGemini APIリクエスト（小さい1枚もののカルテ向け）
+
+バイタルシートや処方箋のような小さい画像は、長いプロンプトの方が画像よりトークンを多く使う。
+一定時間内に届いた画像を最大件数までまとめ、画像ごとに区切り行を付けて出力させてから分割する。
+分割できなかった場合や、まとめる相手が来なかった場合は None を返し、呼び出し側で1枚ずつ抽出する。
+"""
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 画像ごとの出力の区切り行（n は1から）
+MARKER_FORMAT = "<<<IMAGE {n}>>>"
+_MARKER_PATTERN = re.compile(r"^[ \t]*<<<IMAGE (\d+)>>>[ \t]*$", re.MULTILINE)
+
+
+class BatchParseError(ValueError):
+    """まとめて抽出した結果を画像ごとに分割できない場合に送出される例外"""
+
+
+def image_label(n: int) -> str:
+    """リクエスト内で各画像の直前に置くラベル（区切り行と同じ表記）"""
+    return MARKER_FORMAT.format(n=n)
+
+
+def split_batch_output(text: str, count: int) -> List[str]:
+    """区切り行で分割し、画像の順に抽出テキストを返す（1〜countがちょうど1回ずつ現れない場合はエラー）"""
+    matches = list(_MARKER_PATTERN.finditer(text))
+    numbers = [int(match.group(1)) for match in matches]
+    if numbers != list(range(1, count + 1)):
+        raise BatchParseError(f"Expected markers 1..{count}, got {numbers}")
+    if text[:matches[0].start()].strip():
+        raise BatchParseError("Unexpected text before the first marker")
+
+    results = []
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        results.append(text[match.end():end].strip("\n"))
+    return results
+
+
+class OCRBatcher:
+    """一定時間内に届いた画像をキー（言語など、同じプロンプトを使えるもの）ごとにまとめて抽出する
+
+    run_batch はキーと画像のリストを受け取り、画像の順に抽出テキストを返す。
+    """
+
+    def __init__(self, run_batch: Callable[[Hashable, List[dict]], Awaitable[List[str]]], max_size: int = 4,
+                 max_wait: float = 0.5):
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending: Dict[Hashable, List[Tuple[dict, asyncio.Future]]] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.batched_images = 0
+        self.fallbacks = 0
+
+    async def submit(self, key: Hashable, image_part: dict) -> Optional[str]:
+        """画像をまとめて抽出する（抽出できなかった場合は None。呼び出し側で1枚ずつ抽出する）"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((image_part, future))
+        if len(pending) >= self.max_size:
+            self._flush(key)
+        elif len(pending) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key: Hashable) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        items = self._pending.pop(key, [])
+        if not items:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(key, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _resolve(items: List[Tuple[dict, asyncio.Future]], results: List[Optional[str]]) -> None:
+        for (_, future), result in zip(items, results):
+            # 待機側がキャンセルされている場合は結果を捨てる
+            if not future.done():
+                future.set_result(result)
+
+    async def _run(self, key: Hashable, items: List[Tuple[dict, asyncio.Future]]) -> None:
+        # まとめる相手がいなければ通常の1枚ずつの抽出に任せる
+        if len(items) == 1:
+            self._resolve(items, [None])
+            return
+        try:
+            texts = await self.run_batch(key, [image_part for image_part, _ in items])
+        except Exception as e:
+            logger.warning(f"Batched OCR of {len(items)} images failed, falling back to single requests: {str(e)}")
+            self.fallbacks += len(items)
+            self._resolve(items, [None] * len(items))
+            return
+        self.batches += 1
+        self.batched_images += len(items)
+        self._resolve(items, texts)
+
+    def stats(self) -> dict:
+        return {
+            "pending": sum(len(items) for items in self._pending.values()),
+            "batches": self.batches,
+            "batched_images": self.batched_images,
+            "fallbacks": self.fallbacks,
+        }
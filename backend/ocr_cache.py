@@ -0,0 +1,250 @@
+"""OCR結果キャッシュ
+
+画像のSHA-256とOCR設定（プロンプト・モデル・言語・生成設定）をキーに抽出結果を保存する。
+同じ画像の再アップロードや再処理ではGemini APIを呼ばずに結果を返す。
+メモリ上のLRU（高速・プロセス内）とSQLite（永続・プロセス再起動後も有効）の2段構成。
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from blocking_io import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+def image_digest(image_bytes: bytes) -> str:
+    """画像データのSHA-256"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def settings_digest(prompt: str, model_name: str, language: str, generation_config: dict,
+                    extra: Optional[dict] = None) -> str:
+    """OCR設定（前処理設定などextraを含む）のハッシュ"""
+    settings = json.dumps(
+        {"prompt": prompt, "model": model_name, "language": language, "generation_config": generation_config,
+         "extra": extra or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+
+def cache_key(image_sha256: str, prompt: str, model_name: str, language: str, generation_config: dict,
+              extra: Optional[dict] = None) -> str:
+    """画像ハッシュとOCR設定（前処理設定などextraを含む）からキャッシュキーを生成する"""
+    return f"{image_sha256}:{settings_digest(prompt, model_name, language, generation_config, extra)}"
+
+
+class MemoryCacheTier:
+    """件数上限とTTL付きのLRUキャッシュ"""
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            text, stored_at = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return text
+
+    def put(self, key: str, text: str, stored_at: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (text, stored_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCacheTier:
+    """合計サイズ上限とTTL付きの永続キャッシュ（最終アクセスが古いものから削除）
+
+    DBは最初に使うときに開く（main の読み込み時にファイルを作らない）。開けない場合はキャッシュしない。
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, ttl: float = 0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._unavailable = False
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """DBの接続（ロックを取得した状態で呼び出す。開けなかった場合は None）"""
+        if self._conn is None and not self._unavailable:
+            try:
+                self._conn = self._open()
+            except sqlite3.Error as e:
+                logger.warning(f"Persistent OCR cache unavailable ({self.path}): {str(e)}")
+                self._unavailable = True
+        return self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ocr_cache (
+                  key TEXT PRIMARY KEY,
+                  extracted_text TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  created_at REAL NOT NULL,
+                  accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_accessed_at ON ocr_cache(accessed_at)")
+            conn.commit()
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def get(self, key: str) -> Optional[tuple]:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            if db is None:
+                return None
+            row = db.execute(
+                "SELECT extracted_text, created_at FROM ocr_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                db.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE ocr_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            db.commit()
+            return row[0], row[1]
+
+    def put(self, key: str, text: str) -> None:
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            db = self._db()
+            if db is None:
+                return
+            db.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, extracted_text, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, text, size, now, now),
+            )
+            self._evict(db, now)
+            db.commit()
+
+    def _evict(self, db: sqlite3.Connection, now: float) -> None:
+        if self.ttl:
+            db.execute("DELETE FROM ocr_cache WHERE created_at < ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = db.execute("SELECT key, size FROM ocr_cache ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            db.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+            total -= size
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class OCRCache:
+    """メモリとSQLiteの2段構成のOCR結果キャッシュ"""
+
+    def __init__(self, memory: MemoryCacheTier, persistent: Optional[SQLiteCacheTier] = None, enabled: bool = True):
+        self.memory = memory
+        self.persistent = persistent
+        self.enabled = enabled
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        """キャッシュ済みの抽出結果を返す（なければNone）"""
+        if not self.enabled:
+            return None
+        text = self.memory.get(key)
+        if text is not None:
+            self.memory_hits += 1
+            return text
+        if self.persistent is not None:
+            try:
+                entry = await run_blocking(self.persistent.get, key)
+            except Exception as e:
+                logger.warning(f"OCR cache read error: {str(e)}")
+                entry = None
+            if entry is not None:
+                text, stored_at = entry
+                self.memory.put(key, text, stored_at)
+                self.persistent_hits += 1
+                return text
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, text: str) -> None:
+        """抽出結果を保存する"""
+        if not self.enabled:
+            return
+        self.memory.put(key, text)
+        if self.persistent is not None:
+            try:
+                await run_blocking(self.persistent.put, key, text)
+            except Exception as e:
+                logger.warning(f"OCR cache write error: {str(e)}")
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.persistent_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.memory),
+            "memory_hits": self.memory_hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.memory_hits + self.persistent_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        if self.persistent is not None:
+            self.persistent.close()
+
+
+def create_cache(
+    enabled: bool = True,
+    max_entries: int = 1000,
+    ttl: float = 0,
+    sqlite_path: Optional[str] = None,
+    max_bytes: int = 256 * 1024 * 1024,
+) -> OCRCache:
+    """設定値からキャッシュを生成する（SQLiteが使えない環境ではメモリのみ。DBは最初に使うときに開く）"""
+    persistent = None
+    if enabled and sqlite_path:
+        persistent = SQLiteCacheTier(sqlite_path, max_bytes=max_bytes, ttl=ttl)
+    return OCRCache(MemoryCacheTier(max_entries=max_entries, ttl=ttl), persistent, enabled=enabled)
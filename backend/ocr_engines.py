@@ -0,0 +1,293 @@
+"""OCRエンジンの抽象化と振り分け
+
+Gemini Pro（高精度）、Gemini Flash（安価・高速）、ローカルのTesseract（オフライン・混雑時用）を
+同じインターフェースで扱い、画像サイズ・キューの待ち件数・直近の所要時間からジョブごとにエンジンを選ぶ。
+安価なエンジンの結果の確信度（生成の終了理由・トークンの対数確率・判読不能の表記から推定）が低い場合だけ、
+高精度のエンジンで抽出し直す。
+Tesseract（pytesseract と tesseract コマンド）はオプションで、ない環境ではローカルエンジンを使わない。
+"""
+import importlib.util
+import io
+import logging
+import math
+import shutil
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 判読できなかった箇所の表記（OCRプロンプトで指定している）
+ILLEGIBLE_MARKERS = ("[判読不能]", "[ILLEGIBLE]")
+
+# 生成が途中で止まった・打ち切られた場合の終了理由と、その場合の確信度の上限
+DEGRADED_FINISH_REASONS = {
+    "MAX_TOKENS": 0.3,
+    "OTHER": 0.3,
+    "SAFETY": 0.0,
+    "RECITATION": 0.0,
+    "BLOCKLIST": 0.0,
+    "PROHIBITED_CONTENT": 0.0,
+    "SPII": 0.0,
+}
+
+# Tesseractの言語データ名
+TESSERACT_LANGUAGES = {"ja": "jpn", "en": "eng"}
+# 抽出データに記録するローカルエンジンのモデル名
+TESSERACT_MODEL_NAME = "tesseract"
+
+
+@dataclass
+class OCRResult:
+    text: str
+    # 0〜1（低いほど読み取りに自信がない）
+    confidence: float
+    engine: str
+    # 抽出データに記録するモデル名（gemini-1.5-pro・tesseract など）
+    model_name: str = ""
+    # 確信度が低い・エラーのため抽出し直した場合の最初のエンジン
+    escalated_from: Optional[str] = None
+    # 振り分けの前にキャッシュから取得した結果か
+    cached: bool = False
+
+
+def text_confidence(text: str) -> float:
+    """生成されたテキストの確信度（判読不能と表記された行の割合から推定する。空の場合は0）"""
+    lines = [line for line in (text or "").splitlines() if line.strip()]
+    if not lines:
+        return 0.0
+    illegible = sum(text.count(marker) for marker in ILLEGIBLE_MARKERS)
+    return max(0.0, 1.0 - illegible / len(lines))
+
+
+def response_confidence(text: str, finish_reason: Optional[str] = None, avg_logprobs: Optional[float] = None) -> float:
+    """Geminiの生成結果の確信度
+
+    判読不能の表記はほとんど出力されないため、生成の終了理由（トークン上限での打ち切り・安全性のブロックなど）と、
+    レスポンスに含まれる場合はトークンの平均対数確率（exp で0〜1にする）からも推定し、最も低い値にする。
+    """
+    confidence = text_confidence(text)
+    if finish_reason in DEGRADED_FINISH_REASONS:
+        confidence = min(confidence, DEGRADED_FINISH_REASONS[finish_reason])
+    if isinstance(avg_logprobs, (int, float)):
+        confidence = min(confidence, math.exp(min(avg_logprobs, 0.0)))
+    return confidence
+
+
+class OCREngine(ABC):
+    """1枚の画像からテキストを抽出するエンジン"""
+
+    name: str
+    model_name: str
+
+    def available(self) -> bool:
+        return True
+
+    @abstractmethod
+    async def extract(self, image_bytes: bytes, language: str = "ja", **options) -> OCRResult:
+        ...
+
+
+class GeminiEngine(OCREngine):
+    """Geminiのモデルで抽出する（リトライ・レート制限・キャッシュは run に任せる）"""
+
+    def __init__(self, name: str, model_name: str, run: Callable[..., Awaitable[str]]):
+        self.name = name
+        self.model_name = model_name
+        # run(model_name, image_bytes, language, signals=..., **options) -> 抽出テキスト
+        # （signals にはレスポンスの finish_reason・avg_logprobs を設定する。キャッシュの結果などでは空のまま）
+        self.run = run
+
+    async def extract(self, image_bytes: bytes, language: str = "ja", **options) -> OCRResult:
+        signals: dict = {}
+        text = await self.run(self.model_name, image_bytes, language, signals=signals, **options)
+        return OCRResult(text, response_confidence(text, **signals), self.name, self.model_name)
+
+
+def tesseract_ocr(image_bytes: bytes, lang: str) -> Tuple[str, float]:
+    """Tesseractで抽出し、テキストと単語ごとの確信度の平均を返す（プロセスプールで実行する）"""
+    import pytesseract
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+    lines: Dict[tuple, list] = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        confidence = float(data["conf"][i])
+        if not word.strip() or confidence < 0:
+            continue
+        lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(word)
+        confidences.append(confidence)
+    # 日本語は単語の間に空白を入れない
+    separator = "" if lang.startswith("jpn") else " "
+    text = "\n".join(separator.join(words) for words in lines.values())
+    return text, (sum(confidences) / len(confidences) / 100 if confidences else 0.0)
+
+
+class TesseractEngine(OCREngine):
+    """ローカルのCPUで抽出する（APIを使わないため、Geminiが使えない間や混雑時に使う）"""
+
+    name = "local"
+    model_name = TESSERACT_MODEL_NAME
+
+    def __init__(self, run_in_pool: Callable[..., Awaitable], languages: Optional[Dict[str, str]] = None):
+        self.run_in_pool = run_in_pool
+        self.languages = languages or TESSERACT_LANGUAGES
+
+    def available(self) -> bool:
+        return importlib.util.find_spec("pytesseract") is not None and shutil.which("tesseract") is not None
+
+    async def extract(self, image_bytes: bytes, language: str = "ja", **options) -> OCRResult:
+        lang = self.languages.get(language, self.languages["en"])
+        text, confidence = await self.run_in_pool(tesseract_ocr, image_bytes, lang)
+        return OCRResult(text, confidence, self.name, self.model_name)
+
+
+class EngineRouter:
+    """ジョブごとにOCRエンジンを選び、確信度が低い場合は primary で抽出し直す
+
+    - Geminiが使えない間（offline）やキューの待ち件数が overflow_queue_depth 以上の間はローカルエンジン
+    - large_image_bytes を超える画像（書き込みの多いページ）は最初から primary
+    - それ以外は fast。ただし fast の直近の所要時間が primary より長い間は primary
+    - 選んだGeminiのエンジンの直近の所要時間が latency_budget を超えている間はローカルエンジン
+    所要時間で避けたエンジンも、測り直すため probe_interval 回に1回は使う。
+    lookup を指定した場合は、エンジンを選ぶ前に primary・fast のキャッシュ済みの結果を探す
+    （キャッシュから返した結果は振り分けの件数・所要時間に数えない）。
+    Geminiが使えない間・混雑時にローカルエンジンで抽出した結果は、確信度が低くても primary で抽出し直さない
+    （primary は待たされるため。精度の低い結果は抽出データのモデル名から後で再処理する）。
+    """
+
+    def __init__(self, primary: OCREngine, fast: Optional[OCREngine] = None, local: Optional[OCREngine] = None,
+                 large_image_bytes: int = 0, overflow_queue_depth: int = 0, latency_budget: float = 0.0,
+                 min_confidence: float = 0.8, latency_alpha: float = 0.3, probe_interval: int = 20,
+                 can_fall_back: Callable[[Exception], bool] = lambda error: True,
+                 lookup: Optional[Callable[..., Awaitable[Optional[str]]]] = None):
+        self.primary = primary
+        self.fast = fast
+        if local is not None and not local.available():
+            logger.warning("Local OCR engine is not installed (pytesseract / tesseract), routing without it")
+            local = None
+        self.local = local
+        self.large_image_bytes = large_image_bytes
+        self.overflow_queue_depth = overflow_queue_depth
+        self.latency_budget = latency_budget
+        self.min_confidence = min_confidence
+        self.latency_alpha = latency_alpha
+        self.probe_interval = probe_interval
+        self._skipped = 0
+        # primary のエラーをローカルエンジンで代替してよいか（認証エラー等は代替しない）
+        self.can_fall_back = can_fall_back
+        # lookup(model_name, image_bytes, language, **options) -> キャッシュ済みの抽出テキスト（なければ None）
+        self.lookup = lookup
+        self.cache_hits = 0
+        self._latency: Dict[str, float] = {}
+        self.routed: Dict[str, int] = {}
+        self.escalations = 0
+        self.fallbacks = 0
+        # 確信度が低いが抽出し直さなかった件数
+        self.deferred = 0
+
+    def latency(self, engine: OCREngine) -> Optional[float]:
+        """直近の所要時間（指数移動平均。まだ使っていない場合は None）"""
+        return self._latency.get(engine.name)
+
+    def observe(self, engine: OCREngine, seconds: float) -> None:
+        previous = self._latency.get(engine.name)
+        self._latency[engine.name] = seconds if previous is None else (
+            self.latency_alpha * seconds + (1 - self.latency_alpha) * previous
+        )
+
+    def _over_budget(self, engine: OCREngine) -> bool:
+        latency = self.latency(engine)
+        return self.latency_budget > 0 and latency is not None and latency > self.latency_budget
+
+    def choose(self, image_size: int, queue_depth: int = 0, offline: bool = False) -> OCREngine:
+        return self._choose(image_size, queue_depth, offline)[0]
+
+    def _choose(self, image_size: int, queue_depth: int, offline: bool) -> Tuple[OCREngine, bool]:
+        """エンジンと、確信度が低い場合に primary で抽出し直してよいかを返す"""
+        overflow = self.overflow_queue_depth > 0 and queue_depth >= self.overflow_queue_depth
+        if self.local is not None and (offline or overflow):
+            return self.local, False
+        engine = self.primary
+        if self.fast is not None and not (self.large_image_bytes > 0 and image_size > self.large_image_bytes):
+            fast_latency, primary_latency = self.latency(self.fast), self.latency(self.primary)
+            if fast_latency is None or primary_latency is None or fast_latency <= primary_latency or self._probe():
+                engine = self.fast
+        if self.local is not None and self._over_budget(engine) and not self._probe():
+            return self.local, True
+        return engine, True
+
+    def _probe(self) -> bool:
+        """所要時間で避けたエンジンを測り直す番か"""
+        self._skipped += 1
+        return self.probe_interval > 0 and self._skipped % self.probe_interval == 0
+
+    async def _run(self, engine: OCREngine, image_bytes: bytes, language: str, options: dict) -> OCRResult:
+        started = time.perf_counter()
+        result = await engine.extract(image_bytes, language, **options)
+        self.observe(engine, time.perf_counter() - started)
+        self.routed[engine.name] = self.routed.get(engine.name, 0) + 1
+        return result
+
+    def _fallback_for(self, engine: OCREngine, error: Exception) -> Optional[OCREngine]:
+        if engine is not self.primary:
+            return self.primary
+        if self.local is not None and self.can_fall_back(error):
+            return self.local
+        return None
+
+    async def _cached(self, image_bytes: bytes, language: str, options: dict) -> Optional[OCRResult]:
+        """primary・fast の順にキャッシュ済みの結果を探す（確信度の低い fast の結果は primary の結果で置き換わっている）"""
+        if self.lookup is None:
+            return None
+        for engine in (self.primary, self.fast):
+            if engine is None:
+                continue
+            text = await self.lookup(engine.model_name, image_bytes, language, **options)
+            if text is not None:
+                self.cache_hits += 1
+                return OCRResult(text, text_confidence(text), engine.name, engine.model_name, cached=True)
+        return None
+
+    async def extract(self, image_bytes: bytes, language: str = "ja", queue_depth: int = 0,
+                      offline: bool = False, **options) -> OCRResult:
+        cached = await self._cached(image_bytes, language, options)
+        if cached is not None:
+            return cached
+        engine, can_escalate = self._choose(len(image_bytes), queue_depth, offline)
+        try:
+            result = await self._run(engine, image_bytes, language, options)
+        except Exception as e:
+            fallback = self._fallback_for(engine, e)
+            if fallback is None:
+                raise
+            logger.warning(f"OCR engine {engine.name} failed, retrying with {fallback.name}: {str(e)}")
+            self.fallbacks += 1
+            result = await self._run(fallback, image_bytes, language, options)
+            result.escalated_from = engine.name
+            return result
+        if engine is self.primary or result.confidence >= self.min_confidence:
+            return result
+        if not can_escalate:
+            self.deferred += 1
+            return result
+        # 確信度が低い場合だけ高精度のエンジンで抽出し直す
+        logger.info(f"OCR confidence {result.confidence:.2f} from {engine.name} is low, escalating to {self.primary.name}")
+        self.escalations += 1
+        escalated = await self._run(self.primary, image_bytes, language, options)
+        escalated.escalated_from = engine.name
+        return escalated
+
+    def stats(self) -> dict:
+        return {
+            "engines": [engine.name for engine in (self.primary, self.fast, self.local) if engine is not None],
+            "routed": dict(self.routed),
+            "escalations": self.escalations,
+            "fallbacks": self.fallbacks,
+            "deferred": self.deferred,
+            "cache_hits": self.cache_hits,
+            "latency_seconds": {name: round(seconds, 3) for name, seconds in self._latency.items()},
+        }
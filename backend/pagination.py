@@ -0,0 +1,51 @@
+"""カルテ一覧のキーセット（カーソル）ページネーション
+
+(uploaded_at, id) の降順で並べ、前のページの最後の行より後ろの行を取得する。
+OFFSETと違って読み飛ばす行がないため、どれだけ後ろのページでも同じ速さで取得できる。
+カーソルは最後の行の (uploaded_at, id) をBase64エンコードした文字列で、クライアントからは不透明な値として扱う。
+"""
+import base64
+import binascii
+import json
+from typing import Optional
+
+
+class InvalidCursorError(ValueError):
+    """カーソルの形式が不正な場合に送出される例外"""
+
+
+def encode_cursor(row: dict) -> str:
+    """行の (uploaded_at, id) からカーソルを作る"""
+    payload = json.dumps({"u": row["uploaded_at"], "id": row["id"]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """カーソルを (uploaded_at, id) に戻す"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        uploaded_at, record_id = payload["u"], payload["id"]
+    except (binascii.Error, ValueError, KeyError, TypeError) as e:
+        raise InvalidCursorError("Invalid cursor") from e
+    if not isinstance(uploaded_at, str) or not isinstance(record_id, str):
+        raise InvalidCursorError("Invalid cursor")
+    return {"uploaded_at": uploaded_at, "id": record_id}
+
+
+def _quote(value: str) -> str:
+    # PostgRESTのフィルタでは ":" や "," を含む値をダブルクォートで囲む
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def keyset_filter(cursor: dict) -> str:
+    """カーソルより後ろ（降順で次）の行を取得する PostgREST の or フィルタ"""
+    uploaded_at, record_id = _quote(cursor["uploaded_at"]), _quote(cursor["id"])
+    return f"uploaded_at.lt.{uploaded_at},and(uploaded_at.eq.{uploaded_at},id.lt.{record_id})"
+
+
+def next_cursor(rows: list, limit: int) -> Optional[str]:
+    """limit+1 件取得した結果から次のページのカーソルを返す（最後のページならNone）"""
+    if len(rows) <= limit:
+        return None
+    return encode_cursor(rows[limit - 1])
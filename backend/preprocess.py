@@ -0,0 +1,179 @@
+"""OCR前の画像前処理
+
+MIMEタイプの判定、EXIFの向き補正、最大解像度への縮小、グレースケール化とコントラスト補正、
+再エンコードを行い、Gemini APIに送る画像を小さくする。
+画像処理はCPU負荷が高いため、プロセスプールで実行してイベントループを止めない。
+"""
+import asyncio
+import io
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillowがない環境では前処理を行わずにそのまま送信する
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# 先頭バイトによるファイル形式の判定
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"%PDF-", "application/pdf"),
+]
+
+
+def detect_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """ファイルの先頭バイトからMIMEタイプを判定する"""
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+
+@dataclass
+class PreprocessSettings:
+    """前処理の設定"""
+    enabled: bool = True
+    max_dimension: int = 2048
+    grayscale: bool = True
+    autocontrast: bool = True
+    output_format: str = "JPEG"
+    jpeg_quality: int = 85
+
+    def as_dict(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "max_dimension": self.max_dimension,
+            "grayscale": self.grayscale,
+            "autocontrast": self.autocontrast,
+            "output_format": self.output_format,
+            "jpeg_quality": self.jpeg_quality,
+        }
+
+
+@dataclass
+class PreprocessResult:
+    """前処理の結果"""
+    data: bytes
+    mime_type: str
+    original_size: int
+    processed_size: int
+    width: int = 0
+    height: int = 0
+
+
+def encode_pil_image(image, settings: PreprocessSettings) -> PreprocessResult:
+    """PILの画像に前処理を適用して再エンコードする（PDF・TIFFのページ画像にも使用）"""
+    if settings.enabled:
+        # EXIFの向き情報を反映（スマートフォンで撮影したカルテ対策）
+        image = ImageOps.exif_transpose(image)
+
+        # 最大解像度に縮小（縦横比は維持）
+        if max(image.size) > settings.max_dimension:
+            image.thumbnail((settings.max_dimension, settings.max_dimension), Image.LANCZOS)
+
+    if settings.enabled and settings.grayscale:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    if settings.enabled and settings.autocontrast:
+        image = ImageOps.autocontrast(image, cutoff=1)
+
+    buffer = io.BytesIO()
+    if settings.output_format.upper() == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.save(buffer, format="JPEG", quality=settings.jpeg_quality, optimize=True)
+        mime_type = "image/jpeg"
+    data = buffer.getvalue()
+    width, height = image.size
+    return PreprocessResult(data, mime_type, len(data), len(data), width, height)
+
+
+def preprocess_image(data: bytes, settings: PreprocessSettings) -> PreprocessResult:
+    """画像を前処理する（プロセスプールで実行される同期関数）"""
+    mime_type = detect_mime_type(data)
+    if not settings.enabled or Image is None or not mime_type.startswith("image/"):
+        return PreprocessResult(data, mime_type, len(data), len(data))
+
+    with Image.open(io.BytesIO(data)) as image:
+        result = encode_pil_image(image, settings)
+
+    # 再エンコードで大きくなる場合（小さなPNGなど）は元の画像を使う
+    if result.processed_size >= len(data):
+        return PreprocessResult(data, mime_type, len(data), len(data), result.width, result.height)
+    result.original_size = len(data)
+    return result
+
+
+class ImagePreprocessor:
+    """プロセスプールで前処理を実行し、削減量を集計する"""
+
+    def __init__(self, settings: PreprocessSettings, workers: Optional[int] = None):
+        self.settings = settings
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.processed = 0
+        self.failed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def run_in_pool(self, func, *args):
+        """同期関数を前処理用のプロセスプールで実行する（PDF・TIFFのページ分割など）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), func, *args)
+
+    def record(self, result: PreprocessResult) -> None:
+        """前処理前後のバイト数を集計に加える"""
+        self.processed += 1
+        self.bytes_before += result.original_size
+        self.bytes_after += result.processed_size
+
+    async def run(self, data: bytes) -> PreprocessResult:
+        """画像を前処理する（失敗した場合は元の画像をそのまま返す）"""
+        if not self.settings.enabled or Image is None:
+            return PreprocessResult(data, detect_mime_type(data), len(data), len(data))
+        try:
+            result = await self.run_in_pool(preprocess_image, data, self.settings)
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Image preprocessing failed, sending original image: {str(e)}")
+            return PreprocessResult(data, detect_mime_type(data), len(data), len(data))
+
+        self.record(result)
+        logger.info(
+            f"Preprocessed image: {result.original_size} -> {result.processed_size} bytes "
+            f"({result.width}x{result.height}, {result.mime_type})"
+        )
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.settings.enabled and Image is not None,
+            "processed": self.processed,
+            "failed": self.failed,
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after,
+            "size_ratio": self.bytes_after / self.bytes_before if self.bytes_before else 1.0,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
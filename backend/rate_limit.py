@@ -0,0 +1,219 @@
+"""Gemini API呼び出しのレート制御
+
+プロセス全体で共有するトークンバケット（リクエスト数/分・トークン数/分）と、
+429やクォータ超過のエラーを受けたときにワーカープール全体を一時停止するサーキットブレーカーを提供する。
+エラーはメッセージの部分一致ではなく、例外の型とステータスコードで分類する。
+"""
+import asyncio
+import logging
+import random
+import sys
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# エラー分類
+RATE_LIMITED = "rate_limited"  # 429・クォータ超過（待てば回復する）
+TRANSIENT = "transient"        # 5xx・タイムアウト・接続エラー（リトライする）
+PERMANENT = "permanent"        # 認証エラー・不正なリクエスト（リトライしても失敗する）
+
+_RATE_LIMIT_STATUS = {429}
+_TRANSIENT_STATUS = {408, 500, 502, 503, 504}
+_PERMANENT_STATUS = {400, 401, 403, 404}
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """例外からHTTPステータスコードを取り出す（google-api-core・httpx）"""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def classify_error(error: Exception) -> str:
+    """Gemini API呼び出しのエラーを分類する"""
+    # Gemini SDKの読み込み前に発生した例外は google-api-core の例外ではないため、ここでは import しない
+    google_exceptions = sys.modules.get("google.api_core.exceptions")
+    if google_exceptions is not None:
+        if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+            return RATE_LIMITED
+        if isinstance(error, (google_exceptions.ServerError, google_exceptions.DeadlineExceeded,
+                              google_exceptions.RetryError)):
+            return TRANSIENT
+        if isinstance(error, (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied,
+                              google_exceptions.InvalidArgument, google_exceptions.NotFound)):
+            return PERMANENT
+
+    status = _status_code(error)
+    if status in _RATE_LIMIT_STATUS:
+        return RATE_LIMITED
+    if status in _TRANSIENT_STATUS:
+        return TRANSIENT
+    if status in _PERMANENT_STATUS:
+        return PERMANENT
+    # 接続エラーやタイムアウトなど、分類できないものはリトライ対象にする
+    return TRANSIENT
+
+
+class TokenBucket:
+    """1分あたりの上限を持つトークンバケット（上限0以下は無制限）"""
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.per_minute = per_minute
+        self.capacity = burst if burst is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.per_minute <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """amount分のトークンを予約し、使えるようになるまでの待ち時間（秒）を返す
+
+        不足分は前借りする（残高が負になる）ため、呼び出し順に公平に待たされる。
+        バケット容量を超える要求は容量分として扱う。
+        """
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens * 60 / self.per_minute
+
+    def adjust(self, amount: float) -> None:
+        """予約したトークン数と実際の消費量の差を反映する（正なら追加消費、負なら返却）"""
+        if self.unlimited:
+            return
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens - amount)
+
+
+class CircuitBreaker:
+    """レート制限エラーを受けたら一定時間すべての呼び出しを止めるサーキットブレーカー
+
+    連続して制限を受けるたびに停止時間を倍にし（上限あり）、成功すると元に戻す。
+    停止中に受けたエラーや、前回開いた時点より前に送信したリクエストのエラーは、同じ制限によるものとして数えない。
+    """
+
+    def __init__(self, cooldown: float = 30.0, max_cooldown: float = 300.0):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._open_until = 0.0
+        self._consecutive_trips = 0
+        self._tripped_at = float("-inf")
+        self.trips = 0
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    def remaining(self) -> float:
+        return max(0.0, self._open_until - time.monotonic())
+
+    def trip(self, retry_after: Optional[float] = None, sent_at: Optional[float] = None) -> float:
+        """ブレーカーを開き、停止する秒数を返す
+
+        sent_at はエラーになったリクエストを送信した時刻（time.monotonic()）。
+        """
+        now = time.monotonic()
+        # 同時に送信していた複数のリクエストが同じ制限で失敗しても、停止時間は1回分だけ延ばす
+        if sent_at is not None:
+            new_trip = sent_at >= self._tripped_at
+        else:
+            new_trip = not self.is_open
+        delay = 0.0
+        if new_trip:
+            self._consecutive_trips += 1
+            self.trips += 1
+            self._tripped_at = now
+            delay = min(self.max_cooldown, self.cooldown * (2 ** (self._consecutive_trips - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self._open_until = max(self._open_until, now + delay)
+        return self.remaining()
+
+    def record_success(self) -> None:
+        self._consecutive_trips = 0
+
+
+class RateLimiter:
+    """Gemini API呼び出し前に待機させるプロセス全体のリミッター"""
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 cooldown: float = 30.0, max_cooldown: float = 300.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.breaker = CircuitBreaker(cooldown, max_cooldown)
+        self._lock = asyncio.Lock()
+        self.throttled_seconds = 0.0
+        self.throttled_calls = 0
+        self.rate_limited_errors = 0
+
+    async def wait_until_closed(self) -> float:
+        """ブレーカーが閉じるまで待機し、待機した秒数を返す（ワーカーがジョブを取り出す前にも呼ばれる）"""
+        waited = 0.0
+        while self.breaker.is_open:
+            delay = self.breaker.remaining()
+            await asyncio.sleep(delay)
+            waited += delay
+        if waited:
+            self.throttled_seconds += waited
+        return waited
+
+    async def acquire(self, estimated_tokens: float = 0) -> float:
+        """リクエスト1件とestimated_tokens分のトークンを確保する。待機した秒数を返す"""
+        waited = await self.wait_until_closed()
+        async with self._lock:
+            delay = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if delay > 0:
+            await asyncio.sleep(delay)
+            self.throttled_seconds += delay
+            waited += delay
+        # バケット待ちの間にブレーカーが開いた場合は、閉じるまで待つ
+        waited += await self.wait_until_closed()
+        if waited:
+            self.throttled_calls += 1
+        return waited
+
+    def record_usage(self, estimated_tokens: float, actual_tokens: Optional[float]) -> None:
+        """レスポンスの実際のトークン数で予約分を補正する"""
+        self.breaker.record_success()
+        if actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def record_rate_limited(self, retry_after: Optional[float] = None, sent_at: Optional[float] = None) -> float:
+        """429・クォータ超過を記録してブレーカーを開く。停止する秒数を返す
+
+        sent_at には失敗したリクエストを送信した時刻（time.monotonic()）を渡す。
+        """
+        self.rate_limited_errors += 1
+        delay = self.breaker.trip(retry_after, sent_at)
+        logger.warning(f"Gemini API rate limited; pausing all OCR calls for {delay:.1f}s")
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            "requests_per_minute": self.requests.per_minute,
+            "tokens_per_minute": self.tokens.per_minute,
+            "circuit_open": self.breaker.is_open,
+            "circuit_open_remaining": round(self.breaker.remaining(), 1),
+            "circuit_trips": self.breaker.trips,
+            "rate_limited_errors": self.rate_limited_errors,
+            "throttled_calls": self.throttled_calls,
+            "throttled_seconds": round(self.throttled_seconds, 2),
+        }
+
+
+def backoff_delay(attempt: int, initial_delay: float) -> float:
+    """一時的なエラーのリトライ間隔（エクスポネンシャルバックオフ・ジッター付き）"""
+    return initial_delay * (2 ** (attempt - 1)) * (0.5 + random.random())
@@ -0,0 +1,73 @@
+"""カルテ詳細のリードスルーキャッシュ
+
+処理が完了したカルテの詳細（レコードと抽出データ）は再処理されるまで変わらないため、
+プロセス内にキャッシュして結果ページの表示でDBに問い合わせないようにする。
+再処理時に無効化し、無効化と同時に実行中だった取得結果はキャッシュしない。
+共有のジョブキューでは他のプロセスで再処理されるため、キャッシュを返す前に処理状態の列をDBと比べる。
+"""
+from typing import Optional
+
+from ocr_cache import MemoryCacheTier
+
+# キャッシュするのは以後変化しない状態のレコードだけ
+CACHEABLE_STATUSES = {"completed"}
+# 再処理されると変わる列（他のプロセスでの再処理をこの列で検出する）
+REVALIDATE_COLUMNS = ("processing_status", "ocr_queued_at")
+
+
+def is_current(result: dict, row: dict) -> bool:
+    """キャッシュした詳細が、DBから取得した最新の列と同じ状態か"""
+    return all(result["record"].get(column) == row.get(column) for column in REVALIDATE_COLUMNS)
+
+
+class RecordCache:
+    """完了済みカルテの詳細をキャッシュする"""
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 0, enabled: bool = True):
+        self.enabled = enabled
+        self.memory = MemoryCacheTier(max_entries, ttl)
+        # 無効化の世代（取得開始後に無効化があった場合は結果を保存しない）
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def generation(self) -> int:
+        """取得を開始する前に呼び出し、put に渡す"""
+        return self._generation
+
+    def get(self, record_id: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        result = self.memory.get(record_id)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, record_id: str, result: dict, generation: int) -> bool:
+        """完了済みのレコードであればキャッシュする（保存したかどうかを返す）"""
+        if not self.enabled or generation != self._generation:
+            return False
+        if result["record"].get("processing_status") not in CACHEABLE_STATUSES:
+            return False
+        self.memory.put(record_id, result)
+        return True
+
+    def invalidate(self, record_id: str) -> None:
+        """再処理などでレコードが変わる前に呼び出す"""
+        self._generation += 1
+        self.invalidations += 1
+        self.memory.delete(record_id)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.memory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
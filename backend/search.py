@@ -0,0 +1,217 @@
+"""抽出テキストの全文検索
+
+本番ではSupabase（文字とバイグラムのGINインデックス + search_extracted_text関数）で検索する。
+テストやSupabaseのないローカル環境では、文字のバイグラムによるインメモリの転置インデックスを使う。
+日本語は単語の区切りがないため、どちらも部分一致で検索し、出現回数の多い順に並べる。
+"""
+import re
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List, Set, Tuple
+
+from blocking_io import execute
+
+# 全角スペースも区切りとして扱う
+_TERM_SEPARATOR = re.compile(r"[\s　]+")
+
+
+def parse_query(query: str, max_terms: int = 5) -> List[str]:
+    """検索語を空白で分割する（長い語を先頭にし、インデックスで絞り込みやすくする）"""
+    terms = []
+    for term in _TERM_SEPARATOR.split(query.strip()):
+        if term and term.lower() not in (t.lower() for t in terms):
+            terms.append(term)
+    return sorted(terms[:max_terms], key=len, reverse=True)
+
+
+def count_occurrences(text: str, terms: List[str]) -> int:
+    """検索語の出現回数の合計（大文字小文字は区別しない）"""
+    lowered = text.lower()
+    return sum(lowered.count(term.lower()) for term in terms)
+
+
+def make_snippet(text: str, terms: List[str], width: int = 40) -> Tuple[str, List[List[int]]]:
+    """最初に一致した位置の前後を切り出し、スニペット内の一致箇所の [開始, 終了) を返す"""
+    lowered = text.lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [p for p in positions if p >= 0]
+    first = min(positions) if positions else 0
+
+    start = max(0, first - width)
+    end = min(len(text), first + width * 2)
+    snippet = text[start:end]
+
+    highlights = []
+    lowered_snippet = snippet.lower()
+    for term in terms:
+        term = term.lower()
+        index = lowered_snippet.find(term)
+        while index >= 0 and term:
+            highlights.append([index, index + len(term)])
+            index = lowered_snippet.find(term, index + len(term))
+    highlights.sort()
+
+    # 前後を省略した場合は「…」を付ける（ハイライト位置もずらす）
+    if start > 0:
+        snippet = "…" + snippet
+        highlights = [[s + 1, e + 1] for s, e in highlights]
+    if end < len(text):
+        snippet = snippet + "…"
+    return snippet, highlights
+
+
+@dataclass
+class SearchHit:
+    """検索結果の1件（ページ単位）"""
+    record_id: str
+    page_index: int
+    text: str
+    score: int
+    uploaded_at: str = ""
+
+    def to_dict(self, terms: List[str]) -> dict:
+        snippet, highlights = make_snippet(self.text, terms)
+        return {
+            "record_id": self.record_id,
+            "page_index": self.page_index,
+            "score": self.score,
+            "uploaded_at": self.uploaded_at,
+            "snippet": snippet,
+            "highlights": highlights,
+        }
+
+
+class SearchBackend(ABC):
+    """検索バックエンドの共通インターフェース"""
+
+    @abstractmethod
+    async def search(self, terms: List[str], limit: int, offset: int = 0) -> List[SearchHit]:
+        """すべての検索語を含むページをスコア順に返す"""
+
+    async def index_pages(self, record_id: str, pages: List[str], uploaded_at: str = "") -> None:
+        """抽出テキストを索引に登録する（DBのインデックスを使う場合は何もしない）"""
+
+
+class SupabaseSearchBackend(SearchBackend):
+    """文字とバイグラムのGINインデックスを使うSupabaseのRPC関数で検索する
+
+    出現回数を数えるのは、すべての語を含むページのうちアップロード日時の新しい candidate_limit 件だけ
+    （offset によるページ送りもこの範囲内で行い、ページごとに候補が変わらないようにする）。
+    """
+
+    def __init__(self, get_client, candidate_limit: int = 1000):
+        self._get_client = get_client
+        self.candidate_limit = candidate_limit
+
+    async def search(self, terms: List[str], limit: int, offset: int = 0) -> List[SearchHit]:
+        query = self._get_client().rpc("search_extracted_text", {
+            "search_terms": terms,
+            "result_limit": limit,
+            "result_offset": offset,
+            "candidate_limit": self.candidate_limit,
+        })
+        result = await execute(query)
+        return [
+            SearchHit(
+                record_id=row["record_id"],
+                page_index=row.get("page_index") or 0,
+                text=row.get("extracted_text") or "",
+                score=row.get("score") or 0,
+                uploaded_at=row.get("uploaded_at") or "",
+            )
+            for row in result.data
+        ]
+
+
+class InMemorySearchIndex(SearchBackend):
+    """文字バイグラムの転置インデックス（テスト・ローカル開発用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (record_id, page_index) -> (テキスト, アップロード日時)
+        self._documents: Dict[Tuple[str, int], Tuple[str, str]] = {}
+        # 1文字・2文字の部分文字列 -> それを含む文書
+        self._postings: Dict[str, Set[Tuple[str, int]]] = {}
+
+    @staticmethod
+    def _grams(text: str) -> Set[str]:
+        lowered = text.lower()
+        grams = set(lowered)
+        grams.update(lowered[i:i + 2] for i in range(len(lowered) - 1))
+        return grams
+
+    def add(self, record_id: str, page_index: int, text: str, uploaded_at: str = "") -> None:
+        key = (record_id, page_index)
+        with self._lock:
+            self._remove_locked(key)
+            self._documents[key] = (text, uploaded_at)
+            for gram in self._grams(text):
+                self._postings.setdefault(gram, set()).add(key)
+
+    def remove_record(self, record_id: str) -> None:
+        with self._lock:
+            for key in [key for key in self._documents if key[0] == record_id]:
+                self._remove_locked(key)
+
+    def _remove_locked(self, key: Tuple[str, int]) -> None:
+        document = self._documents.pop(key, None)
+        if document is None:
+            return
+        for gram in self._grams(document[0]):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(key)
+                if not postings:
+                    del self._postings[gram]
+
+    def _candidates(self, term: str) -> Set[Tuple[str, int]]:
+        lowered = term.lower()
+        grams = [lowered] if len(lowered) == 1 else [lowered[i:i + 2] for i in range(len(lowered) - 1)]
+        candidates = None
+        for gram in grams:
+            postings = self._postings.get(gram, set())
+            candidates = set(postings) if candidates is None else candidates & postings
+            if not candidates:
+                return set()
+        return candidates or set()
+
+    def search_sync(self, terms: List[str], limit: int, offset: int = 0) -> List[SearchHit]:
+        if not terms:
+            return []
+        with self._lock:
+            candidates = None
+            for term in terms:
+                matches = self._candidates(term)
+                candidates = matches if candidates is None else candidates & matches
+            hits = []
+            for key in candidates or ():
+                text, uploaded_at = self._documents[key]
+                # バイグラムが揃っていても連続しているとは限らないため、部分一致で確認する
+                lowered = text.lower()
+                if all(term.lower() in lowered for term in terms):
+                    hits.append(SearchHit(key[0], key[1], text, count_occurrences(text, terms), uploaded_at))
+        hits.sort(key=lambda hit: (hit.record_id, hit.page_index))
+        hits.sort(key=lambda hit: (hit.score, hit.uploaded_at), reverse=True)
+        return hits[offset:offset + limit]
+
+    async def search(self, terms: List[str], limit: int, offset: int = 0) -> List[SearchHit]:
+        return self.search_sync(terms, limit, offset)
+
+    async def index_pages(self, record_id: str, pages: List[str], uploaded_at: str = "") -> None:
+        # 再処理された場合は古い結果を置き換える
+        self.remove_record(record_id)
+        for page_index, text in enumerate(pages):
+            self.add(record_id, page_index, text or "", uploaded_at)
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+
+def create_search_backend(kind: str, get_client, candidate_limit: int = 1000) -> SearchBackend:
+    """設定値から検索バックエンドを生成する"""
+    if kind == "supabase":
+        return SupabaseSearchBackend(get_client, candidate_limit)
+    if kind == "memory":
+        return InMemorySearchIndex()
+    raise ValueError(f"Unknown search backend: {kind}")
@@ -0,0 +1,52 @@
+"""同時に実行された同じ処理の集約（single-flight）
+
+同じキーの処理が実行中の場合は新たに実行せず、実行中の処理の結果（例外を含む）を共有する。
+同じ画像のOCR（Gemini APIの呼び出し）や、同じカルテへの再処理リクエストの重複を防ぐ。
+結果は保持しない（完了後に同じキーで呼び出すと再度実行する）。
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つにまとめる"""
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """key の処理が実行中ならその結果を待ち、なければ fn を実行する"""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.shared += 1
+            # 待機側がキャンセルされても実行中の処理は止めない
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self.executed += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 待機者がいない場合に「取得されなかった例外」の警告を出さない
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._in_flight), "executed": self.executed, "shared": self.shared}
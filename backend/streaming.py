@@ -0,0 +1,63 @@
+"""Gemini APIのストリーミング出力
+
+生成途中のテキストを受け取りながら、一定間隔ごとにまとめて通知する（チャンクごとには通知しない）。
+長いカルテでも最初の数行を1〜2秒で表示できるようにする。
+"""
+import time
+from typing import Callable, List, Optional, Tuple
+
+
+class PartialTextFlusher:
+    """受信したテキストを蓄積し、一定間隔・一定文字数ごとにまとめて通知する"""
+
+    def __init__(self, on_flush: Callable[[str], None], interval: float = 0.5, min_chars: int = 200):
+        self.on_flush = on_flush
+        self.interval = interval
+        self.min_chars = min_chars
+        self._parts: List[str] = []
+        self._length = 0
+        self._flushed_length = 0
+        self._last_flush: Optional[float] = None
+        self.flushes = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def append(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        self._length += len(chunk)
+        now = time.monotonic()
+        # 最初のチャンクはすぐに通知し、以降は間隔か文字数のどちらかを満たしたときに通知する
+        if (
+            self._last_flush is None
+            or now - self._last_flush >= self.interval
+            or self._length - self._flushed_length >= self.min_chars
+        ):
+            self.flush(now)
+
+    def flush(self, now: Optional[float] = None) -> None:
+        if self._length == self._flushed_length:
+            return
+        self._last_flush = now if now is not None else time.monotonic()
+        self._flushed_length = self._length
+        self.flushes += 1
+        self.on_flush(self.text)
+
+
+def chunk_text(chunk) -> str:
+    """ストリームのチャンクからテキストを取り出す（終了理由だけのチャンクは空文字）"""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+async def generate_streaming(model, contents, generation_config, flusher: PartialTextFlusher) -> Tuple[str, object]:
+    """ストリーミングで生成し、全文とレスポンス（usage_metadata参照用）を返す"""
+    response = await model.generate_content_async(contents, generation_config=generation_config, stream=True)
+    async for chunk in response:
+        flusher.append(chunk_text(chunk))
+    return flusher.text, response
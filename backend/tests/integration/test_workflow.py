@@ -120,7 +120,7 @@ def test_error_handling_invalid_file():
     # 400エラーが返ることを確認
     assert response.status_code == 400
     assert "detail" in response.json()
-    assert "Only JPG and PNG files are allowed" in response.json()["detail"]
+    assert "Only JPG, PNG, PDF and TIFF files are allowed" in response.json()["detail"]
 
 
 @pytest.mark.skipif(not os.environ.get("RUN_INTEGRATION_TESTS"), reason="Integration tests disabled")
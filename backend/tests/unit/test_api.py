@@ -1,6 +1,6 @@
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 from main import app
 
@@ -96,8 +96,8 @@ def test_get_record_by_id(mock_get_supabase, mock_supabase):
 
 
 @patch("main.get_supabase")
-@patch("main.asyncio.create_task")
-def test_reprocess_record(mock_create_task, mock_get_supabase, mock_supabase):
+@patch("main.job_queue.enqueue")
+def test_reprocess_record(mock_enqueue, mock_get_supabase, mock_supabase):
     """POST /api/process/{record_id} エンドポイントのテスト"""
     # Supabaseのモック設定
     mock_get_supabase.return_value = mock_supabase
@@ -120,15 +120,15 @@ def test_reprocess_record(mock_create_task, mock_get_supabase, mock_supabase):
     mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value = mock_record_result
     mock_supabase.table.return_value.update.return_value.eq.return_value.execute.return_value = mock_update_result
     
-    # httpxクライアントのモック
-    with patch("httpx.AsyncClient") as mock_client:
+    # 共有httpxクライアントのモック
+    with patch("main.clients.http") as mock_http:
         mock_client_instance = MagicMock()
-        mock_client.return_value.__aenter__.return_value = mock_client_instance
+        mock_http.return_value = mock_client_instance
         
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.content = b"test image data"
-        mock_client_instance.get.return_value = mock_response
+        mock_client_instance.get = AsyncMock(return_value=mock_response)
         
         # APIリクエスト実行
         response = client.post("/api/process/550e8400-e29b-41d4-a716-446655440000")
@@ -139,5 +139,5 @@ def test_reprocess_record(mock_create_task, mock_get_supabase, mock_supabase):
         assert response.json()["status"] == "processing"
         assert response.json()["record_id"] == "550e8400-e29b-41d4-a716-446655440000"
         
-        # 非同期タスクが作成されたことを確認
-        assert mock_create_task.called
\ No newline at end of file
+        # OCRジョブがキューに投入されたことを確認
+        assert mock_enqueue.called
\ No newline at end of file
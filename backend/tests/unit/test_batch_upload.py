@@ -0,0 +1,97 @@
+import io
+import zipfile
+from fastapi.testclient import TestClient
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import main
+
+
+def make_supabase(record_count):
+    """一括insertで record_count 件を返すSupabaseのモック"""
+    mock_supabase = MagicMock()
+    mock_supabase.storage.from_.return_value.get_public_url.side_effect = lambda path: f"http://example.com/{path}"
+    mock_result = MagicMock()
+    mock_result.data = [{"id": f"record-{i}"} for i in range(record_count)]
+    mock_supabase.table.return_value.insert.return_value.execute.return_value = mock_result
+    return mock_supabase
+
+
+@patch("main.job_queue.enqueue", new_callable=AsyncMock)
+def test_batch_upload_inserts_records_in_one_call(mock_enqueue):
+    """バッチアップロードは1回のinsertで全レコードを作成し、全件をキューに投入する"""
+    mock_supabase = make_supabase(2)
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        client = TestClient(main.app)
+        files = [
+            ("files", ("a.jpg", b"image a", "image/jpeg")),
+            ("files", ("b.png", b"image b", "image/png")),
+            ("files", ("notes.txt", b"text", "text/plain")),
+        ]
+        response = client.post("/api/upload/batch", files=files)
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    data = response.json()
+    assert "batch_id" in data
+    assert [f["status"] for f in data["files"]] == ["processing", "processing", "rejected"]
+    assert [f["record_id"] for f in data["files"][:2]] == ["record-0", "record-1"]
+
+    inserted = mock_supabase.table.return_value.insert.call_args.args[0]
+    assert len(inserted) == 2
+    assert all(row["batch_id"] == data["batch_id"] for row in inserted)
+    assert mock_supabase.table.return_value.insert.call_count == 1
+    assert mock_enqueue.call_count == 2
+
+
+@patch("main.job_queue.enqueue", new_callable=AsyncMock)
+def test_batch_upload_expands_zip(mock_enqueue):
+    """ZIPファイルは展開され、中の画像が個別にアップロードされる"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("scans/page1.jpg", b"page 1")
+        archive.writestr("scans/page2.jpg", b"page 2")
+        archive.writestr("scans/", b"")
+    mock_supabase = make_supabase(2)
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        client = TestClient(main.app)
+        files = [("files", ("scans.zip", buffer.getvalue(), "application/zip"))]
+        response = client.post("/api/upload/batch", files=files)
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    names = [f["filename"] for f in response.json()["files"]]
+    assert names == ["scans.zip/scans/page1.jpg", "scans.zip/scans/page2.jpg"]
+    assert mock_supabase.storage.from_.return_value.upload.call_count == 2
+
+
+def test_batch_upload_rejects_too_many_files_before_reading(monkeypatch):
+    """上限を超えるバッチは、ファイルを読み込む・ZIPを展開する前に拒否する"""
+    monkeypatch.setattr(main, "max_batch_files", 2)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for i in range(3):
+            archive.writestr(f"page{i}.jpg", b"page")
+    main.app.dependency_overrides[main.get_supabase] = lambda: make_supabase(0)
+    try:
+        client = TestClient(main.app)
+        with patch("main.spool_upload", wraps=main.spool_upload) as mock_spool, \
+                patch("main.spool_stream", wraps=main.spool_stream) as mock_stream:
+            too_many = client.post("/api/upload/batch", files=[
+                ("files", (f"{name}.jpg", b"image", "image/jpeg")) for name in "abc"
+            ])
+            assert mock_spool.call_count == 0
+            expanded = client.post("/api/upload/batch", files=[
+                ("files", ("a.jpg", b"image", "image/jpeg")),
+                ("files", ("scans.zip", buffer.getvalue(), "application/zip")),
+            ])
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert too_many.status_code == expanded.status_code == 400
+    # ZIPの中の画像は取り出さない（1つ目の画像とZIP自体だけを一時ファイルに退避する）
+    assert mock_spool.call_count == 2
+    mock_stream.assert_not_called()
@@ -0,0 +1,80 @@
+import asyncio
+
+import main
+from benchmarks import import_time
+from benchmarks.fakes import FakeSupabase, LatencyProfile
+from benchmarks.import_time import measure_once
+from benchmarks.run import BenchmarkConfig, percentile, run_benchmark
+
+
+def quick_config(**overrides) -> BenchmarkConfig:
+    """遅延なしで数件だけ実行する設定"""
+    values = dict(
+        uploads=4, concurrency=2, poll_interval=0.01, timeout=30, gemini_latency=0, gemini_jitter=0,
+        db_latency=0, storage_latency=0, download_latency=0, image_size=200,
+    )
+    values.update(overrides)
+    return BenchmarkConfig(**values)
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 95) == 0.0
+
+
+def test_fake_supabase_embeds_extracted_data():
+    """埋め込みの select("*, extracted_data(*)") で子テーブルの行も返す"""
+    db = FakeSupabase(LatencyProfile())
+    record = db.table("medical_records").insert({"original_image_url": "u"}).execute().data[0]
+    db.table("extracted_data").insert({"record_id": record["id"], "extracted_text": "text"}).execute()
+
+    row = db.table("medical_records").select("*, extracted_data(*)").eq("id", record["id"]).execute().data[0]
+
+    assert row["processing_status"] == "pending"
+    assert [item["extracted_text"] for item in row["extracted_data"]] == ["text"]
+
+
+def test_benchmark_completes_all_uploads_by_polling():
+    clients = main.clients
+    result = asyncio.run(run_benchmark(quick_config()))
+
+    assert result["outcomes"] == {"completed": 4}
+    assert result["end_to_end_latency"]["count"] == 4
+    assert result["gemini"]["calls"] == 4
+    assert "gemini" in result["stage_timings"]
+    # 差し替えたクライアントは元に戻る
+    assert main.clients is clients
+
+
+def test_benchmark_waits_with_sse():
+    result = asyncio.run(run_benchmark(quick_config(wait="sse", uploads=2, streaming=False)))
+
+    assert result["outcomes"] == {"completed": 2}
+
+
+def test_main_import_does_not_load_sdks():
+    """main の読み込み時には Gemini・Supabase のSDKを import しない（初回の使用時に読み込む）"""
+    sample = measure_once()
+
+    assert sample["loaded"] == []
+    # デフォルトの設定でもキャッシュのDBは最初に使うときに作る
+    assert sample["created"] == []
+    assert sample["app_seconds"] < sample["total_seconds"]
+
+
+def test_import_time_budget_fails_when_exceeded(monkeypatch):
+    """中央値が予算を超えた場合や、SDKが読み込み時に import された場合は失敗にする"""
+    samples = iter([
+        {"app_seconds": 0.2, "total_seconds": 0.9, "loaded": [], "created": []},
+        {"app_seconds": 0.4, "total_seconds": 1.1, "loaded": [], "created": []},
+        {"app_seconds": 0.1, "total_seconds": 0.8, "loaded": ["supabase"], "created": []},
+    ])
+    monkeypatch.setattr(import_time, "measure_once", lambda: next(samples))
+
+    result = import_time.run(runs=3, budget=0.3)
+
+    assert result["app_seconds"] == 0.2
+    assert result["eagerly_loaded"] == ["supabase"]
+    assert not result["ok"]
@@ -0,0 +1,122 @@
+import asyncio
+import errno
+import io
+import os
+import sqlite3
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+import ingest
+import main
+from blob_cache import BlobCache
+from ingest import spool_stream
+
+
+@pytest.fixture
+def spool_dir(tmp_path):
+    """一時ファイルの保存先をテストごとに分ける"""
+    with patch.object(ingest, "_spool_dir", str(tmp_path / "spool")):
+        yield tmp_path / "spool"
+
+
+@pytest.fixture
+def blob_cache(tmp_path, spool_dir, monkeypatch):
+    cache = BlobCache(str(tmp_path / "blobs"), max_bytes=10_000)
+    monkeypatch.setattr(main, "blob_cache", cache)
+    yield cache
+    cache.close()
+
+
+def spooled(data: bytes):
+    return spool_stream(io.BytesIO(data), max_size=100_000, filename="chart.jpg")
+
+
+def mock_http(handler):
+    """ストレージへのリクエストを handler で処理する共有httpxクライアント"""
+    return patch.object(main.clients, "http", return_value=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+def test_checkout_survives_worker_cleanup(blob_cache):
+    """取り出した一時ファイルを削除してもキャッシュには残り、URLからも引ける"""
+    image = spooled(b"a" * 100)
+    blob_cache.put(image, "http://storage/a.jpg", etag='"v1"')
+    image.cleanup()
+
+    assert blob_cache.lookup("http://storage/a.jpg") == (image.sha256, '"v1"')
+    first = blob_cache.checkout(image.sha256, "a.jpg")
+    first.cleanup()
+    second = blob_cache.checkout(image.sha256, "a.jpg")
+
+    assert second.read() == b"a" * 100
+    assert second.path != first.path
+    assert blob_cache.stats()["hits"] == 2
+
+
+def test_evicts_least_recently_used_blobs(blob_cache):
+    """合計サイズが上限を超えると最終アクセスが古いものから削除する"""
+    images = [spooled(bytes([i]) * 4000) for i in range(3)]
+    blob_cache.put(images[0])
+    blob_cache.put(images[1])
+    blob_cache.checkout(images[0].sha256).cleanup()
+    blob_cache.put(images[2])
+
+    assert blob_cache.lookup("", images[0].sha256) is not None
+    assert blob_cache.lookup("", images[1].sha256) is None
+    assert not os.path.exists(blob_cache.path_for(images[1].sha256))
+    assert blob_cache.stats()["bytes"] == 8000
+
+
+def test_download_image_uses_cache_by_hash(blob_cache):
+    """画像のハッシュが分かる場合は、キャッシュにあればストレージに問い合わせない"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, content=b"downloaded", headers={"ETag": '"v1"'})
+
+    with mock_http(handler):
+        image = asyncio.run(main.download_image("http://storage/a.jpg"))
+        again = asyncio.run(main.download_image("http://storage/a.jpg", image.sha256))
+
+    assert len(requests) == 1
+    assert again.read() == b"downloaded"
+
+
+def test_download_image_revalidates_with_etag(blob_cache, monkeypatch):
+    """ハッシュが分からない場合はETagで変更を確認し、304ならキャッシュを使う"""
+    monkeypatch.setattr(main, "blob_cache_revalidate", True)
+    blob_cache.put(spooled(b"cached"), "http://storage/a.jpg", etag='"v1"')
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(304)
+
+    with mock_http(handler):
+        image = asyncio.run(main.download_image("http://storage/a.jpg"))
+
+    assert image.read() == b"cached"
+    assert requests[0].headers["If-None-Match"] == '"v1"'
+
+
+def test_download_image_falls_back_to_storage_when_cache_fails(blob_cache):
+    """キャッシュからの取り出しや索引の参照に失敗した場合は、キャッシュにないものとしてダウンロードする"""
+    cached = spooled(b"cached")
+    blob_cache.put(cached, "http://storage/a.jpg")
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, content=b"downloaded")
+
+    with mock_http(handler):
+        with patch("ingest.link_or_copy", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            linked = asyncio.run(main.download_image("http://storage/a.jpg", cached.sha256))
+        with patch.object(blob_cache, "_db", side_effect=sqlite3.OperationalError("database is locked")):
+            locked = asyncio.run(main.download_image("http://storage/a.jpg"))
+
+    assert linked.read() == locked.read() == b"downloaded"
+    assert len(requests) == 2
+    assert blob_cache.stats()["misses"] == 2
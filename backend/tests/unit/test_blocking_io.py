@@ -0,0 +1,37 @@
+import asyncio
+import time
+from unittest.mock import MagicMock
+
+from blocking_io import execute, run_blocking
+
+
+def test_run_blocking_does_not_stall_event_loop():
+    """同期処理の実行中もイベントループは他の処理を進められる"""
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        result = await run_blocking(lambda: time.sleep(0.2) or "done")
+        task.cancel()
+        return result, ticks
+
+    result, ticks = asyncio.run(scenario())
+    assert result == "done"
+    assert ticks >= 5
+
+
+def test_execute_runs_query_in_thread_pool():
+    """execute() はクエリの execute() を呼び出して結果を返す"""
+    query = MagicMock()
+    query.execute.return_value.data = [{"id": "1"}]
+
+    result = asyncio.run(execute(query))
+
+    query.execute.assert_called_once_with()
+    assert result.data == [{"id": "1"}]
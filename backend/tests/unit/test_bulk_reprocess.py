@@ -0,0 +1,223 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from fastapi.testclient import TestClient
+
+import main
+from bulk_reprocess import BulkFilter, BulkReprocessor
+from pagination import decode_cursor
+
+
+def make_rows(start, count):
+    return [
+        {"id": f"record-{i:02d}", "original_image_url": f"http://example.com/{i}.jpg",
+         "image_sha256": f"sha-{i}", "uploaded_at": f"2025-03-04T12:{59 - i:02d}:00+00:00"}
+        for i in range(start, start + count)
+    ]
+
+
+def mock_records_query(pages):
+    """medical_records の検索結果をページごとに返すSupabaseのモック"""
+    mock_supabase = MagicMock()
+    query = mock_supabase.table.return_value.select.return_value
+    for method in ("eq", "neq", "gte", "lt", "or_", "order", "limit"):
+        getattr(query, method).return_value = query
+    query.execute.side_effect = [MagicMock(data=page) for page in pages]
+    return mock_supabase, query
+
+
+def test_run_schedules_batches_and_saves_cursor():
+    """バッチごとに投入し、最後に投入したカルテのカーソルを保存して次のバッチはその後ろから取得する"""
+    rows = make_rows(0, 3)
+    mock_supabase, query = mock_records_query([rows[:2], rows[2:], []])
+    schedule = AsyncMock(side_effect=lambda batch, run_id, bypass_cache: len(batch) - 1)
+    reprocessor = BulkReprocessor(lambda: mock_supabase, schedule, AsyncMock())
+    run = {"id": "run-1", "filter": {"status": "failed"}, "batch_size": 2, "bypass_cache": True}
+
+    asyncio.run(reprocessor._run(run))
+
+    assert [call.args[0] for call in schedule.call_args_list] == [rows[:2], rows[2:]]
+    assert schedule.call_args.args[1:] == ("run-1", True)
+    query.eq.assert_any_call("processing_status", "failed")
+    query.limit.assert_called_with(2)
+    # 2回目以降は前のバッチの最後の行より後ろを取得する
+    assert query.or_.call_count == 2
+    updates = [call.args[0] for call in mock_supabase.table.return_value.update.call_args_list]
+    progress = [update for update in updates if "cursor" in update]
+    assert decode_cursor(progress[0]["cursor"])["id"] == "record-01"
+    assert (progress[1]["scheduled"], progress[1]["skipped"]) == (1, 2)
+    assert updates[-1]["status"] == "completed"
+    # 進捗・完了は実行中の場合だけ保存する
+    mock_supabase.table.return_value.update.return_value.eq.return_value.eq.assert_called_with("status", "running")
+    assert not reprocessor.is_running("run-1")
+
+
+def test_resume_continues_running_runs():
+    """前回のプロセスで実行中だった一括再処理を保存したカーソルから再開する"""
+    saved = {"id": "run-1", "status": "running", "filter": {}, "batch_size": 10, "cursor": None, "scheduled": 5}
+    mock_supabase = MagicMock()
+    runs_query = mock_supabase.table.return_value.select.return_value
+    runs_query.eq.return_value = runs_query
+    runs_query.order.return_value = runs_query
+    runs_query.execute.return_value = MagicMock(data=[saved])
+    reprocessor = BulkReprocessor(lambda: mock_supabase, AsyncMock(), AsyncMock())
+
+    async def scenario():
+        with patch.object(reprocessor, "_run", AsyncMock()) as mock_run:
+            resumed = await reprocessor.resume()
+            await asyncio.sleep(0)
+            return resumed, mock_run
+
+    resumed, mock_run = asyncio.run(scenario())
+
+    assert resumed == 1
+    mock_run.assert_awaited_once_with(saved)
+
+
+def test_schedule_skips_queued_records_and_updates_in_bulk():
+    """キュー投入済みのカルテは除き、残りは1回の更新でまとめて状態を変更してから投入する"""
+    rows = make_rows(0, 3)
+    mock_supabase = MagicMock()
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch.object(main.job_queue, "has_record", side_effect=lambda record_id: record_id == "record-01"), \
+            patch("main.enqueue_ocr_job", new_callable=AsyncMock) as mock_enqueue:
+        scheduled = asyncio.run(main.schedule_bulk_reprocess(rows, "run-1", False))
+
+    assert scheduled == 2
+    update = mock_supabase.table.return_value.update
+    update.assert_called_once_with({"processing_status": "pending", "reprocess_run_id": "run-1"})
+    update.return_value.in_.assert_called_once_with("id", ["record-00", "record-02"])
+    assert [call.args[0] for call in mock_enqueue.call_args_list] == ["record-00", "record-02"]
+    assert mock_enqueue.call_args.kwargs["image_sha256"] == "sha-2"
+
+
+def test_start_endpoint_validates_and_builds_filter():
+    """日時・処理状態を検証し、outdated=true では現在のOCR設定以外で処理したカルテを対象にする"""
+    main.app.dependency_overrides[main.get_supabase] = lambda: MagicMock()
+    try:
+        client = TestClient(main.app)
+        assert client.post("/api/process/bulk", params={"uploaded_from": "yesterday"}).status_code == 400
+        assert client.post("/api/process/bulk", params={"status": "unknown"}).status_code == 400
+
+        with patch.object(main.bulk_reprocessor, "start", AsyncMock(
+            return_value={"id": "run-1", "status": "running", "total": 42}
+        )) as mock_start:
+            response = client.post("/api/process/bulk", params={
+                "status": "completed", "uploaded_from": "2025-03-01", "outdated": "true", "batch_size": 200,
+            })
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    assert response.json()["total"] == 42
+    bulk_filter = mock_start.call_args.args[0]
+    assert bulk_filter == BulkFilter(
+        status="completed", uploaded_from="2025-03-01T00:00:00+00:00",
+        exclude_ocr_version=main.current_ocr_version(),
+    )
+    assert mock_start.call_args.kwargs == {"bypass_cache": False, "batch_size": 200}
+
+
+def test_resume_skips_runs_taken_over_by_another_process():
+    """同時に起動した他のプロセスが先に再開した一括再処理は再開しない"""
+    saved = {"id": "run-1", "status": "running", "filter": {}, "updated_at": "2025-03-04T12:00:00+00:00"}
+    mock_supabase = MagicMock()
+    runs_query = mock_supabase.table.return_value.select.return_value
+    runs_query.eq.return_value = runs_query
+    runs_query.order.return_value = runs_query
+    runs_query.execute.return_value = MagicMock(data=[saved])
+    take_over = mock_supabase.table.return_value.update.return_value.eq.return_value.eq
+    take_over.return_value.execute.return_value = MagicMock(data=[])
+    reprocessor = BulkReprocessor(lambda: mock_supabase, AsyncMock(), AsyncMock())
+
+    with patch.object(reprocessor, "_launch") as mock_launch:
+        resumed = asyncio.run(reprocessor.resume())
+
+    assert resumed == 0
+    take_over.assert_called_once_with("updated_at", saved["updated_at"])
+    mock_launch.assert_not_called()
+
+
+def test_resume_leaves_runs_driven_by_live_processes():
+    """最近進捗を更新した一括再処理は、他のプロセスが実行中なので引き継がない"""
+    saved = {"id": "run-1", "status": "running", "filter": {}, "updated_at": datetime.now(timezone.utc).isoformat()}
+    mock_supabase = MagicMock()
+    runs_query = mock_supabase.table.return_value.select.return_value
+    runs_query.eq.return_value = runs_query
+    runs_query.order.return_value = runs_query
+    runs_query.execute.return_value = MagicMock(data=[saved])
+    reprocessor = BulkReprocessor(lambda: mock_supabase, AsyncMock(), AsyncMock(), stale_after=60)
+
+    with patch.object(reprocessor, "_launch") as mock_launch:
+        resumed = asyncio.run(reprocessor.resume())
+
+    assert resumed == 0
+    mock_supabase.table.return_value.update.assert_not_called()
+    mock_launch.assert_not_called()
+
+
+def test_run_heartbeats_while_waiting_for_capacity():
+    """キューの空きを待つ間も updated_at を更新する"""
+    rows = make_rows(0, 1)
+    mock_supabase, _ = mock_records_query([rows, []])
+
+    async def wait_for_capacity(count):
+        await asyncio.sleep(0.05)
+
+    reprocessor = BulkReprocessor(lambda: mock_supabase, AsyncMock(return_value=1), wait_for_capacity, stale_after=0.03)
+
+    asyncio.run(reprocessor._run({"id": "run-1", "filter": {}, "batch_size": 1}))
+
+    updates = [call.args[0] for call in mock_supabase.table.return_value.update.call_args_list]
+    assert set(updates[0]) == {"updated_at"}
+    assert updates[-1]["status"] == "completed"
+
+
+class FakeRunsTable:
+    """reprocess_runs の1行を複数のプロセスで共有する（条件付きの更新を再現する）"""
+
+    def __init__(self, row):
+        self.row = row
+        self.updates = []
+
+    def update(self, values):
+        filters = {}
+        table = self
+
+        class Query:
+            def eq(self, column, value):
+                filters[column] = value
+                return self
+
+            def execute(self):
+                if any(table.row.get(column) != value for column, value in filters.items()):
+                    return MagicMock(data=[])
+                table.row.update(values)
+                table.updates.append(values)
+                return MagicMock(data=[table.row])
+
+        return Query()
+
+
+def test_run_stops_when_cancelled_by_another_process():
+    """他のプロセスで中止された一括再処理は次のバッチを投入せず、完了で上書きしない"""
+    rows = make_rows(0, 4)
+    records, _ = mock_records_query([rows[:2], rows[2:], []])
+    runs = FakeRunsTable({"id": "run-1", "status": "running"})
+    client = MagicMock()
+    client.table.side_effect = lambda name: runs if name == "reprocess_runs" else records.table(name)
+    process_b = BulkReprocessor(lambda: client, AsyncMock(), AsyncMock())
+
+    async def schedule(batch, run_id, bypass_cache):
+        # プロセスAが1つ目のバッチを投入している間に、プロセスBが中止する
+        await process_b.cancel(run_id)
+        return len(batch)
+
+    process_a = BulkReprocessor(lambda: client, schedule, AsyncMock())
+
+    asyncio.run(process_a._run({"id": "run-1", "filter": {}, "batch_size": 2}))
+
+    assert runs.row["status"] == "cancelled"
+    assert "cursor" not in runs.row
+    assert "completed" not in [update.get("status") for update in runs.updates]
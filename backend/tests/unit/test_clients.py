@@ -0,0 +1,45 @@
+import asyncio
+from unittest.mock import patch, MagicMock
+
+from clients import ClientRegistry
+
+
+@patch("clients.httpx.Client")
+@patch("supabase.create_client")
+def test_supabase_client_is_created_once(mock_create_client, mock_http_client):
+    """Supabaseクライアントはプロセス内で1度だけ生成される"""
+    registry = ClientRegistry("https://example.supabase.co", "key")
+
+    first = registry.supabase()
+    second = registry.supabase()
+
+    assert first is second
+    assert mock_create_client.call_count == 1
+    # PostgRESTのセッションは接続数上限付きのものに差し替えられる
+    assert mock_http_client.call_args.kwargs["limits"] is registry.limits
+
+
+@patch("google.generativeai.configure")
+@patch("google.generativeai.GenerativeModel")
+def test_model_is_cached_per_name(mock_model, mock_configure):
+    """GenerativeModel はモデル名ごとに使い回され、APIキーは初回の生成時に1度だけ設定される"""
+    mock_model.side_effect = lambda name: MagicMock(name=name)
+    registry = ClientRegistry(None, None, gemini_api_key="gemini-key")
+
+    assert registry.model("gemini-1.5-pro") is registry.model("gemini-1.5-pro")
+    assert registry.model("gemini-1.5-flash") is not registry.model("gemini-1.5-pro")
+    assert mock_model.call_count == 2
+    mock_configure.assert_called_once_with(api_key="gemini-key")
+
+
+def test_http_client_is_shared_and_closed():
+    """httpxクライアントは共有され、aclose() で閉じられる"""
+    async def scenario():
+        registry = ClientRegistry(None, None, http_max_connections=5, http_max_keepalive=2)
+        client = registry.http()
+        assert registry.http() is client
+        await registry.aclose()
+        return client
+
+    client = asyncio.run(scenario())
+    assert client.is_closed
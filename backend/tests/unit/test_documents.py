@@ -0,0 +1,82 @@
+import asyncio
+import io
+from PIL import Image
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import main
+from documents import count_pages, split_document
+from preprocess import ImagePreprocessor, PreprocessResult, PreprocessSettings
+
+
+def make_tiff(path, page_count):
+    """テスト用のマルチページTIFFを作成する"""
+    pages = [Image.new("RGB", (300, 200), (i * 40, 0, 0)) for i in range(page_count)]
+    pages[0].save(path, format="TIFF", save_all=True, append_images=pages[1:])
+
+
+def make_pdf(path, page_count):
+    """テスト用の複数ページPDFを作成する"""
+    pages = [Image.new("RGB", (300, 200), "white") for _ in range(page_count)]
+    pages[0].save(path, format="PDF", save_all=True, append_images=pages[1:])
+
+
+def test_split_multipage_tiff(tmp_path):
+    """マルチページTIFFはページごとのJPEG画像に分割される"""
+    path = str(tmp_path / "fax.tif")
+    make_tiff(path, 3)
+    preprocessor = ImagePreprocessor(PreprocessSettings(), workers=2)
+    try:
+        pages = asyncio.run(split_document(preprocessor, path, "image/tiff"))
+    finally:
+        preprocessor.shutdown()
+
+    assert len(pages) == 3
+    assert all(page.mime_type == "image/jpeg" for page in pages)
+    with Image.open(io.BytesIO(pages[0].data)) as image:
+        assert image.size == (300, 200)
+
+
+def test_split_pdf(tmp_path):
+    """PDFはページ数を数え、指定DPIでページ画像に変換される"""
+    path = str(tmp_path / "chart.pdf")
+    make_pdf(path, 2)
+    assert count_pages(path, "application/pdf") == 2
+
+    preprocessor = ImagePreprocessor(PreprocessSettings(max_dimension=4000), workers=1)
+    try:
+        pages = asyncio.run(split_document(preprocessor, path, "application/pdf", dpi=144))
+    finally:
+        preprocessor.shutdown()
+
+    assert len(pages) == 2
+    assert pages[0].width > 0 and pages[0].height > 0
+
+
+def test_process_document_saves_pages_in_one_upsert():
+    """ページごとに並列でOCRし、ページ番号付きで一括保存する"""
+    pages = [PreprocessResult(f"page {i}".encode(), "image/jpeg", 6, 6) for i in range(3)]
+    mock_supabase = MagicMock()
+
+    async def fake_extract_text(image_bytes, language="ja", **kwargs):
+        return image_bytes.decode().upper()
+
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch("main.extract_text", side_effect=fake_extract_text):
+        asyncio.run(main.process_document("record-1", "http://example.com/a.pdf", pages))
+
+    rows = mock_supabase.table.return_value.upsert.call_args.args[0]
+    assert [row["page_index"] for row in rows] == [0, 1, 2]
+    assert [row["extracted_text"] for row in rows] == ["PAGE 0", "PAGE 1", "PAGE 2"]
+    assert mock_supabase.table.return_value.upsert.call_count == 1
+    statuses = [call.args[0] for call in mock_supabase.table.return_value.update.call_args_list]
+    assert statuses[0] == {"processing_status": "processing", "page_count": 3}
+    assert statuses[-1] == {"processing_status": "completed", "ocr_version": main.current_ocr_version()}
+
+
+def test_assemble_document_text_orders_pages():
+    """ページ順に連結される"""
+    rows = [
+        {"page_index": 1, "extracted_text": "2ページ目"},
+        {"page_index": 0, "extracted_text": "1ページ目"},
+    ]
+    assert main.assemble_document_text(rows) == "1ページ目\n\n2ページ目"
@@ -0,0 +1,117 @@
+import asyncio
+import json
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import main
+from events import RecordEventBus
+
+
+def parse_events(chunks):
+    """SSEのチャンクからstatusイベントのデータを取り出す"""
+    return [
+        json.loads(chunk.split("data: ", 1)[1])
+        for chunk in chunks
+        if chunk.startswith("event: status")
+    ]
+
+
+def test_bus_delivers_to_subscribers_and_keeps_latest():
+    """購読中のキューに配信し、直近の状態を保持する"""
+    async def scenario():
+        bus = RecordEventBus(max_recent=1)
+        queue = bus.subscribe("a")
+        bus.publish("a", "processing")
+        bus.publish("b", "pending")
+        event = queue.get_nowait()
+        bus.unsubscribe("a", queue)
+        return bus, event
+
+    bus, event = asyncio.run(scenario())
+    assert event["processing_status"] == "processing"
+    assert bus.latest("a") is None  # 件数上限で古いものから削除される
+    assert bus.latest("b")["processing_status"] == "pending"
+    assert bus.stats()["subscribers"] == 0
+
+
+def test_stream_ends_on_completion_without_polling_db(monkeypatch):
+    """処理中のレコードは完了の通知まで待ち、DBへの問い合わせは最初の1回だけ"""
+    bus = RecordEventBus()
+    monkeypatch.setattr(main, "record_events", bus)
+    mock_supabase = MagicMock()
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value = MagicMock(
+        data=[{"id": "record-1", "processing_status": "processing", "page_count": 1}]
+    )
+    request = MagicMock()
+    request.is_disconnected = AsyncMock(return_value=False)
+
+    async def scenario():
+        response = await main.stream_record_events("record-1", request, mock_supabase)
+        chunks = []
+
+        async def consume():
+            async for chunk in response.body_iterator:
+                chunks.append(chunk)
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        bus.publish("record-1", "completed")
+        await asyncio.wait_for(consumer, timeout=1)
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    statuses = [event["processing_status"] for event in parse_events(chunks)]
+    assert statuses == ["processing", "completed"]
+    assert mock_supabase.table.return_value.select.return_value.eq.return_value.execute.call_count == 1
+    assert bus.stats()["subscribers"] == 0
+
+
+def test_stream_polls_db_when_workers_run_elsewhere(monkeypatch):
+    """ワーカーが別のプロセスの場合は、DBの処理状態の変化を配信する"""
+    monkeypatch.setattr(main, "record_events", RecordEventBus())
+    monkeypatch.setattr(main.job_queue.backend, "distributed", True, raising=False)
+    monkeypatch.setattr(main, "sse_poll_seconds", 0.01)
+    mock_supabase = MagicMock()
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.side_effect = [
+        MagicMock(data=[{"id": "record-1", "processing_status": status, "page_count": 1}])
+        for status in ["pending", "pending", "processing", "completed"]
+    ]
+    request = MagicMock()
+    request.is_disconnected = AsyncMock(return_value=False)
+
+    async def scenario():
+        response = await main.stream_record_events("record-1", request, mock_supabase)
+        return [chunk async for chunk in response.body_iterator]
+
+    chunks = asyncio.run(scenario())
+    statuses = [event["processing_status"] for event in parse_events(chunks)]
+    assert statuses == ["pending", "processing", "completed"]
+
+
+def test_stream_uses_latest_event_from_this_process(monkeypatch):
+    """このプロセスで処理済みのレコードはDBを参照せずに現在の状態を返して終了する"""
+    bus = RecordEventBus()
+    bus.publish("record-1", "failed")
+    monkeypatch.setattr(main, "record_events", bus)
+    mock_supabase = MagicMock()
+
+    async def scenario():
+        response = await main.stream_record_events("record-1", MagicMock(), mock_supabase)
+        return [chunk async for chunk in response.body_iterator]
+
+    chunks = asyncio.run(scenario())
+    assert [event["processing_status"] for event in parse_events(chunks)] == ["failed"]
+    mock_supabase.table.assert_not_called()
+
+
+def test_process_image_publishes_status_transitions(monkeypatch):
+    """process_image は処理中・完了を通知する"""
+    bus = RecordEventBus()
+    monkeypatch.setattr(main, "record_events", bus)
+    events = []
+    monkeypatch.setattr(bus, "publish", lambda record_id, status, **fields: events.append(status))
+
+    with patch.object(main.clients, "supabase", return_value=MagicMock()), \
+            patch("main.extract_text", AsyncMock(return_value="text")):
+        asyncio.run(main.process_image("record-1", "http://example.com/a.jpg", b"image"))
+
+    assert events == ["processing", "completed"]
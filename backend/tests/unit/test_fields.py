@@ -0,0 +1,107 @@
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from fastapi.testclient import TestClient
+
+import main
+from fields import FieldExtractor, parse_fields, parse_pages
+from preprocess import ImagePreprocessor, PreprocessSettings
+
+
+def by_name(fields):
+    return {field["name"]: field for field in fields}
+
+
+def test_parse_vitals_normalizes_units_and_full_width_text():
+    """全角の数字・記号も解析し、血圧は上と下を別の項目にする。範囲外の値は捨てる"""
+    fields = by_name(parse_fields("体温３６．５℃　血圧145/95 脈拍 72回/分 SpO₂ 98% 体重 60.5kg 体温 365"))
+
+    assert fields["body_temperature"]["value_numeric"] == 36.5
+    assert fields["body_temperature"]["unit"] == "℃"
+    assert fields["blood_pressure_systolic"]["value_numeric"] == 145
+    assert fields["blood_pressure_diastolic"]["value_text"] == "145/95"
+    assert (fields["pulse"]["value_numeric"], fields["spo2"]["value_numeric"]) == (72, 98)
+    assert fields["weight"]["unit"] == "kg"
+    assert len([field for field in parse_fields("体温 36.5℃ 体温 365") if field["name"] == "body_temperature"]) == 1
+
+
+def test_parse_dates_converts_japanese_eras():
+    """和暦（元年・略記を含む）を西暦の日付にし、直前のラベルで日付の意味を決める"""
+    fields = parse_fields("生年月日：昭和50年4月1日\n受診日 R7.3.4\n平成元年1月8日 令和7年2月30日 2025/03/05")
+    dates = [(field["name"], field["value_date"]) for field in fields]
+
+    assert dates == [
+        ("birth_date", "1975-04-01"),
+        ("visit_date", "2025-03-04"),
+        ("date", "1989-01-08"),
+        ("date", "2025-03-05"),
+    ]
+    assert fields[0]["attributes"] == {"era": "昭和"}
+
+
+def test_parse_medications_with_dosage():
+    """薬品名・規格・1回量・1日の回数・服用時点を取り出し、検査値は処方と誤認しない"""
+    fields = parse_fields("Rp. ロキソニン錠60mg 3錠 分3 毎食後\nアムロジピンOD錠 5mg 1日1回 朝食後\n血糖 120mg/dL")
+    medications = [field for field in fields if field["field_type"] == "medication"]
+
+    assert [field["name"] for field in medications] == ["ロキソニン錠", "アムロジピンOD錠"]
+    assert medications[0]["value_numeric"] == 60 and medications[0]["unit"] == "mg"
+    assert medications[0]["attributes"] == {"quantity": 3, "form": "錠", "times_per_day": 3, "timing": "毎食後"}
+    assert medications[1]["attributes"] == {"times_per_day": 1, "timing": "朝食後"}
+
+
+def test_extractor_runs_in_process_pool():
+    """解析はプロセスプールで実行し、ページ番号を付けて返す"""
+    preprocessor = ImagePreprocessor(PreprocessSettings(), workers=1)
+    extractor = FieldExtractor(preprocessor.run_in_pool)
+    try:
+        fields = asyncio.run(extractor.run(["体温 36.5℃", "血圧 120/80"]))
+    finally:
+        preprocessor.shutdown()
+
+    assert fields == parse_pages(["体温 36.5℃", "血圧 120/80"])
+    assert [field["page_index"] for field in fields] == [0, 1, 1]
+    assert extractor.stats()["fields"] == 3
+
+
+def test_process_image_replaces_structured_fields(monkeypatch):
+    """OCR結果の保存時に、前回の構造化項目を削除してから保存する"""
+    async def run_inline(func, *args):
+        return func(*args)
+
+    monkeypatch.setattr(main, "field_extractor", FieldExtractor(run_inline))
+    mock_supabase = MagicMock()
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch("main.extract_text", AsyncMock(return_value="体温 36.5℃")):
+        asyncio.run(main.process_image("record-1", "http://example.com/a.jpg", b"image"))
+
+    table = mock_supabase.table.return_value
+    table.delete.return_value.eq.assert_called_once_with("record_id", "record-1")
+    inserted = table.insert.call_args.args[0]
+    assert [(row["record_id"], row["name"], row["value_numeric"]) for row in inserted] == [
+        ("record-1", "body_temperature", 36.5)
+    ]
+    assert "fields" in table.upsert.call_args.args[0]["stage_timings"]
+
+
+def test_get_record_returns_fields_in_page_order():
+    """カルテ詳細に構造化項目をページ・出現順に含める"""
+    mock_supabase = MagicMock()
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[{
+        "id": "record-1", "processing_status": "processing", "page_count": 2,
+        "extracted_data": [],
+        "extracted_fields": [
+            {"name": "pulse", "page_index": 1, "position": 0},
+            {"name": "blood_pressure_systolic", "page_index": 0, "position": 8},
+            {"name": "body_temperature", "page_index": 0, "position": 0},
+        ],
+    }])
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        response = TestClient(main.app).get("/api/records/record-1")
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    assert [field["name"] for field in response.json()["fields"]] == ["body_temperature", "blood_pressure_systolic", "pulse"]
+    assert "extracted_fields" not in response.json()["record"]
@@ -0,0 +1,99 @@
+import asyncio
+import io
+import os
+import threading
+import pytest
+from fastapi import UploadFile
+from fastapi.testclient import TestClient
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import ingest
+import main
+from ingest import FileTooLargeError, spool_upload
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path):
+    """一時ファイルの保存先をテストごとに分ける"""
+    with patch.object(ingest, "_spool_dir", str(tmp_path)):
+        yield tmp_path
+
+
+def test_spool_upload_writes_chunks_to_temp_file(spool_dir):
+    """アップロードはチャンク単位で一時ファイルに書き込まれ、ハッシュも計算される"""
+    data = b"x" * 2500
+    upload = UploadFile(io.BytesIO(data), filename="chart.jpg")
+
+    image = asyncio.run(spool_upload(upload, max_size=10_000, chunk_size=1000))
+
+    assert image.size == 2500
+    assert image.read() == data
+    assert os.path.dirname(image.path) == str(spool_dir)
+    image.cleanup()
+    assert not os.path.exists(image.path)
+
+
+def test_spool_upload_stops_at_size_limit(spool_dir):
+    """サイズ上限を超えた時点で読み込みを中止し、一時ファイルを残さない"""
+    upload = UploadFile(io.BytesIO(b"x" * 5000), filename="chart.jpg")
+
+    with pytest.raises(FileTooLargeError):
+        asyncio.run(spool_upload(upload, max_size=2000, chunk_size=1000))
+
+    assert os.listdir(spool_dir) == []
+
+
+def test_spool_upload_writes_off_the_event_loop(spool_dir):
+    """一時ファイルへの書き込みとハッシュの計算はイベントループのスレッドでは行わない"""
+    loop_thread = threading.get_ident()
+    threads = []
+    write = ingest.SpoolWriter.write
+
+    def record_thread(self, chunk):
+        threads.append(threading.get_ident())
+        write(self, chunk)
+
+    upload = UploadFile(io.BytesIO(b"x" * 2500), filename="chart.jpg")
+    with patch.object(ingest.SpoolWriter, "write", record_thread):
+        image = asyncio.run(spool_upload(upload, max_size=10_000, chunk_size=1000))
+
+    assert len(threads) == 3 and loop_thread not in threads
+    image.cleanup()
+
+
+@patch("main.job_queue.enqueue", new_callable=AsyncMock)
+def test_upload_streams_file_to_storage(mock_enqueue):
+    """ストレージにはバイト列ではなく一時ファイルが渡され、ジョブも一時ファイルを保持する"""
+    mock_supabase = MagicMock()
+    mock_supabase.storage.from_.return_value.get_public_url.return_value = "http://example.com/a.jpg"
+    mock_result = MagicMock()
+    mock_result.data = [{"id": "record-1"}]
+    mock_supabase.table.return_value.insert.return_value.execute.return_value = mock_result
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        client = TestClient(main.app)
+        response = client.post("/api/upload", files={"file": ("a.jpg", b"image data", "image/jpeg")})
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    uploaded_file = mock_supabase.storage.from_.return_value.upload.call_args.kwargs["file"]
+    assert not isinstance(uploaded_file, bytes)
+    job = mock_enqueue.call_args.args[0]
+    assert job.image.read() == b"image data"
+    job.image.cleanup()
+
+
+def test_upload_rejects_oversized_file(monkeypatch):
+    """上限を超えるファイルは400を返し、ストレージにはアップロードしない"""
+    monkeypatch.setattr(main, "MAX_FILE_SIZE", 5)
+    mock_supabase = MagicMock()
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        client = TestClient(main.app)
+        response = client.post("/api/upload", files={"file": ("a.jpg", b"too large", "image/jpeg")})
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 400
+    mock_supabase.storage.from_.return_value.upload.assert_not_called()
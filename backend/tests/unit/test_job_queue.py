@@ -0,0 +1,250 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock, AsyncMock
+
+import main
+from job_queue import InMemoryJobBackend, JobQueue, OCRJob, QueueFullError, SQLiteJobBackend, SupabaseJobBackend
+
+
+def test_in_memory_backend_rejects_when_full():
+    """上限に達したキューへの投入は QueueFullError になる"""
+    async def scenario():
+        backend = InMemoryJobBackend(maxsize=1)
+        await backend.put(OCRJob(record_id="a", image_url="http://example.com/a.jpg"))
+        with pytest.raises(QueueFullError):
+            await backend.put(OCRJob(record_id="b", image_url="http://example.com/b.jpg"))
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_processes_jobs():
+    """ワーカーが投入されたジョブをすべて処理する"""
+    async def scenario():
+        processed = []
+
+        async def handler(job):
+            processed.append(job.record_id)
+
+        queue = JobQueue(handler, InMemoryJobBackend(), workers=2)
+        await queue.start()
+        for i in range(5):
+            await queue.enqueue(OCRJob(record_id=str(i), image_url=f"http://example.com/{i}.jpg"))
+        while len(processed) < 5:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return processed, queue.stats()
+
+    processed, stats = asyncio.run(scenario())
+    assert sorted(processed) == ["0", "1", "2", "3", "4"]
+    assert stats["processed"] == 5
+
+
+def test_sqlite_backend_recovers_unfinished_jobs(tmp_path):
+    """SQLiteバックエンドは未完了のジョブを再起動後に復旧する"""
+    path = str(tmp_path / "jobs.db")
+
+    async def first_run():
+        backend = SQLiteJobBackend(path)
+        await backend.put(OCRJob(record_id="done", image_url="http://example.com/done.jpg"))
+        await backend.put(OCRJob(record_id="left", image_url="http://example.com/left.jpg"))
+        job = await backend.get()
+        await backend.ack(job)
+        await backend.close()
+
+    async def second_run():
+        backend = SQLiteJobBackend(path)
+        jobs = await backend.recover()
+        await backend.close()
+        return jobs
+
+    asyncio.run(first_run())
+    jobs = asyncio.run(second_run())
+    assert [job.record_id for job in jobs] == ["left"]
+    assert jobs[0].image is None
+
+
+def test_upload_rejected_when_queue_full(monkeypatch):
+    """キューが満杯の場合、アップロードは429を返す"""
+    mock_supabase = MagicMock()
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    monkeypatch.setattr(main.job_queue.backend, "maxsize", 1)
+    monkeypatch.setattr(main.job_queue.backend, "qsize", lambda: 1)
+    try:
+        client = TestClient(main.app)
+        files = {"file": ("chart.jpg", b"image data", "image/jpeg")}
+        response = client.post("/api/upload", files=files)
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "30"
+    mock_supabase.storage.from_.return_value.upload.assert_not_called()
+
+
+def test_workers_wait_for_gate_before_taking_jobs():
+    """ゲートが閉じている間、ワーカーはジョブを取り出さずにキューに残す"""
+    async def scenario():
+        processed = []
+        gate_open = asyncio.Event()
+
+        async def handler(job):
+            processed.append(job.record_id)
+
+        queue = JobQueue(handler, InMemoryJobBackend(), workers=2, gate=gate_open.wait)
+        await queue.start()
+        await queue.enqueue(OCRJob(record_id="a", image_url="http://example.com/a.jpg"))
+        await asyncio.sleep(0.05)
+        queued_while_closed = queue.stats()["queued"]
+        gate_open.set()
+        while not processed:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return queued_while_closed, processed
+
+    queued_while_closed, processed = asyncio.run(scenario())
+    assert queued_while_closed == 1
+    assert processed == ["a"]
+
+
+def mock_claims(rows):
+    """claim_ocr_jobs が rows を1件ずつ返し、その後は空を返すSupabaseのモック"""
+    mock_supabase = MagicMock()
+    results = [MagicMock(data=[row]) for row in rows]
+    mock_supabase.rpc.return_value.execute.side_effect = lambda: results.pop(0) if results else MagicMock(data=[])
+    return mock_supabase
+
+
+def test_supabase_backend_claims_and_releases_jobs():
+    """カルテを取得してジョブにし、完了時は自分が保持しているリースだけを解放する"""
+    mock_supabase = mock_claims([{
+        "id": "record-1", "original_image_url": "http://example.com/a.jpg", "image_sha256": "sha",
+        "ocr_bypass_cache": True, "ocr_queued_at": "2025-03-04T12:00:00+00:00", "ocr_attempts": 2, "reclaimed": True,
+    }])
+    backend = SupabaseJobBackend(lambda: mock_supabase, worker_id="node-1:42", lease_seconds=60)
+
+    async def scenario():
+        job = await backend.get()
+        await backend.ack(job)
+        await backend.close()
+        return job
+
+    job = asyncio.run(scenario())
+
+    assert mock_supabase.rpc.call_args_list[0].args == ("claim_ocr_jobs", {
+        "p_worker_id": "node-1:42", "p_limit": 1, "p_lease_seconds": 60, "p_max_attempts": 3,
+    })
+    assert (job.record_id, job.bypass_cache, job.image_sha256, job.image) == ("record-1", True, "sha", None)
+    # 解放は自分が保持しているリースだけで、取得時の ocr_queued_at と比べて再処理を判定する
+    assert mock_supabase.rpc.call_args_list[-1].args == ("release_ocr_job", {
+        "p_id": "record-1", "p_worker_id": "node-1:42", "p_claimed_queued_at": "2025-03-04T12:00:00+00:00",
+    })
+    assert backend.stats()["reclaimed"] == 1
+    assert backend.stats()["requeued"] == 0
+
+
+def test_supabase_backend_requeues_records_reprocessed_while_claimed():
+    """処理中に再処理が投入されたカルテは、解放時に pending に戻ったことを数える"""
+    mock_supabase = MagicMock()
+    claim = MagicMock(data=[{
+        "id": "record-1", "original_image_url": "http://example.com/a.jpg", "ocr_queued_at": "2025-03-04T12:00:00+00:00",
+    }])
+    mock_supabase.rpc.return_value.execute.side_effect = [claim, MagicMock(data=[{"id": "record-1", "requeued": True}])]
+    backend = SupabaseJobBackend(lambda: mock_supabase, worker_id="node-1:42")
+
+    async def scenario():
+        await backend.ack(await backend.get())
+        await backend.close()
+
+    asyncio.run(scenario())
+
+    assert mock_supabase.rpc.call_args.args[0] == "release_ocr_job"
+    assert backend.stats()["requeued"] == 1
+
+
+def test_supabase_backend_detects_lost_leases():
+    """リースの延長で返されなかったカルテは他のワーカーに取得されたものとして扱う"""
+    mock_supabase = mock_claims([{"id": "record-1", "original_image_url": "http://example.com/a.jpg"}])
+    backend = SupabaseJobBackend(lambda: mock_supabase, lease_seconds=0.03)
+
+    async def scenario():
+        await backend.get()
+        while backend.stats()["active"]:
+            await asyncio.sleep(0.01)
+        await backend.close()
+
+    asyncio.run(scenario())
+
+    assert mock_supabase.rpc.call_args.args[0] == "extend_ocr_leases"
+    assert backend.stats()["leases_lost"] == 1
+
+
+def test_distributed_enqueue_updates_record_instead_of_tracking():
+    """共有のバックエンドへの投入は画像を保持せず、他のプロセスが処理するため投入済みとして追跡しない"""
+    mock_supabase = MagicMock()
+    queue = JobQueue(AsyncMock(), SupabaseJobBackend(lambda: mock_supabase), workers=0)
+    image = MagicMock()
+
+    async def scenario():
+        await queue.enqueue(OCRJob(record_id="uploaded", image_url="http://example.com/a.jpg", image=image))
+        await queue.enqueue(OCRJob(record_id="reprocessed", image_url="http://example.com/b.jpg", bypass_cache=True))
+
+    asyncio.run(scenario())
+
+    image.cleanup.assert_called_once()
+    # アップロード直後のカルテは登録時の状態のまま処理できる
+    update = mock_supabase.table.return_value.update
+    update.assert_called_once()
+    assert update.call_args.args[0]["ocr_bypass_cache"] is True
+    update.return_value.eq.assert_called_once_with("id", "reprocessed")
+    assert not queue.has_record("uploaded") and not queue.has_record("reprocessed")
+
+
+def test_has_record_counts_only_bypass_jobs_for_bypass_requests():
+    """キャッシュを使わない再処理は、投入済みのジョブもキャッシュを使わない場合だけ投入済みとみなす"""
+    queue = JobQueue(AsyncMock(), InMemoryJobBackend(), workers=0)
+
+    asyncio.run(queue.enqueue(OCRJob(record_id="record-1", image_url="http://example.com/a.jpg")))
+    assert queue.has_record("record-1")
+    assert not queue.has_record("record-1", bypass_cache=True)
+
+    asyncio.run(queue.enqueue(OCRJob(record_id="record-1", image_url="http://example.com/a.jpg", bypass_cache=True)))
+    assert queue.has_record("record-1") and queue.has_record("record-1", bypass_cache=True)
+
+
+def test_supabase_backend_reports_pending_count_as_queue_size():
+    """待機中のジョブ数はDBで数えた値を返し、数え直すまでの間は投入した分を加算する（上限の判定にも使う）"""
+    mock_supabase = MagicMock()
+    counted = mock_supabase.table.return_value.select.return_value.eq.return_value.limit.return_value
+    counted.execute.return_value = MagicMock(count=99)
+    backend = SupabaseJobBackend(lambda: mock_supabase, maxsize=100)
+    queue = JobQueue(AsyncMock(), backend, workers=0)
+
+    async def scenario():
+        await queue.start()
+        sizes = [backend.qsize()]
+        await queue.enqueue(OCRJob(record_id="record-1", image_url="http://example.com/a.jpg", bypass_cache=True))
+        sizes.append(backend.qsize())
+        await queue.stop()
+        return sizes
+
+    assert asyncio.run(scenario()) == [99, 100]
+    assert backend.is_full() and not queue.has_capacity(1)
+
+
+def test_supabase_backend_restores_attempts_when_released_on_shutdown():
+    """停止時に処理中だったジョブは、取得時に数えた試行回数を戻して pending にする"""
+    mock_supabase = mock_claims([{"id": "record-1", "original_image_url": "http://example.com/a.jpg", "ocr_attempts": 2}])
+    backend = SupabaseJobBackend(lambda: mock_supabase, worker_id="node-1:42")
+
+    async def scenario():
+        await backend.get()
+        await backend.close()
+
+    asyncio.run(scenario())
+
+    update = mock_supabase.table.return_value.update
+    assert update.call_args.args[0] == {
+        "processing_status": "pending", "claimed_by": None, "lease_expires_at": None, "ocr_attempts": 1,
+    }
+    update.return_value.in_.assert_called_once_with("id", ["record-1"])
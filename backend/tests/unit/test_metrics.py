@@ -0,0 +1,84 @@
+import asyncio
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import main
+from job_queue import OCRJob
+from metrics import StageTimings
+
+
+def sample(name, labels):
+    """メトリクスの現在値（未記録の場合は0）"""
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_metrics_endpoint_exposes_prometheus_format():
+    """/metrics はPrometheusのテキスト形式で返す"""
+    response = TestClient(main.app).get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "ocr_stage_duration_seconds_bucket" in response.text
+    assert "ocr_jobs_in_flight" in response.text
+    assert "ocr_queue_depth" in response.text
+
+
+def test_stage_timings_accumulate_and_observe():
+    """同じ段階の所要時間は合計され、ヒストグラムにも記録される"""
+    before = sample("ocr_stage_duration_seconds_count", {"stage": "download"})
+    timings = StageTimings({"upload_read": 0.5})
+    timings.add("download", 0.25)
+    timings.add("download", 0.25)
+    timings.add("download", 1.0, observe_histogram=False)
+
+    assert timings.as_dict() == {"upload_read": 0.5, "download": 1.5}
+    assert sample("ocr_stage_duration_seconds_count", {"stage": "download"}) == before + 2
+
+
+def test_ocr_job_persists_stage_timings(monkeypatch):
+    """ジョブの処理で計測した段階ごとの所要時間を抽出データと一緒に保存する"""
+    monkeypatch.setattr(main.preprocessor.settings, "enabled", False)
+    image = MagicMock(sha256="abc")
+    image.read_head.return_value = b"\xff\xd8\xff"
+    image.read.return_value = b"\xff\xd8\xffimage"
+    job = OCRJob(record_id="record-1", image_url="http://example.com/a.jpg", image=image,
+                 stage_timings={"upload_read": 0.1, "storage_upload": 0.2})
+    mock_supabase = MagicMock()
+
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch("main.extract_text", AsyncMock(return_value="text")):
+        asyncio.run(main.run_ocr_job(job))
+
+    stage_timings = mock_supabase.table.return_value.upsert.call_args.args[0]["stage_timings"]
+    assert stage_timings["upload_read"] == 0.1
+    assert stage_timings["storage_upload"] == 0.2
+    assert {"queue_wait", "preprocess"} <= set(stage_timings)
+
+
+def test_failures_are_counted_by_class():
+    """保存に失敗したレコードはエラー分類ごとに数える"""
+    before = sample("ocr_failures_total", {"error_class": "db"})
+    mock_supabase = MagicMock()
+    mock_supabase.table.return_value.upsert.return_value.execute.side_effect = RuntimeError("db down")
+
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch("main.extract_text", AsyncMock(return_value="text")):
+        asyncio.run(main.process_image("record-1", "http://example.com/a.jpg", b"image"))
+
+    assert sample("ocr_failures_total", {"error_class": "db"}) == before + 1
+
+
+def test_ocr_job_marks_record_failed_when_download_fails():
+    """再処理・復旧したジョブで画像を取得できない場合はカルテをエラー状態にする"""
+    before = sample("ocr_failures_total", {"error_class": "download"})
+    job = OCRJob(record_id="record-1", image_url="http://example.com/missing.jpg")
+
+    with patch("main.download_image", AsyncMock(side_effect=main.HTTPException(status_code=500, detail="404"))), \
+            patch("main.mark_record_failed", AsyncMock()) as mark_record_failed, \
+            patch("main.process_image", AsyncMock()) as process_image:
+        asyncio.run(main.run_ocr_job(job))
+
+    mark_record_failed.assert_awaited_once_with("record-1")
+    process_image.assert_not_awaited()
+    assert sample("ocr_failures_total", {"error_class": "download"}) == before + 1
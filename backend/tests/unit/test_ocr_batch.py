@@ -0,0 +1,96 @@
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+
+import main
+from ocr_batch import BatchParseError, OCRBatcher, image_label, split_batch_output
+from ocr_cache import MemoryCacheTier, OCRCache
+from rate_limit import RateLimiter
+
+
+def test_split_batch_output():
+    """区切り行で画像ごとに分割し、区切り行が足りない・順番が違う場合はエラーにする"""
+    text = f"{image_label(1)}\n患者名：山田太郎\n体温 36.5℃\n{image_label(2)}\n{image_label(3)}\n処方：ロキソニン\n"
+
+    assert split_batch_output(text, 3) == ["患者名：山田太郎\n体温 36.5℃", "", "処方：ロキソニン"]
+    with pytest.raises(BatchParseError):
+        split_batch_output(f"{image_label(1)}\nA\n{image_label(3)}\nB", 2)
+    with pytest.raises(BatchParseError):
+        split_batch_output(f"以下が結果です\n{image_label(1)}\nA\n{image_label(2)}\nB", 2)
+
+
+def test_batcher_groups_concurrent_submits():
+    """同じキーで同時に届いた画像は1回にまとめ、1件だけなら1枚ずつの抽出に任せる"""
+    run_batch = AsyncMock(side_effect=lambda key, parts: [f"{key}:{part['data']}" for part in parts])
+    batcher = OCRBatcher(run_batch, max_size=2, max_wait=0.01)
+
+    async def scenario():
+        grouped = await asyncio.gather(batcher.submit("ja", {"data": "a"}), batcher.submit("ja", {"data": "b"}))
+        alone = await batcher.submit("en", {"data": "c"})
+        return grouped, alone
+
+    grouped, alone = asyncio.run(scenario())
+
+    assert grouped == ["ja:a", "ja:b"]
+    assert alone is None
+    run_batch.assert_awaited_once()
+    assert batcher.stats()["batched_images"] == 2
+
+
+def test_batcher_falls_back_on_error():
+    """まとめた抽出に失敗した場合は全員に None を返す"""
+    batcher = OCRBatcher(AsyncMock(side_effect=BatchParseError("bad output")), max_size=2)
+
+    async def scenario():
+        return await asyncio.gather(batcher.submit("ja", {"data": "a"}), batcher.submit("ja", {"data": "b"}))
+
+    assert asyncio.run(scenario()) == [None, None]
+    assert batcher.stats()["fallbacks"] == 2
+
+
+@pytest.fixture
+def batching(monkeypatch):
+    monkeypatch.setattr(main, "ocr_cache", OCRCache(MemoryCacheTier()))
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(main, "ocr_streaming", False)
+    monkeypatch.setattr(main, "ocr_batching", True)
+    monkeypatch.setattr(main, "ocr_batcher", OCRBatcher(main.run_ocr_batch, max_size=2, max_wait=1))
+
+
+def extract_two():
+    async def scenario():
+        return await asyncio.gather(
+            main.extract_text(b"image-a", max_retries=0), main.extract_text(b"image-b", max_retries=0)
+        )
+    return asyncio.run(scenario())
+
+
+def test_extract_text_batches_small_images(batching):
+    """小さい画像は1回のリクエストでまとめて抽出し、画像ごとのテキストを返す"""
+    mock_model = MagicMock()
+    mock_model.generate_content_async = AsyncMock(
+        return_value=MagicMock(text=f"{image_label(1)}\n体温 36.5℃\n{image_label(2)}\n血圧 120/80")
+    )
+    with patch.object(main.clients, "model", return_value=mock_model):
+        texts = extract_two()
+
+    assert texts == ["体温 36.5℃", "血圧 120/80"]
+    contents = mock_model.generate_content_async.call_args.args[0]
+    assert [content["data"] for content in contents if isinstance(content, dict)] == [b"image-a", b"image-b"]
+    assert mock_model.generate_content_async.await_count == 1
+
+
+def test_extract_text_falls_back_when_output_cannot_be_split(batching):
+    """区切り行が崩れた場合は1枚ずつ抽出し直す"""
+    mock_model = MagicMock()
+    mock_model.generate_content_async = AsyncMock(side_effect=[
+        MagicMock(text="体温 36.5℃ 血圧 120/80"),
+        MagicMock(text="single-a"),
+        MagicMock(text="single-b"),
+    ])
+    with patch.object(main.clients, "model", return_value=mock_model):
+        texts = extract_two()
+
+    assert sorted(texts) == ["single-a", "single-b"]
+    assert mock_model.generate_content_async.await_count == 3
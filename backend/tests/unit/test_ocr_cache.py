@@ -0,0 +1,105 @@
+import asyncio
+import time
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import main
+from ocr_cache import MemoryCacheTier, OCRCache, SQLiteCacheTier, cache_key, image_digest
+
+
+def test_cache_key_depends_on_image_and_settings():
+    """キャッシュキーは画像とOCR設定の両方で変わる"""
+    digest = image_digest(b"image")
+    config = {"temperature": 0.1}
+
+    base = cache_key(digest, "prompt", "gemini-1.5-pro", "ja", config)
+
+    assert base == cache_key(digest, "prompt", "gemini-1.5-pro", "ja", {"temperature": 0.1})
+    assert base != cache_key(image_digest(b"other"), "prompt", "gemini-1.5-pro", "ja", config)
+    assert base != cache_key(digest, "prompt", "gemini-1.5-flash", "ja", config)
+    assert base != cache_key(digest, "prompt", "gemini-1.5-pro", "ja", {"temperature": 0.2})
+
+
+def test_memory_tier_evicts_least_recently_used():
+    """件数上限を超えると最も古く使われたものから削除される"""
+    tier = MemoryCacheTier(max_entries=2)
+    tier.put("a", "A")
+    tier.put("b", "B")
+    tier.get("a")
+    tier.put("c", "C")
+
+    assert tier.get("a") == "A"
+    assert tier.get("b") is None
+    assert tier.get("c") == "C"
+
+
+def test_sqlite_tier_size_and_ttl_eviction(tmp_path):
+    """SQLite層は合計サイズ上限とTTLで削除される"""
+    tier = SQLiteCacheTier(str(tmp_path / "cache.db"), max_bytes=10)
+    tier.put("a", "12345")
+    tier.put("b", "67890")
+    tier.put("c", "abcde")
+    assert tier.get("a") is None
+    assert tier.get("c")[0] == "abcde"
+    tier.close()
+
+    expiring = SQLiteCacheTier(str(tmp_path / "ttl.db"), ttl=1)
+    expiring.put("a", "text")
+    with patch("ocr_cache.time.time", return_value=time.time() + 5):
+        assert expiring.get("a") is None
+    expiring.close()
+
+
+def test_sqlite_tier_opens_on_first_use(tmp_path):
+    """SQLite層のDBは最初に使うときに作り、開けない場合はキャッシュしない"""
+    path = tmp_path / "cache.db"
+    tier = SQLiteCacheTier(str(path))
+    assert not path.exists()
+    tier.put("a", "text")
+    assert path.exists() and tier.get("a")[0] == "text"
+    tier.close()
+
+    missing = SQLiteCacheTier(str(tmp_path / "missing" / "cache.db"))
+    missing.put("a", "text")
+    assert missing.get("a") is None
+    missing.close()
+
+
+def test_persistent_hit_is_promoted_to_memory(tmp_path):
+    """永続層のヒットはメモリ層に昇格し、ヒット数が記録される"""
+    persistent = SQLiteCacheTier(str(tmp_path / "cache.db"))
+    persistent.put("key", "体温 36.5℃")
+    cache = OCRCache(MemoryCacheTier(), persistent)
+
+    async def scenario():
+        first = await cache.get("key")
+        second = await cache.get("key")
+        missing = await cache.get("other")
+        return first, second, missing
+
+    first, second, missing = asyncio.run(scenario())
+    assert first == second == "体温 36.5℃"
+    assert missing is None
+    assert cache.stats()["persistent_hits"] == 1
+    assert cache.stats()["memory_hits"] == 1
+    assert cache.stats()["misses"] == 1
+    cache.close()
+
+
+def test_process_image_skips_gemini_on_cache_hit(monkeypatch):
+    """キャッシュ済みの画像はGemini APIを呼ばずに保存される"""
+    image = b"same chart"
+    key = main.ocr_cache_key(image_digest(image), "ja")
+    cache = OCRCache(MemoryCacheTier())
+    cache.memory.put(key, "cached text")
+    monkeypatch.setattr(main, "ocr_cache", cache)
+
+    mock_supabase = MagicMock()
+    mock_model = MagicMock()
+    mock_model.generate_content_async = AsyncMock()
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch.object(main.clients, "model", return_value=mock_model):
+        asyncio.run(main.process_image("record-1", "http://example.com/a.jpg", image))
+
+    mock_model.generate_content_async.assert_not_called()
+    saved = mock_supabase.table.return_value.upsert.call_args.args[0]
+    assert saved["extracted_text"] == "cached text"
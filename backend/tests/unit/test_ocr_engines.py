@@ -0,0 +1,203 @@
+import asyncio
+import io
+import sys
+import types
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+from PIL import Image
+
+import main
+from ocr_cache import MemoryCacheTier, OCRCache
+from ocr_engines import (
+    EngineRouter, GeminiEngine, OCREngine, OCRResult, response_confidence, tesseract_ocr, text_confidence,
+)
+from rate_limit import RateLimiter
+
+
+class FakeEngine(OCREngine):
+    def __init__(self, name, text="text", confidence=1.0, error=None):
+        self.name = name
+        self.text = text
+        self.confidence = confidence
+        self.error = error
+        self.calls = 0
+
+    async def extract(self, image_bytes, language="ja", **options):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return OCRResult(self.text, self.confidence, self.name)
+
+
+def test_text_confidence_counts_illegible_lines():
+    """判読不能と表記された行が多いほど確信度を下げ、空のテキストは0にする"""
+    assert text_confidence("体温 36.5℃\n血圧 120/80") == 1.0
+    assert text_confidence("体温 [判読不能]\n血圧 120/80\n脈拍 72\n所見 [判読不能]") == 0.5
+    assert text_confidence("  \n") == 0.0
+
+
+def test_router_chooses_engine_by_size_queue_and_latency():
+    """大きい画像は primary、混雑時・予算超過時はローカル、fast が遅い間は primary を選ぶ"""
+    primary, fast, local = FakeEngine("pro"), FakeEngine("flash"), FakeEngine("local")
+    router = EngineRouter(
+        primary, fast, local, large_image_bytes=1000, overflow_queue_depth=10, latency_budget=5, probe_interval=2
+    )
+
+    assert router.choose(500) is fast
+    assert router.choose(5000) is primary
+    assert router.choose(500, queue_depth=10) is local
+    assert router.choose(5000, offline=True) is local
+
+    router.observe(primary, 2.0)
+    router.observe(fast, 3.0)
+    assert router.choose(500) is primary
+    # 所要時間を測り直すため、ときどき fast を使う
+    assert router.choose(500) is fast
+    router.observe(primary, 20.0)
+    assert router.latency(primary) == pytest.approx(0.3 * 20 + 0.7 * 2)
+    assert router.choose(5000) is local
+
+
+def test_router_escalates_only_low_confidence():
+    """fast の確信度が低い場合だけ primary で抽出し直す"""
+    primary, fast = FakeEngine("pro", "正確なテキスト"), FakeEngine("flash", "[判読不能]", confidence=0.2)
+    router = EngineRouter(primary, fast, min_confidence=0.8)
+
+    result = asyncio.run(router.extract(b"image"))
+
+    assert (result.text, result.engine, result.escalated_from) == ("正確なテキスト", "pro", "flash")
+    assert router.stats()["escalations"] == 1
+    fast.confidence = 0.9
+    router = EngineRouter(primary, fast, min_confidence=0.8)
+    assert asyncio.run(router.extract(b"image")).engine == "flash"
+    assert primary.calls == 1
+
+
+def test_router_does_not_escalate_local_results_while_offline_or_overflowing():
+    """Geminiが使えない間・混雑時のローカルの結果は、確信度が低くても primary で抽出し直さない"""
+    primary, local = FakeEngine("pro"), FakeEngine("local", "[判読不能]", confidence=0.2)
+    router = EngineRouter(primary, local=local, overflow_queue_depth=10, latency_budget=5)
+
+    assert asyncio.run(router.extract(b"image", offline=True)).engine == "local"
+    assert asyncio.run(router.extract(b"image", queue_depth=10)).engine == "local"
+    assert primary.calls == 0
+    assert router.stats()["deferred"] == 2
+
+    # 所要時間が理由の場合は抽出し直す
+    router.observe(primary, 20.0)
+    router.probe_interval = 0
+    result = asyncio.run(router.extract(b"image"))
+    assert (result.engine, result.escalated_from) == ("pro", "local")
+
+
+def test_router_falls_back_on_errors():
+    """fast のエラーは primary で、primary の一時的なエラーはローカルで抽出し直す"""
+    primary, fast, local = FakeEngine("pro"), FakeEngine("flash", error=RuntimeError("503")), FakeEngine("local")
+    router = EngineRouter(primary, fast, local)
+    assert asyncio.run(router.extract(b"image")).engine == "pro"
+
+    router = EngineRouter(FakeEngine("pro", error=RuntimeError("503")), local=local)
+    assert asyncio.run(router.extract(b"image")).engine == "local"
+
+    router = EngineRouter(FakeEngine("pro", error=ValueError("401")), local=local, can_fall_back=lambda e: False)
+    with pytest.raises(ValueError):
+        asyncio.run(router.extract(b"image"))
+
+
+def test_tesseract_ocr_joins_lines_and_averages_confidence(monkeypatch):
+    """単語を行ごとにまとめ、確信度は認識できた単語の平均にする"""
+    data = {
+        "text": ["", "体温", "36.5℃", "血圧"],
+        "conf": [-1, 90, 80, 70],
+        "block_num": [0, 1, 1, 1],
+        "par_num": [0, 1, 1, 1],
+        "line_num": [0, 1, 1, 2],
+    }
+    fake = types.SimpleNamespace(image_to_data=MagicMock(return_value=data), Output=types.SimpleNamespace(DICT="dict"))
+    monkeypatch.setitem(sys.modules, "pytesseract", fake)
+    buffer = io.BytesIO()
+    Image.new("L", (8, 8)).save(buffer, format="PNG")
+
+    text, confidence = tesseract_ocr(buffer.getvalue(), "jpn")
+
+    assert text == "体温36.5℃\n血圧"
+    assert confidence == pytest.approx(0.8)
+    assert fake.image_to_data.call_args.kwargs["lang"] == "jpn"
+
+
+def routed_extraction(monkeypatch):
+    """Pro と Flash を振り分ける main の設定（キャッシュはメモリのみ）"""
+    monkeypatch.setattr(main, "ocr_cache", OCRCache(MemoryCacheTier()))
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(main, "ocr_streaming", False)
+    monkeypatch.setattr(main, "ocr_batching", False)
+    monkeypatch.setattr(main, "ocr_router", EngineRouter(
+        GeminiEngine("pro", main.OCR_MODEL_NAME, main.run_gemini_engine),
+        GeminiEngine("flash", "gemini-1.5-flash", main.run_gemini_engine),
+        lookup=main.lookup_cached_ocr,
+    ))
+
+
+def test_response_confidence_uses_finish_reason_and_logprobs():
+    """判読不能の表記がなくても、打ち切られた生成やトークンの確率が低い生成は確信度を下げる"""
+    assert response_confidence("体温 36.5℃", "STOP") == 1.0
+    assert response_confidence("体温 36.5℃", "MAX_TOKENS") == 0.3
+    assert response_confidence("体温 36.5℃", "SAFETY") == 0.0
+    assert response_confidence("体温 36.5℃", "STOP", avg_logprobs=-0.5) == pytest.approx(0.607, abs=0.001)
+    assert response_confidence("", "STOP") == 0.0
+
+
+def test_extract_text_escalates_truncated_flash_output(monkeypatch):
+    """判読不能の表記がない Flash の結果でも、トークン上限で打ち切られた場合は Pro で抽出し直す"""
+    routed_extraction(monkeypatch)
+    truncated = MagicMock(text="体温 36.5℃", candidates=[
+        types.SimpleNamespace(finish_reason=types.SimpleNamespace(name="MAX_TOKENS"), avg_logprobs=-0.05),
+    ])
+    complete = MagicMock(text="体温 36.5℃\n血圧 120/80", candidates=[
+        types.SimpleNamespace(finish_reason=types.SimpleNamespace(name="STOP"), avg_logprobs=-0.05),
+    ])
+    models = {
+        main.OCR_MODEL_NAME: MagicMock(generate_content_async=AsyncMock(return_value=complete)),
+        "gemini-1.5-flash": MagicMock(generate_content_async=AsyncMock(return_value=truncated)),
+    }
+    with patch.object(main.clients, "model", side_effect=models.get):
+        text = asyncio.run(main.extract_text(b"image", max_retries=0))
+
+    assert text == "体温 36.5℃\n血圧 120/80"
+    assert main.ocr_router.stats()["escalations"] == 1
+
+
+def test_extract_text_routes_to_flash_and_escalates(monkeypatch):
+    """振り分けが有効な場合は Flash で抽出し、確信度が低い場合は Pro の結果を返す（キャッシュはモデルごと）"""
+    routed_extraction(monkeypatch)
+    models = {
+        main.OCR_MODEL_NAME: MagicMock(generate_content_async=AsyncMock(return_value=MagicMock(text="体温 36.5℃"))),
+        "gemini-1.5-flash": MagicMock(generate_content_async=AsyncMock(return_value=MagicMock(text="体温 [判読不能]"))),
+    }
+    with patch.object(main.clients, "model", side_effect=models.get):
+        first = asyncio.run(main.extract_text(b"image", max_retries=0))
+        second = asyncio.run(main.extract_text(b"image", max_retries=0))
+
+    assert first == second == "体温 36.5℃"
+    assert [model.generate_content_async.await_count for model in models.values()] == [1, 1]
+    # 2回目はエンジンを選ぶ前にキャッシュから返す（振り分けの件数には数えない）
+    assert main.ocr_router.stats()["routed"] == {"flash": 1, "pro": 1}
+    assert main.ocr_router.stats()["cache_hits"] == 1
+
+
+def test_process_image_records_local_engine_as_outdated(monkeypatch):
+    """ローカルで抽出した場合はモデル名を抽出データに記録し、OCRバージョンを現在のものと一致させない"""
+    monkeypatch.setattr(main, "extract_text", AsyncMock(
+        side_effect=lambda *args, engines=None, **kwargs: engines.append("tesseract") or "体温 36.5℃"
+    ))
+    supabase = MagicMock()
+
+    with patch.object(main.clients, "supabase", return_value=supabase):
+        asyncio.run(main.process_image("record-1", "http://example.com/a.jpg", b"image"))
+
+    upserted = supabase.table.return_value.upsert.call_args.args[0]
+    updated = supabase.table.return_value.update.call_args.args[0]
+    assert upserted["ocr_engine"] == "tesseract"
+    assert updated["ocr_version"] == f"{main.current_ocr_version()}+tesseract"
+    assert main.record_ocr_version("ja", ["gemini-1.5-flash"]) == main.current_ocr_version()
@@ -0,0 +1,77 @@
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock
+
+import main
+from pagination import InvalidCursorError, decode_cursor, encode_cursor, keyset_filter
+
+
+def make_rows(count):
+    return [
+        {"id": f"record-{i:02d}", "uploaded_at": f"2025-03-04T12:{59 - i:02d}:00+00:00", "processing_status": "failed"}
+        for i in range(count)
+    ]
+
+
+def list_records(mock_supabase, params):
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        return TestClient(main.app).get("/api/records", params=params)
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+def test_cursor_round_trip_and_filter():
+    """カーソルは (uploaded_at, id) を復元でき、PostgRESTのフィルタでは値を引用符で囲む"""
+    row = {"id": "550e8400-e29b-41d4-a716-446655440000", "uploaded_at": "2025-03-04T12:34:56.789+00:00"}
+    cursor = decode_cursor(encode_cursor(row))
+    assert cursor == row
+    assert keyset_filter(cursor) == (
+        'uploaded_at.lt."2025-03-04T12:34:56.789+00:00",'
+        'and(uploaded_at.eq."2025-03-04T12:34:56.789+00:00",id.lt."550e8400-e29b-41d4-a716-446655440000")'
+    )
+    with pytest.raises(InvalidCursorError):
+        decode_cursor("not-a-cursor")
+
+
+def test_list_records_returns_next_cursor_and_filters_status():
+    """1件多く取得して次のページのカーソルを返し、処理状態で絞り込む"""
+    mock_supabase = MagicMock()
+    query = mock_supabase.table.return_value.select.return_value
+    query.eq.return_value = query
+    query.or_.return_value = query
+    query.order.return_value = query
+    query.limit.return_value = query
+    rows = make_rows(3)
+    query.execute.return_value = MagicMock(data=rows)
+
+    response = list_records(mock_supabase, {"limit": 2, "status": "failed"})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert [r["id"] for r in data["records"]] == ["record-00", "record-01"]
+    assert decode_cursor(data["next_cursor"]) == {"uploaded_at": rows[1]["uploaded_at"], "id": "record-01"}
+    query.eq.assert_called_once_with("processing_status", "failed")
+    query.limit.assert_called_once_with(3)
+    query.or_.assert_not_called()
+
+    # 次のページはカーソルより後ろの行だけを取得する
+    query.execute.return_value = MagicMock(data=rows[2:])
+    response = list_records(mock_supabase, {"limit": 2, "status": "failed", "cursor": data["next_cursor"]})
+    assert response.json()["next_cursor"] is None
+    query.or_.assert_called_once_with(keyset_filter(decode_cursor(data["next_cursor"])))
+
+
+def test_list_records_caps_page_size_and_validates_input(monkeypatch):
+    """ページサイズの上限を超える指定は上限に切り詰め、不正な状態・カーソルは400を返す"""
+    monkeypatch.setattr(main, "max_records_page_size", 50)
+    mock_supabase = MagicMock()
+    query = mock_supabase.table.return_value.select.return_value
+    query.order.return_value = query
+    query.limit.return_value = query
+    query.execute.return_value = MagicMock(data=[])
+
+    assert list_records(mock_supabase, {"limit": 100000}).status_code == 200
+    query.limit.assert_called_once_with(51)
+    assert list_records(mock_supabase, {"status": "deleted"}).status_code == 400
+    assert list_records(mock_supabase, {"cursor": "broken"}).status_code == 400
@@ -0,0 +1,65 @@
+import asyncio
+import io
+from PIL import Image
+
+from preprocess import ImagePreprocessor, PreprocessSettings, detect_mime_type, preprocess_image
+
+
+def make_image(size, color=(200, 30, 30), format="PNG", exif_orientation=None):
+    """テスト用の画像データを生成する"""
+    image = Image.new("RGB", size, color)
+    buffer = io.BytesIO()
+    if exif_orientation:
+        exif = Image.Exif()
+        exif[0x0112] = exif_orientation
+        image.save(buffer, format=format, exif=exif)
+    else:
+        image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def test_detect_mime_type():
+    """先頭バイトからMIMEタイプを判定する"""
+    assert detect_mime_type(make_image((10, 10), format="PNG")) == "image/png"
+    assert detect_mime_type(make_image((10, 10), format="JPEG")) == "image/jpeg"
+    assert detect_mime_type(b"%PDF-1.7 ...") == "application/pdf"
+    assert detect_mime_type(b"unknown") == "image/jpeg"
+
+
+def test_preprocess_downscales_and_converts_to_grayscale():
+    """最大解像度に縮小し、グレースケールのJPEGに再エンコードする"""
+    data = make_image((4000, 3000), format="PNG")
+    settings = PreprocessSettings(max_dimension=1000)
+
+    result = preprocess_image(data, settings)
+
+    assert result.mime_type == "image/jpeg"
+    assert result.processed_size < result.original_size
+    with Image.open(io.BytesIO(result.data)) as image:
+        assert image.size == (1000, 750)
+        assert image.mode == "L"
+
+
+def test_preprocess_applies_exif_orientation():
+    """EXIFの向き情報（90度回転）を反映する"""
+    data = make_image((400, 200), format="JPEG", exif_orientation=6)
+
+    result = preprocess_image(data, PreprocessSettings(max_dimension=1000))
+
+    assert (result.width, result.height) == (200, 400)
+
+
+def test_preprocessor_records_size_metrics():
+    """プロセスプールで実行し、前後のバイト数を集計する"""
+    data = make_image((3000, 3000), format="PNG")
+    preprocessor = ImagePreprocessor(PreprocessSettings(max_dimension=500), workers=1)
+    try:
+        result = asyncio.run(preprocessor.run(data))
+    finally:
+        preprocessor.shutdown()
+
+    stats = preprocessor.stats()
+    assert stats["processed"] == 1
+    assert stats["bytes_before"] == len(data)
+    assert stats["bytes_after"] == result.processed_size
+    assert stats["size_ratio"] < 1.0
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import main
+from ocr_cache import MemoryCacheTier, OCRCache
+from rate_limit import PERMANENT, RATE_LIMITED, TRANSIENT, CircuitBreaker, RateLimiter, TokenBucket, classify_error
+
+
+def test_classify_error_by_type_not_message():
+    """エラーは例外の型とステータスコードで分類する"""
+    assert classify_error(google_exceptions.ResourceExhausted("Quota exceeded")) == RATE_LIMITED
+    assert classify_error(google_exceptions.ServiceUnavailable("overloaded")) == TRANSIENT
+    assert classify_error(google_exceptions.PermissionDenied("API key not valid")) == PERMANENT
+    # メッセージに "api" や "limit" を含むだけの一時的なエラーはレート制限扱いにしない
+    assert classify_error(ConnectionError("api connection limit reset")) == TRANSIENT
+
+
+def test_token_bucket_reserves_in_order():
+    """容量を使い切ると、不足分に応じた待ち時間を返す"""
+    bucket = TokenBucket(per_minute=60, burst=2)
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+    assert bucket.reserve(1) == pytest.approx(2.0, abs=0.05)
+    assert TokenBucket(per_minute=0).reserve(100) == 0
+
+
+def test_circuit_breaker_backs_off_on_consecutive_trips():
+    """連続して制限を受けると停止時間が倍になり、成功すると元に戻る"""
+    breaker = CircuitBreaker(cooldown=10, max_cooldown=15)
+    assert breaker.trip() == pytest.approx(10, abs=0.1)
+    assert breaker.is_open
+    breaker._open_until = 0
+    assert breaker.trip() == pytest.approx(15, abs=0.1)
+    breaker._open_until = 0
+    breaker.record_success()
+    assert breaker.trip() == pytest.approx(10, abs=0.1)
+
+
+def test_extract_text_pauses_on_rate_limit_and_retries(monkeypatch):
+    """429を受けたらブレーカーを開いて待機し、キーワードによる追加待機は行わない"""
+    limiter = RateLimiter(cooldown=0.05)
+    monkeypatch.setattr(main, "rate_limiter", limiter)
+    monkeypatch.setattr(main, "ocr_cache", OCRCache(MemoryCacheTier()))
+
+    response = MagicMock(text="体温 36.5℃")
+    response.usage_metadata.total_token_count = 1200
+    mock_model = MagicMock()
+    mock_model.generate_content_async = AsyncMock(
+        side_effect=[google_exceptions.ResourceExhausted("Quota exceeded"), response]
+    )
+    with patch.object(main.clients, "model", return_value=mock_model):
+        text = asyncio.run(main.extract_text(b"image", initial_delay=10))
+
+    assert text == "体温 36.5℃"
+    stats = limiter.stats()
+    assert stats["circuit_trips"] == 1
+    assert stats["rate_limited_errors"] == 1
+    assert 0.04 < stats["throttled_seconds"] < 1
+
+
+def test_extract_text_does_not_retry_permanent_errors(monkeypatch):
+    """認証エラーなどはリトライせずにすぐ失敗する"""
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(main, "ocr_cache", OCRCache(MemoryCacheTier()))
+    mock_model = MagicMock()
+    mock_model.generate_content_async = AsyncMock(side_effect=google_exceptions.PermissionDenied("API key not valid"))
+
+    with patch.object(main.clients, "model", return_value=mock_model):
+        with pytest.raises(google_exceptions.PermissionDenied):
+            asyncio.run(main.extract_text(b"image"))
+
+    assert mock_model.generate_content_async.call_count == 1
+
+
+def test_simultaneous_rate_limits_trip_the_breaker_once():
+    """同時に送信したリクエストが同じ制限で失敗しても、停止時間は1回分だけにする"""
+    limiter = RateLimiter(cooldown=30, max_cooldown=300)
+    sent_at = time.monotonic()
+
+    delays = [limiter.record_rate_limited(sent_at=sent_at) for _ in range(4)]
+
+    assert delays == [pytest.approx(30, abs=0.1)] * 4
+    assert limiter.stats()["circuit_trips"] == 1
+    assert limiter.stats()["rate_limited_errors"] == 4
+
+    # ブレーカーが閉じた後に送信したリクエストの失敗は、連続した制限として停止時間を倍にする
+    limiter.breaker._open_until = 0
+    assert limiter.record_rate_limited(sent_at=time.monotonic()) == pytest.approx(60, abs=0.1)
+    # 送信時刻が分からない場合も、停止中に受けたエラーでは延ばさない
+    assert limiter.record_rate_limited() == pytest.approx(60, abs=0.1)
@@ -0,0 +1,116 @@
+from fastapi.testclient import TestClient
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import main
+from record_cache import RecordCache
+
+RECORD_ID = "550e8400-e29b-41d4-a716-446655440000"
+
+
+def make_supabase(status):
+    """抽出データを埋め込んだレコードを返すSupabaseのモック"""
+    mock_supabase = MagicMock()
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[{
+        "id": RECORD_ID,
+        "original_image_url": "http://example.com/image.jpg",
+        "processing_status": status,
+        "page_count": 2,
+        "extracted_data": [
+            {"id": "b", "record_id": RECORD_ID, "extracted_text": "2ページ目", "page_index": 1},
+            {"id": "a", "record_id": RECORD_ID, "extracted_text": "1ページ目", "page_index": 0},
+        ],
+    }])
+    return mock_supabase
+
+
+def get_record_twice(mock_supabase, monkeypatch):
+    monkeypatch.setattr(main, "record_cache", RecordCache())
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        client = TestClient(main.app)
+        first = client.get(f"/api/records/{RECORD_ID}")
+        second = client.get(f"/api/records/{RECORD_ID}")
+    finally:
+        main.app.dependency_overrides.clear()
+    return first, second
+
+
+def test_get_record_uses_single_embedded_query_and_caches_completed(monkeypatch):
+    """レコードと抽出データを1回の問い合わせで取得し、完了済みなら2回目はキャッシュから返す"""
+    mock_supabase = make_supabase("completed")
+    first, second = get_record_twice(mock_supabase, monkeypatch)
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    data = first.json()
+    assert "extracted_data" not in data["record"]
+    assert [row["id"] for row in data["extracted_data"]] == ["a", "b"]
+    assert data["document_text"] == "1ページ目\n\n2ページ目"
+    mock_supabase.table.return_value.select.assert_called_with("*, extracted_data(*), extracted_fields(*)")
+    assert mock_supabase.table.return_value.select.return_value.eq.return_value.execute.call_count == 1
+
+
+def test_get_record_does_not_cache_unfinished_records(monkeypatch):
+    """処理中のレコードは状態が変わるためキャッシュしない"""
+    mock_supabase = make_supabase("processing")
+    get_record_twice(mock_supabase, monkeypatch)
+
+    assert mock_supabase.table.return_value.select.return_value.eq.return_value.execute.call_count == 2
+
+
+def test_invalidate_discards_entry_and_in_flight_results():
+    """無効化するとキャッシュが消え、無効化前に開始した取得結果は保存されない"""
+    cache = RecordCache()
+    result = {"record": {"id": RECORD_ID, "processing_status": "completed"}, "extracted_data": []}
+    cache.put(RECORD_ID, result, cache.generation())
+    in_flight = cache.generation()
+
+    cache.invalidate(RECORD_ID)
+
+    assert cache.get(RECORD_ID) is None
+    assert cache.put(RECORD_ID, result, in_flight) is False
+    assert cache.put(RECORD_ID, result, cache.generation()) is True
+
+
+@patch("main.job_queue.enqueue", new_callable=AsyncMock)
+def test_reprocess_invalidates_cached_record(mock_enqueue, monkeypatch):
+    """再処理するとキャッシュした詳細を破棄する"""
+    cache = RecordCache()
+    cache.put(RECORD_ID, {"record": {"id": RECORD_ID, "processing_status": "completed"}, "extracted_data": []}, 0)
+    monkeypatch.setattr(main, "record_cache", cache)
+    main.app.dependency_overrides[main.get_supabase] = lambda: make_supabase("completed")
+    try:
+        response = TestClient(main.app).post(f"/api/process/{RECORD_ID}")
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    assert cache.get(RECORD_ID) is None
+
+
+def test_distributed_backend_revalidates_cached_record(monkeypatch):
+    """共有のジョブキューでは、他のプロセスで再処理されたカルテのキャッシュを返さない"""
+    cache = RecordCache()
+    cached = {"record": {"id": RECORD_ID, "processing_status": "completed", "ocr_queued_at": "2025-03-04T12:00:00+00:00"},
+              "extracted_data": [], "fields": []}
+    cache.put(RECORD_ID, cached, cache.generation())
+    monkeypatch.setattr(main, "record_cache", cache)
+    monkeypatch.setattr(main.job_queue.backend, "distributed", True)
+    mock_supabase = make_supabase("completed")
+    execute = mock_supabase.table.return_value.select.return_value.eq.return_value.execute
+    unchanged = MagicMock(data=[{"processing_status": "completed", "ocr_queued_at": "2025-03-04T12:00:00+00:00"}])
+    execute.side_effect = [unchanged, MagicMock(data=[{"processing_status": "pending", "ocr_queued_at": None}]),
+                           execute.return_value]
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        client = TestClient(main.app)
+        first = client.get(f"/api/records/{RECORD_ID}")
+        second = client.get(f"/api/records/{RECORD_ID}")
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert first.json() == cached
+    mock_supabase.table.return_value.select.assert_any_call("processing_status,ocr_queued_at")
+    # 状態が変わっていれば破棄して取得し直す
+    assert [row["id"] for row in second.json()["extracted_data"]] == ["a", "b"]
+    assert execute.call_count == 3
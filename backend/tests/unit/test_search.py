@@ -0,0 +1,85 @@
+import asyncio
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock
+
+import main
+from search import InMemorySearchIndex, SupabaseSearchBackend, make_snippet, parse_query
+
+
+def make_index():
+    index = InMemorySearchIndex()
+    asyncio.run(index.index_pages("record-1", ["診断: 高血圧\n処方: 降圧剤 朝1錠\n所見: 血圧145/95 高血圧"], "2025-03-04T12:00:00"))
+    asyncio.run(index.index_pages("record-2", ["既往歴: 高血圧\n", "診断: 糖尿病"], "2025-03-05T12:00:00"))
+    asyncio.run(index.index_pages("record-3", ["血液検査 異常なし"], "2025-03-06T12:00:00"))
+    return index
+
+
+def test_parse_query_splits_on_full_width_space():
+    """全角スペースでも分割し、長い語を先頭にする"""
+    assert parse_query("血圧　高血圧 血圧") == ["高血圧", "血圧"]
+    assert parse_query("   ") == []
+
+
+def test_in_memory_index_ranks_by_occurrences():
+    """すべての語を含むページを出現回数の多い順に返す"""
+    index = make_index()
+
+    hits = index.search_sync(["高血圧"], limit=10)
+    assert [(hit.record_id, hit.page_index, hit.score) for hit in hits] == [("record-1", 0, 2), ("record-2", 0, 1)]
+
+    # すべての語を含むページだけが一致する
+    assert index.search_sync(["血液", "血圧"], limit=10) == []
+    assert [hit.record_id for hit in index.search_sync(["糖尿病"], limit=10)] == ["record-2"]
+    assert [hit.page_index for hit in index.search_sync(["糖尿病"], limit=10)] == [1]
+
+
+def test_reindex_replaces_previous_pages():
+    """再処理で索引を登録し直すと古い結果は検索されない"""
+    index = make_index()
+    asyncio.run(index.index_pages("record-1", ["診断: 胃炎"]))
+
+    assert [hit.record_id for hit in index.search_sync(["高血圧"], limit=10)] == ["record-2"]
+    assert len(index) == 4
+
+
+def test_snippet_highlights_matches():
+    """一致箇所の前後を切り出し、スニペット内の位置を返す"""
+    text = "あ" * 50 + "高血圧の疑い。血圧145/95"
+    snippet, highlights = make_snippet(text, ["高血圧", "血圧"], width=5)
+    assert snippet.startswith("…")
+    for start, end in highlights:
+        assert snippet[start:end] in ("高血圧", "血圧")
+    assert [snippet[s:e] for s, e in highlights].count("血圧") == 2
+
+
+def test_search_endpoint_paginates(monkeypatch):
+    """検索APIは1ページ分の結果と次のページの有無を返す"""
+    monkeypatch.setattr(main, "search_backend", make_index())
+    client = TestClient(main.app)
+
+    first = client.get("/api/search", params={"q": "高血圧", "limit": 1}).json()
+    second = client.get("/api/search", params={"q": "高血圧", "limit": 1, "offset": 1}).json()
+
+    assert [r["record_id"] for r in first["results"]] == ["record-1"]
+    assert first["has_more"] is True
+    assert [r["record_id"] for r in second["results"]] == ["record-2"]
+    assert second["has_more"] is False
+    assert "高血圧" in first["results"][0]["snippet"]
+    assert client.get("/api/search", params={"q": " "}).status_code == 400
+
+
+def test_supabase_backend_calls_rpc():
+    """Supabaseでは検索用のRPC関数を呼び出す"""
+    mock_supabase = MagicMock()
+    mock_supabase.rpc.return_value.execute.return_value = MagicMock(data=[
+        {"record_id": "record-1", "page_index": 0, "extracted_text": "高血圧", "score": 1, "uploaded_at": "2025-03-04"},
+    ])
+    backend = SupabaseSearchBackend(lambda: mock_supabase)
+
+    hits = asyncio.run(backend.search(["高血圧"], limit=21, offset=20))
+
+    mock_supabase.rpc.assert_called_once_with(
+        "search_extracted_text",
+        {"search_terms": ["高血圧"], "result_limit": 21, "result_offset": 20, "candidate_limit": 1000},
+    )
+    assert hits[0].record_id == "record-1"
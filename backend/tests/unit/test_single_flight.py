@@ -0,0 +1,162 @@
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from ocr_cache import MemoryCacheTier, OCRCache
+from rate_limit import RateLimiter
+from single_flight import SingleFlight
+
+
+def test_single_flight_shares_result_and_errors():
+    """実行中の同じキーの呼び出しは1回だけ実行し、結果とエラーを共有する"""
+    flights = SingleFlight()
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        if value == "bad":
+            raise ValueError("boom")
+        return value.upper()
+
+    async def scenario():
+        results = await asyncio.gather(*(flights.do("a", lambda: work("a")) for _ in range(3)))
+        errors = await asyncio.gather(*(flights.do("b", lambda: work("bad")) for _ in range(2)), return_exceptions=True)
+        # 完了後に同じキーで呼び出した場合は再度実行する
+        again = await flights.do("a", lambda: work("a"))
+        return results, errors, again
+
+    results, errors, again = asyncio.run(scenario())
+
+    assert results == ["A", "A", "A"]
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert again == "A"
+    assert calls == ["a", "bad", "a"]
+    assert flights.stats() == {"in_flight": 0, "executed": 3, "shared": 3}
+
+
+def test_extract_text_coalesces_identical_images(monkeypatch):
+    """同じ画像のOCRが同時に要求された場合、Gemini APIは1回だけ呼ぶ"""
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(main, "ocr_cache", OCRCache(MemoryCacheTier()))
+    monkeypatch.setattr(main, "ocr_flights", SingleFlight())
+
+    async def generate(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return MagicMock(text="診断: 高血圧")
+
+    mock_model = MagicMock()
+    mock_model.generate_content_async = AsyncMock(side_effect=generate)
+
+    async def scenario():
+        return await asyncio.gather(*(main.extract_text(b"same image") for _ in range(3)))
+
+    with patch.object(main.clients, "model", return_value=mock_model):
+        texts = asyncio.run(scenario())
+
+    assert texts == ["診断: 高血圧"] * 3
+    assert mock_model.generate_content_async.call_count == 1
+
+
+def test_process_image_upserts_extracted_data():
+    """再処理・重複実行でも抽出データが重複しないよう、ページごとに上書きする"""
+    mock_supabase = MagicMock()
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch("main.extract_text", AsyncMock(return_value="所見: なし")):
+        asyncio.run(main.process_image("record-1", "http://example.com/a.jpg", b"image"))
+
+    upsert = mock_supabase.table.return_value.upsert
+    assert upsert.call_args.args[0]["page_index"] == 0
+    assert upsert.call_args.kwargs["on_conflict"] == "record_id,page_index"
+    mock_supabase.table.return_value.insert.assert_not_called()
+
+
+@pytest.fixture
+def reprocess_client():
+    mock_supabase = MagicMock()
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value = MagicMock(
+        data=[{"id": "record-1", "original_image_url": "http://example.com/a.jpg", "processing_status": "processing"}]
+    )
+    main.app.dependency_overrides[main.get_supabase] = lambda: mock_supabase
+    try:
+        yield TestClient(main.app), mock_supabase
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+@patch("main.enqueue_ocr_job", new_callable=AsyncMock)
+def test_reprocess_skips_records_already_queued(mock_enqueue, reprocess_client):
+    """キュー投入済み・処理中のカルテは再処理を重複して投入しない"""
+    client, mock_supabase = reprocess_client
+    with patch.object(main.job_queue, "has_record", return_value=True):
+        response = client.post("/api/process/record-1")
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "processing", "record_id": "record-1", "coalesced": True}
+    mock_enqueue.assert_not_called()
+    mock_supabase.table.return_value.update.assert_not_called()
+
+
+def test_concurrent_reprocess_requests_enqueue_once(monkeypatch):
+    """同じカルテへの再処理リクエストが同時に届いた場合は1回だけ投入する"""
+    monkeypatch.setattr(main, "reprocess_flights", SingleFlight())
+    mock_supabase = MagicMock()
+
+    async def slow_execute(query):
+        await asyncio.sleep(0.01)
+        return MagicMock(data=[{"id": "record-1", "original_image_url": "http://example.com/a.jpg"}])
+
+    async def scenario():
+        return await asyncio.gather(*(main.reprocess_record("record-1", supabase=mock_supabase) for _ in range(3)))
+
+    with patch("main.execute", side_effect=slow_execute), \
+            patch("main.enqueue_ocr_job", new_callable=AsyncMock) as mock_enqueue:
+        results = asyncio.run(scenario())
+
+    assert results == [{"status": "processing", "record_id": "record-1"}] * 3
+    mock_enqueue.assert_awaited_once()
+
+
+@pytest.mark.parametrize("order", [(False, True), (True, False)])
+def test_bypass_reprocess_is_not_coalesced_into_cached_reprocess(monkeypatch, order):
+    """bypass_cache=true の再処理は、同時に届いたキャッシュを使う再処理とまとめずに投入する（どちらが先でも）"""
+    monkeypatch.setattr(main, "reprocess_flights", SingleFlight())
+    mock_supabase = MagicMock()
+
+    async def slow_execute(query):
+        await asyncio.sleep(0.01)
+        return MagicMock(data=[{"id": "record-1", "original_image_url": "http://example.com/a.jpg"}])
+
+    async def scenario():
+        return await asyncio.gather(*(
+            main.reprocess_record("record-1", bypass_cache=bypass_cache, supabase=mock_supabase) for bypass_cache in order
+        ))
+
+    with patch("main.execute", side_effect=slow_execute), \
+            patch("main.enqueue_ocr_job", new_callable=AsyncMock) as mock_enqueue:
+        asyncio.run(scenario())
+
+    assert sorted(call.kwargs["bypass_cache"] for call in mock_enqueue.call_args_list) == [False, True]
+
+
+@pytest.mark.parametrize("queued_bypass, requested_bypass, coalesced", [
+    (False, True, False),
+    (True, False, True),
+    (True, True, True),
+])
+@patch("main.enqueue_ocr_job", new_callable=AsyncMock)
+def test_reprocess_coalesces_into_queued_job_only_if_it_honors_bypass(
+    mock_enqueue, reprocess_client, queued_bypass, requested_bypass, coalesced
+):
+    """キュー投入済みのジョブにまとめるのは、キャッシュを使わない指定を満たす場合だけ"""
+    client, _ = reprocess_client
+    job = main.OCRJob(record_id="record-1", image_url="http://example.com/a.jpg", bypass_cache=queued_bypass)
+    with patch.dict(main.job_queue._record_ids, {"record-1": job}):
+        response = client.post("/api/process/record-1", params={"bypass_cache": str(requested_bypass).lower()})
+
+    assert response.status_code == 200
+    assert response.json().get("coalesced", False) is coalesced
+    assert mock_enqueue.called is not coalesced
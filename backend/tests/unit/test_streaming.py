@@ -0,0 +1,61 @@
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import main
+from events import RecordEventBus, format_sse
+from ocr_cache import MemoryCacheTier, OCRCache
+from rate_limit import RateLimiter
+from streaming import PartialTextFlusher
+
+
+class FakeStream:
+    """generate_content_async(stream=True) のレスポンスの代わり"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.usage_metadata = MagicMock(total_token_count=500)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            yield MagicMock(text=chunk)
+
+
+def test_flusher_coalesces_chunks():
+    """最初のチャンクはすぐに通知し、以降は文字数か間隔を満たすまでまとめる"""
+    flushed = []
+    flusher = PartialTextFlusher(flushed.append, interval=60, min_chars=5)
+    for chunk in ["患者名", "：", "山", "田", "太郎", "\n診断"]:
+        flusher.append(chunk)
+
+    assert flushed == ["患者名", "患者名：山田太郎"]
+    assert flusher.text == "患者名：山田太郎\n診断"
+
+
+def test_process_image_streams_partial_text(monkeypatch):
+    """ストリーミング時は生成途中のテキストを partial イベントで配信し、全文を保存する"""
+    bus = RecordEventBus()
+    events = []
+    original_publish = bus.publish
+    monkeypatch.setattr(bus, "publish", lambda *args, **kwargs: events.append(original_publish(*args, **kwargs)))
+    monkeypatch.setattr(main, "record_events", bus)
+    monkeypatch.setattr(main, "ocr_cache", OCRCache(MemoryCacheTier()))
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(main, "ocr_streaming", True)
+    monkeypatch.setattr(main, "ocr_stream_flush_chars", 1)
+
+    mock_model = MagicMock()
+    mock_model.generate_content_async = AsyncMock(return_value=FakeStream(["診断: ", "高血圧"]))
+    mock_supabase = MagicMock()
+    with patch.object(main.clients, "supabase", return_value=mock_supabase), \
+            patch.object(main.clients, "model", return_value=mock_model):
+        asyncio.run(main.process_image("record-1", "http://example.com/a.jpg", b"image"))
+
+    assert mock_model.generate_content_async.call_args.kwargs["stream"] is True
+    partials = [event["partial_text"] for event in events if "partial_text" in event]
+    assert partials == ["診断: ", "診断: 高血圧"]
+    assert format_sse(events[1]).startswith("event: partial\n")
+    assert mock_supabase.table.return_value.upsert.call_args.args[0]["extracted_text"] == "診断: 高血圧"
+    assert events[-1]["processing_status"] == "completed"
@@ -10,6 +10,7 @@ type ExtractedData = {
   record_id: string;
   extracted_text: string;
   extracted_at: string;
+  page_index?: number;
 };
 
 type RecordData = {
@@ -19,17 +20,27 @@ type RecordData = {
     processing_status: string;
   };
   extracted_data: ExtractedData[];
+  document_text?: string; // 複数ページの文書（PDF・TIFF）の全ページを連結したテキスト
+};
+
+type StatusEvent = {
+  record_id: string;
+  processing_status: string;
+  page_count?: number;
+  pages_completed?: number;
+  partial_text?: string; // 生成途中の抽出テキスト（partial イベント）
 };
 
 export default function ResultDisplay({ recordId }: ResultDisplayProps) {
   const [data, setData] = useState<RecordData | null>(null);
   const [loading, setLoading] = useState<boolean>(true);
   const [error, setError] = useState<string | null>(null);
-  const [pollingCount, setPollingCount] = useState<number>(0);
+  const [status, setStatus] = useState<StatusEvent | null>(null);
+  const [partialText, setPartialText] = useState<string>('');
+  const [isSlow, setIsSlow] = useState<boolean>(false);
 
   useEffect(() => {
     let isMounted = true;
-    const maxPollingAttempts = 20; // 最大ポーリング試行回数
     
     const fetchData = async () => {
       try {
@@ -43,59 +54,57 @@ export default function ResultDisplay({ recordId }: ResultDisplayProps) {
         
         if (isMounted) {
           setData(resultData);
-          
-          // 処理ステータスに基づいてポーリングを管理
-          if (resultData.record.processing_status === 'completed' || 
-              resultData.record.processing_status === 'failed' ||
-              pollingCount >= maxPollingAttempts) {
-            // 処理完了またはエラー時、またはポーリング上限に達した場合はポーリングを停止
-            setLoading(false);
-            return true; // ポーリング停止を示す
-          }
-          
-          // ポーリングが継続中でもUIのローディング状態は更新
-          if (resultData.record.processing_status === 'processing') {
-            setLoading(true);
-          }
+          setLoading(false);
         }
-        return false; // ポーリング継続を示す
       } catch (err) {
         console.error('Error fetching result:', err);
         if (isMounted) {
           setError('結果の取得中にエラーが発生しました');
           setLoading(false);
         }
-        return true; // エラー時はポーリングを停止
       }
     };
 
-    // 初回データ取得
-    fetchData();
-    
-    // 動的なポーリング間隔を設定
-    const getPollingInterval = (count: number) => {
-      // 最初は短い間隔で、その後徐々に長くする
-      if (count < 5) return 3000; // 最初の5回は3秒
-      if (count < 10) return 5000; // 次の5回は5秒
-      return 10000; // それ以降は10秒
-    };
+    // 処理状態の変化をサーバーから受け取る（ポーリングはしない）
+    const eventSource = new EventSource(`/api/records/${recordId}/events`);
     
-    // ポーリングを実行
-    const intervalId = setInterval(async () => {
-      const shouldStop = await fetchData();
+    eventSource.addEventListener('status', (e) => {
+      const event: StatusEvent = JSON.parse((e as MessageEvent).data);
+      if (!isMounted) return;
+      setStatus(event);
       
-      if (shouldStop) {
-        clearInterval(intervalId);
-      } else {
-        setPollingCount(prev => prev + 1);
+      // 処理完了またはエラー時に結果を1回だけ取得する
+      if (event.processing_status === 'completed' || event.processing_status === 'failed') {
+        eventSource.close();
+        fetchData();
+      }
+    });
+    
+    // 生成途中のテキストを表示する（サーバー側で一定間隔ごとにまとめて送信される）
+    eventSource.addEventListener('partial', (e) => {
+      const event: StatusEvent = JSON.parse((e as MessageEvent).data);
+      if (!isMounted) return;
+      setStatus(event);
+      setPartialText(event.partial_text ?? '');
+    });
+    
+    eventSource.onerror = () => {
+      // 一時的な切断はブラウザが自動で再接続する。接続が閉じられた場合（404など）のみエラーにする
+      if (eventSource.readyState === EventSource.CLOSED && isMounted) {
+        setError('結果の取得中にエラーが発生しました');
+        setLoading(false);
       }
-    }, getPollingInterval(pollingCount));
+    };
+    
+    // 処理に時間がかかっている場合の案内
+    const slowTimer = setTimeout(() => setIsSlow(true), 60000);
 
     return () => {
       isMounted = false;
-      clearInterval(intervalId);
+      eventSource.close();
+      clearTimeout(slowTimer);
     };
-  }, [recordId, pollingCount]);
+  }, [recordId]);
 
   // 文字列をJSONとしてパースして表示する試み
   const renderExtractedText = (text: string) => {
@@ -138,17 +147,27 @@ export default function ResultDisplay({ recordId }: ResultDisplayProps) {
   };
 
   // ローディング表示の改良
-  if (loading && (!data || data.record.processing_status === 'pending' || data.record.processing_status === 'processing')) {
+  if (loading) {
     return (
       <div className="text-center py-8">
         <div className="animate-spin rounded-full h-12 w-12 border-t-2 border-b-2 border-blue-500 mx-auto"></div>
         <p className="mt-4 text-gray-600">
-          {data?.record.processing_status === 'processing' 
+          {status?.processing_status === 'processing' 
             ? "テキスト抽出中です。しばらくお待ちください..." 
             : "処理の準備中です..."}
         </p>
+        {status && (status.page_count ?? 1) > 1 && status.pages_completed !== undefined && (
+          <p className="mt-2 text-sm text-gray-600">
+            {status.pages_completed} / {status.page_count} ページ完了
+          </p>
+        )}
+        {partialText && (
+          <div className="mt-4 text-left bg-gray-50 p-4 rounded-lg whitespace-pre-wrap overflow-auto max-h-80 text-gray-700">
+            {partialText}
+          </div>
+        )}
         <p className="mt-2 text-xs text-gray-500">
-          {pollingCount > 10 
+          {isSlow 
             ? "処理に時間がかかっています。大きな画像や複雑なカルテの場合は数分かかることがあります。" 
             : ""}
         </p>
@@ -220,6 +239,8 @@ export default function ResultDisplay({ recordId }: ResultDisplayProps) {
                 </div>
               </div>
             </div>
+          ) : data.document_text ? (
+            renderExtractedText(data.document_text)
           ) : data.extracted_data && data.extracted_data.length > 0 ? (
             renderExtractedText(data.extracted_data[0].extracted_text)
           ) : (
@@ -22,7 +22,9 @@ export default function UploadForm({ onUploadStart, onUploadSuccess }: UploadFor
     onDrop,
     accept: {
       'image/jpeg': ['.jpg', '.jpeg'],
-      'image/png': ['.png']
+      'image/png': ['.png'],
+      'image/tiff': ['.tif', '.tiff'],
+      'application/pdf': ['.pdf']
     },
     maxFiles: 1,
     multiple: false
@@ -94,7 +96,7 @@ export default function UploadForm({ onUploadStart, onUploadSuccess }: UploadFor
                 {isDragActive ? 'ファイルをここにドロップ' : 'クリックまたはドラッグ＆ドロップでファイルを選択'}
               </p>
               <p className="mt-1 text-xs text-gray-500">
-                PNG, JPG (最大10MB)
+                PNG, JPG (最大10MB) / PDF, TIFF (最大50MB)
               </p>
             </div>
           )}
@@ -0,0 +1,6 @@
+-- Add batch id to medical_records for batch uploads
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS batch_id UUID;
+
+-- Create index for batch progress lookups
+CREATE INDEX IF NOT EXISTS idx_medical_records_batch_id ON public.medical_records(batch_id)
+  WHERE batch_id IS NOT NULL;
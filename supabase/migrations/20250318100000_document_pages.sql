@@ -0,0 +1,9 @@
+-- Add page count to medical_records for multi-page documents (PDF / TIFF)
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS page_count INTEGER NOT NULL DEFAULT 1;
+
+-- Add page index to extracted_data (0 for single images)
+ALTER TABLE public.extracted_data ADD COLUMN IF NOT EXISTS page_index INTEGER NOT NULL DEFAULT 0;
+
+-- Create index for fetching pages in order
+CREATE INDEX IF NOT EXISTS idx_extracted_data_record_id_page_index
+  ON public.extracted_data(record_id, page_index);
@@ -0,0 +1,14 @@
+-- Keyset pagination on (uploaded_at, id) requires uploaded_at to be set on every row
+UPDATE public.medical_records SET uploaded_at = NOW() WHERE uploaded_at IS NULL;
+ALTER TABLE public.medical_records ALTER COLUMN uploaded_at SET NOT NULL;
+
+-- Composite index for cursor pagination (replaces the single-column index)
+CREATE INDEX IF NOT EXISTS idx_medical_records_uploaded_at_id
+  ON public.medical_records(uploaded_at DESC, id DESC);
+DROP INDEX IF EXISTS public.idx_medical_records_uploaded_at;
+
+-- Partial compound index for listing unfinished / failed records by status.
+-- Completed records are the vast majority and are served by the composite index above.
+CREATE INDEX IF NOT EXISTS idx_medical_records_status_uploaded_at_id
+  ON public.medical_records(processing_status, uploaded_at DESC, id DESC)
+  WHERE processing_status <> 'completed';
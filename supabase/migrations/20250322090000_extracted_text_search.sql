@@ -0,0 +1,55 @@
+-- Trigram index for substring search over extracted text (works for Japanese, which has no word boundaries).
+-- Terms of 3 or more characters are served by the index; shorter terms fall back to a scan.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_extracted_data_text_trgm
+  ON public.extracted_data USING gin (extracted_text gin_trgm_ops);
+
+-- Build an ILIKE pattern that matches the term literally as a substring
+CREATE OR REPLACE FUNCTION public.substring_pattern(term TEXT)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE
+AS $$
+  SELECT '%' || replace(replace(replace(term, '\', '\\'), '%', '\%'), '_', '\_') || '%';
+$$;
+
+-- Ranked search: pages containing every term, ordered by total number of occurrences.
+-- The first term (the caller puts the longest first) is matched on its own so the trigram index is used.
+CREATE OR REPLACE FUNCTION public.search_extracted_text(
+  search_terms TEXT[],
+  result_limit INTEGER DEFAULT 20,
+  result_offset INTEGER DEFAULT 0
+)
+RETURNS TABLE (
+  record_id UUID,
+  page_index INTEGER,
+  extracted_text TEXT,
+  score INTEGER,
+  uploaded_at TIMESTAMP WITH TIME ZONE
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    d.record_id,
+    d.page_index,
+    d.extracted_text,
+    (
+      SELECT COALESCE(SUM(
+        (length(d.extracted_text) - length(replace(lower(d.extracted_text), lower(term), '')))
+          / GREATEST(length(term), 1)
+      ), 0)::INTEGER
+      FROM unnest(search_terms) AS term
+    ) AS score,
+    r.uploaded_at
+  FROM public.extracted_data d
+  JOIN public.medical_records r ON r.id = d.record_id
+  WHERE d.extracted_text ILIKE public.substring_pattern(search_terms[1])
+    AND d.extracted_text ILIKE ALL (
+      SELECT public.substring_pattern(term) FROM unnest(search_terms) AS term
+    )
+  ORDER BY score DESC, r.uploaded_at DESC, d.record_id, d.page_index
+  LIMIT GREATEST(result_limit, 1)
+  OFFSET GREATEST(result_offset, 0);
+$$;
+
+GRANT EXECUTE ON FUNCTION public.search_extracted_text(TEXT[], INTEGER, INTEGER) TO anon, authenticated, service_role;
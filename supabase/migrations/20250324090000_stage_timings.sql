@@ -0,0 +1,3 @@
+-- Per-record pipeline stage timings in seconds (upload_read, storage_upload, db_insert, queue_wait,
+-- download, preprocess, gemini, db_write), written together with the extracted text
+ALTER TABLE public.extracted_data ADD COLUMN IF NOT EXISTS stage_timings JSONB;
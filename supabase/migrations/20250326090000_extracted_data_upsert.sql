@@ -0,0 +1,14 @@
+-- One extracted_data row per record page so that reprocessing (or a job that ran twice) overwrites
+-- the previous result with an upsert instead of appending duplicate rows
+
+-- Keep only the latest row for each (record_id, page_index)
+DELETE FROM public.extracted_data d
+USING public.extracted_data newer
+WHERE d.record_id = newer.record_id
+  AND d.page_index = newer.page_index
+  AND (d.extracted_at, d.id) < (newer.extracted_at, newer.id);
+
+-- Replace the non-unique index with a unique one (used as the upsert conflict target)
+DROP INDEX IF EXISTS public.idx_extracted_data_record_id_page_index;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_extracted_data_record_id_page_index
+  ON public.extracted_data(record_id, page_index);
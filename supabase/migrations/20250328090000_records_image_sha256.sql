@@ -0,0 +1,3 @@
+-- SHA-256 of the uploaded image, used to find the image in the worker's local blob cache
+-- (reprocessing then does not download it again from storage). NULL for records uploaded before this column
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS image_sha256 TEXT;
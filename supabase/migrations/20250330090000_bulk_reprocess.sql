@@ -0,0 +1,42 @@
+-- Bulk reprocessing after a prompt / model change
+
+-- OCR settings the record was last processed with: "<model>:<hash of prompt, generation and preprocess settings>"
+-- ('' for records processed before this column was added)
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS ocr_version TEXT NOT NULL DEFAULT '';
+
+-- Bulk reprocess run that last scheduled the record (progress is counted from this column)
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS reprocess_run_id UUID;
+
+CREATE INDEX IF NOT EXISTS idx_medical_records_reprocess_run_id
+  ON public.medical_records(reprocess_run_id, processing_status)
+  WHERE reprocess_run_id IS NOT NULL;
+
+-- One row per bulk reprocess request. The scheduler saves the keyset cursor of the last scheduled record
+-- after every batch, so a restarted process resumes a running run where it stopped
+CREATE TABLE IF NOT EXISTS public.reprocess_runs (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  status TEXT NOT NULL DEFAULT 'running',
+  filter JSONB NOT NULL DEFAULT '{}'::jsonb,
+  bypass_cache BOOLEAN NOT NULL DEFAULT false,
+  batch_size INTEGER NOT NULL DEFAULT 100,
+  total INTEGER,
+  scheduled INTEGER NOT NULL DEFAULT 0,
+  skipped INTEGER NOT NULL DEFAULT 0,
+  cursor TEXT,
+  error TEXT,
+  created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_reprocess_runs_status ON public.reprocess_runs(status);
+
+ALTER TABLE public.reprocess_runs ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Anonymous select reprocess_runs" ON public.reprocess_runs
+  FOR SELECT USING (true);
+
+CREATE POLICY "Anonymous insert reprocess_runs" ON public.reprocess_runs
+  FOR INSERT WITH CHECK (true);
+
+CREATE POLICY "Anonymous update reprocess_runs" ON public.reprocess_runs
+  FOR UPDATE USING (true);
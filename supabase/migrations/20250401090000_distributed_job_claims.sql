@@ -0,0 +1,81 @@
+-- Distributed OCR job claiming (JOB_QUEUE_BACKEND=supabase)
+-- medical_records itself is the queue: worker processes on any node claim pending records with
+-- FOR UPDATE SKIP LOCKED, hold a lease while processing and extend it with heartbeats.
+-- Records whose lease expired (the worker crashed or lost its connection) are claimed again.
+
+-- Worker that holds the record and until when
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS claimed_by TEXT;
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITH TIME ZONE;
+-- Number of claims since the record was last queued (records that keep killing workers are given up on)
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS ocr_attempts INTEGER NOT NULL DEFAULT 0;
+-- Job options that used to live only in the in-process queue
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS ocr_bypass_cache BOOLEAN NOT NULL DEFAULT false;
+ALTER TABLE public.medical_records ADD COLUMN IF NOT EXISTS ocr_queued_at TIMESTAMP WITH TIME ZONE DEFAULT NOW();
+
+CREATE INDEX IF NOT EXISTS idx_medical_records_claimable
+  ON public.medical_records(uploaded_at)
+  WHERE processing_status IN ('pending', 'processing');
+
+-- Claim up to p_limit records for p_worker_id. Concurrent callers skip each other's locked rows,
+-- so every record is handed to exactly one worker
+CREATE OR REPLACE FUNCTION public.claim_ocr_jobs(
+  p_worker_id TEXT,
+  p_limit INTEGER DEFAULT 1,
+  p_lease_seconds INTEGER DEFAULT 60,
+  p_max_attempts INTEGER DEFAULT 3
+)
+RETURNS TABLE (
+  id UUID,
+  original_image_url TEXT,
+  image_sha256 TEXT,
+  ocr_bypass_cache BOOLEAN,
+  ocr_queued_at TIMESTAMP WITH TIME ZONE,
+  ocr_attempts INTEGER,
+  reclaimed BOOLEAN
+)
+LANGUAGE sql
+AS $$
+  -- Give up on records whose lease expired on every attempt
+  UPDATE public.medical_records
+     SET processing_status = 'failed', claimed_by = NULL, lease_expires_at = NULL
+   WHERE processing_status = 'processing'
+     AND lease_expires_at < NOW()
+     AND ocr_attempts >= p_max_attempts;
+
+  WITH candidates AS (
+    SELECT r.id, r.claimed_by IS NOT NULL AS reclaimed
+      FROM public.medical_records r
+     WHERE r.processing_status IN ('pending', 'processing')
+       AND (r.lease_expires_at IS NULL OR r.lease_expires_at < NOW())
+       AND r.ocr_attempts < p_max_attempts
+     ORDER BY r.uploaded_at
+     LIMIT p_limit
+     FOR UPDATE SKIP LOCKED
+  )
+  UPDATE public.medical_records r
+     SET processing_status = 'processing',
+         claimed_by = p_worker_id,
+         lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+         ocr_attempts = r.ocr_attempts + 1
+    FROM candidates c
+   WHERE r.id = c.id
+  RETURNING r.id, r.original_image_url, r.image_sha256, r.ocr_bypass_cache, r.ocr_queued_at, r.ocr_attempts,
+            c.reclaimed;
+$$;
+
+-- Extend the leases p_worker_id still holds and return those record ids
+-- (a missing id means the lease expired and another worker reclaimed the record)
+CREATE OR REPLACE FUNCTION public.extend_ocr_leases(
+  p_worker_id TEXT,
+  p_ids UUID[],
+  p_lease_seconds INTEGER DEFAULT 60
+)
+RETURNS TABLE (id UUID)
+LANGUAGE sql
+AS $$
+  UPDATE public.medical_records
+     SET lease_expires_at = NOW() + make_interval(secs => p_lease_seconds)
+   WHERE medical_records.id = ANY(p_ids)
+     AND claimed_by = p_worker_id
+  RETURNING medical_records.id;
+$$;
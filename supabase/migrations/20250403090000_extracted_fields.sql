@@ -0,0 +1,41 @@
+-- Structured fields parsed from the extracted text (vitals, dates incl. Japanese eras, medications)
+-- so consumers can query values like "systolic blood pressure >= 140" without re-parsing extracted_text.
+-- The fields of a record are replaced as a whole when it is reprocessed.
+CREATE TABLE IF NOT EXISTS public.extracted_fields (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  record_id UUID NOT NULL REFERENCES public.medical_records(id) ON DELETE CASCADE,
+  page_index INTEGER NOT NULL DEFAULT 0,
+  -- vital / date / medication
+  field_type TEXT NOT NULL,
+  -- e.g. body_temperature, blood_pressure_systolic, birth_date, or the drug name for medications
+  name TEXT NOT NULL,
+  value_text TEXT,
+  value_numeric NUMERIC,
+  value_date DATE,
+  unit TEXT,
+  -- Extra details such as the dosage of a medication ({"quantity": 3, "form": "錠", "times_per_day": 3})
+  attributes JSONB NOT NULL DEFAULT '{}'::jsonb,
+  -- Matched text and its character offset in the NFKC-normalized page text
+  raw_text TEXT NOT NULL,
+  position INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_extracted_fields_record_id
+  ON public.extracted_fields(record_id, page_index, position);
+CREATE INDEX IF NOT EXISTS idx_extracted_fields_numeric
+  ON public.extracted_fields(field_type, name, value_numeric);
+CREATE INDEX IF NOT EXISTS idx_extracted_fields_date
+  ON public.extracted_fields(name, value_date)
+  WHERE value_date IS NOT NULL;
+
+ALTER TABLE public.extracted_fields ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Anonymous select extracted_fields" ON public.extracted_fields
+  FOR SELECT USING (true);
+
+CREATE POLICY "Anonymous insert extracted_fields" ON public.extracted_fields
+  FOR INSERT WITH CHECK (true);
+
+CREATE POLICY "Anonymous delete extracted_fields" ON public.extracted_fields
+  FOR DELETE USING (true);
@@ -0,0 +1,52 @@
+-- Fail records whose OCR job kept failing (JOB_QUEUE_BACKEND=supabase)
+-- ack releases the claim (lease_expires_at = NULL) even when the handler raised before writing a status,
+-- so such records are claimed again right away. Once they reach p_max_attempts they were neither
+-- claimable nor given up on and stayed 'processing' forever.
+
+-- Claim up to p_limit records for p_worker_id. Concurrent callers skip each other's locked rows,
+-- so every record is handed to exactly one worker
+CREATE OR REPLACE FUNCTION public.claim_ocr_jobs(
+  p_worker_id TEXT,
+  p_limit INTEGER DEFAULT 1,
+  p_lease_seconds INTEGER DEFAULT 60,
+  p_max_attempts INTEGER DEFAULT 3
+)
+RETURNS TABLE (
+  id UUID,
+  original_image_url TEXT,
+  image_sha256 TEXT,
+  ocr_bypass_cache BOOLEAN,
+  ocr_queued_at TIMESTAMP WITH TIME ZONE,
+  ocr_attempts INTEGER,
+  reclaimed BOOLEAN
+)
+LANGUAGE sql
+AS $$
+  -- Give up on records that were claimed p_max_attempts times without finishing: the lease expired
+  -- (the worker died) or was released by ack after the handler raised before writing a status
+  UPDATE public.medical_records
+     SET processing_status = 'failed', claimed_by = NULL, lease_expires_at = NULL
+   WHERE processing_status = 'processing'
+     AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+     AND ocr_attempts >= p_max_attempts;
+
+  WITH candidates AS (
+    SELECT r.id, r.claimed_by IS NOT NULL AS reclaimed
+      FROM public.medical_records r
+     WHERE r.processing_status IN ('pending', 'processing')
+       AND (r.lease_expires_at IS NULL OR r.lease_expires_at < NOW())
+       AND r.ocr_attempts < p_max_attempts
+     ORDER BY r.uploaded_at
+     LIMIT p_limit
+     FOR UPDATE SKIP LOCKED
+  )
+  UPDATE public.medical_records r
+     SET processing_status = 'processing',
+         claimed_by = p_worker_id,
+         lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+         ocr_attempts = r.ocr_attempts + 1
+    FROM candidates c
+   WHERE r.id = c.id
+  RETURNING r.id, r.original_image_url, r.image_sha256, r.ocr_bypass_cache, r.ocr_queued_at, r.ocr_attempts,
+            c.reclaimed;
+$$;
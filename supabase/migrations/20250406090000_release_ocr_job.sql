@@ -0,0 +1,24 @@
+-- Release a claimed OCR job and requeue it when it was reprocessed while being processed
+-- (JOB_QUEUE_BACKEND=supabase). A reprocess that arrives while another worker holds the claim only
+-- sets processing_status = 'pending' and a newer ocr_queued_at. That worker then wrote 'completed' and
+-- released the claim, silently dropping the reprocess. The release now compares ocr_queued_at with the
+-- value the worker claimed and puts the record back to 'pending' if it moved, in one statement.
+CREATE OR REPLACE FUNCTION public.release_ocr_job(
+  p_id UUID,
+  p_worker_id TEXT,
+  p_claimed_queued_at TIMESTAMP WITH TIME ZONE
+)
+RETURNS TABLE (id UUID, requeued BOOLEAN)
+LANGUAGE sql
+AS $$
+  UPDATE public.medical_records
+     SET claimed_by = NULL,
+         lease_expires_at = NULL,
+         processing_status = CASE
+           WHEN ocr_queued_at > p_claimed_queued_at THEN 'pending'
+           ELSE processing_status
+         END
+   WHERE medical_records.id = p_id
+     AND claimed_by = p_worker_id
+  RETURNING medical_records.id, COALESCE(ocr_queued_at > p_claimed_queued_at, false);
+$$;
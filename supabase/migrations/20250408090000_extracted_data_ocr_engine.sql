@@ -0,0 +1,4 @@
+-- Model that extracted each page (e.g. gemini-1.5-pro, gemini-1.5-flash, tesseract) when OCR routing is enabled.
+-- Records with pages extracted by the local engine get an ocr_version ending in "+tesseract",
+-- so the outdated bulk reprocess re-runs them with Gemini.
+ALTER TABLE public.extracted_data ADD COLUMN IF NOT EXISTS ocr_engine TEXT;
@@ -0,0 +1,77 @@
+-- pg_trgm cannot serve 1-2 character terms from its index, and most Japanese medical terms are that short
+-- (e.g. 咳, 熱, 浮腫), so those searches scanned every page and computed the score for each match.
+-- Index the distinct characters and character bigrams of each page instead (needs no extension such as pg_bigm):
+-- a page can only contain a term if it contains every character and bigram of the term, for any term length.
+CREATE OR REPLACE FUNCTION public.text_grams(content TEXT)
+RETURNS TEXT[]
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+  SELECT COALESCE(array_agg(DISTINCT substr(lowered, i, n)), '{}')
+  FROM (SELECT lower(COALESCE(content, '')) AS lowered) AS t,
+    generate_series(1, length(t.lowered)) AS i,
+    (VALUES (1), (2)) AS sizes(n)
+  WHERE i + n - 1 <= length(t.lowered);
+$$;
+
+ALTER TABLE public.extracted_data
+  ADD COLUMN IF NOT EXISTS text_grams TEXT[] GENERATED ALWAYS AS (public.text_grams(extracted_text)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_extracted_data_text_grams
+  ON public.extracted_data USING gin (text_grams);
+
+-- The trigram index is no longer used by search_extracted_text
+DROP INDEX IF EXISTS public.idx_extracted_data_text_trgm;
+
+-- Ranked search: pages containing every term, ordered by total number of occurrences.
+-- Candidates are narrowed by the gram index, rechecked with ILIKE, and capped to the candidate_limit
+-- most recently uploaded pages before the occurrence count is computed, so very common terms stay cheap.
+DROP FUNCTION IF EXISTS public.search_extracted_text(TEXT[], INTEGER, INTEGER);
+
+CREATE OR REPLACE FUNCTION public.search_extracted_text(
+  search_terms TEXT[],
+  result_limit INTEGER DEFAULT 20,
+  result_offset INTEGER DEFAULT 0,
+  candidate_limit INTEGER DEFAULT 1000
+)
+RETURNS TABLE (
+  record_id UUID,
+  page_index INTEGER,
+  extracted_text TEXT,
+  score INTEGER,
+  uploaded_at TIMESTAMP WITH TIME ZONE
+)
+LANGUAGE sql STABLE
+AS $$
+  WITH candidates AS (
+    SELECT d.record_id, d.page_index, d.extracted_text, r.uploaded_at
+    FROM public.extracted_data d
+    JOIN public.medical_records r ON r.id = d.record_id
+    WHERE d.text_grams @> (
+        SELECT COALESCE(array_agg(gram), '{}')
+        FROM unnest(search_terms) AS term, unnest(public.text_grams(term)) AS gram
+      )
+      AND d.extracted_text ILIKE ALL (
+        SELECT public.substring_pattern(term) FROM unnest(search_terms) AS term
+      )
+    ORDER BY r.uploaded_at DESC, d.record_id, d.page_index
+    LIMIT GREATEST(candidate_limit, GREATEST(result_offset, 0) + GREATEST(result_limit, 1))
+  )
+  SELECT
+    c.record_id,
+    c.page_index,
+    c.extracted_text,
+    (
+      SELECT COALESCE(SUM(
+        (length(c.extracted_text) - length(replace(lower(c.extracted_text), lower(term), '')))
+          / GREATEST(length(term), 1)
+      ), 0)::INTEGER
+      FROM unnest(search_terms) AS term
+    ) AS score,
+    c.uploaded_at
+  FROM candidates c
+  ORDER BY score DESC, c.uploaded_at DESC, c.record_id, c.page_index
+  LIMIT GREATEST(result_limit, 1)
+  OFFSET GREATEST(result_offset, 0);
+$$;
+
+GRANT EXECUTE ON FUNCTION public.search_extracted_text(TEXT[], INTEGER, INTEGER, INTEGER) TO anon, authenticated, service_role;
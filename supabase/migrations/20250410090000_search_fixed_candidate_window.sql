@@ -0,0 +1,50 @@
+-- Rank every result page over the same candidate window.
+-- The window used to grow with result_offset, so each page of results was ranked over a different set
+-- and rows were duplicated or skipped across pages. Pagination now stays inside the candidate_limit
+-- most recently uploaded matching pages; ties are broken by (record_id, page_index) as in the in-memory index.
+CREATE OR REPLACE FUNCTION public.search_extracted_text(
+  search_terms TEXT[],
+  result_limit INTEGER DEFAULT 20,
+  result_offset INTEGER DEFAULT 0,
+  candidate_limit INTEGER DEFAULT 1000
+)
+RETURNS TABLE (
+  record_id UUID,
+  page_index INTEGER,
+  extracted_text TEXT,
+  score INTEGER,
+  uploaded_at TIMESTAMP WITH TIME ZONE
+)
+LANGUAGE sql STABLE
+AS $$
+  WITH candidates AS (
+    SELECT d.record_id, d.page_index, d.extracted_text, r.uploaded_at
+    FROM public.extracted_data d
+    JOIN public.medical_records r ON r.id = d.record_id
+    WHERE d.text_grams @> (
+        SELECT COALESCE(array_agg(gram), '{}')
+        FROM unnest(search_terms) AS term, unnest(public.text_grams(term)) AS gram
+      )
+      AND d.extracted_text ILIKE ALL (
+        SELECT public.substring_pattern(term) FROM unnest(search_terms) AS term
+      )
+    ORDER BY r.uploaded_at DESC, d.record_id, d.page_index
+    LIMIT GREATEST(candidate_limit, 1)
+  )
+  SELECT
+    c.record_id,
+    c.page_index,
+    c.extracted_text,
+    (
+      SELECT COALESCE(SUM(
+        (length(c.extracted_text) - length(replace(lower(c.extracted_text), lower(term), '')))
+          / GREATEST(length(term), 1)
+      ), 0)::INTEGER
+      FROM unnest(search_terms) AS term
+    ) AS score,
+    c.uploaded_at
+  FROM candidates c
+  ORDER BY score DESC, c.uploaded_at DESC, c.record_id, c.page_index
+  LIMIT GREATEST(result_limit, 1)
+  OFFSET GREATEST(result_offset, 0);
+$$;